@@ -16,9 +16,6 @@ from pprint import pprint
 
 from tabulate import tabulate
 
-# pyATS
-from genie.utils import Dq
-
 #
 # libディレクトリをパスに加える
 #
@@ -29,167 +26,212 @@ if lib_dir not in sys.path:
     sys.path.append(lib_dir)
 
 # lib/db_util/db_util.py
-from db_util import get_dhcp_clients_documents
-from db_util import search_mac_vendors
-from db_util import get_wlc_clients_documents
-from db_util import get_mac_address_table
+from db_util import DbSession
+from db_util import iter_dhcp_clients_documents
+from db_util import search_mac_vendors_many
+from db_util import iter_wlc_clients_documents
+from db_util import iter_documents
+from db_util import search_device_mac_address_table
+from db_util import to_mac
 
 
 logger = logging.getLogger(__name__)
 
 
-def analyze_dhcp() -> dict:
-    known_mac = {}
-
-    # 全件回す
-    docs = get_dhcp_clients_documents()
-    for doc in docs:
-        dhcp_list = doc['doc_data']
-        for d in dhcp_list:
-            # d はこんな感じ {'ip': a.b.c.d, 'mac': AA:BB:CC:DD:EE:FF}
-            mac_address = d['mac'].upper()
-            ip_address = d['ip']
-            if known_mac.get(mac_address, None) is None:
-                known_mac[mac_address] = {}
-                known_mac[mac_address]['ip_address'] = ip_address
-                # このMACアドレスが何かを調べる
-                searched = search_mac_vendors(mac_address=mac_address)
-                # 検索結果はこんな感じ
-                # [{'blockType': 'MA-L', 'lastUpdate': '2020/08/13', 'macPrefix': '90:9A:4A', 'private': False, 'vendorName': 'TP-LINK TECHNOLOGIES CO.,LTD.'}]
-
-                if searched:
-                    known_mac[mac_address]['vendor'] = searched[0]['vendorName']
-                else:
-                    known_mac[mac_address]['vendor'] = ''
-
-    return known_mac
+# 取り込み元
+SOURCE_DHCP = 'dhcp'
+SOURCE_WLC = 'wlc'
+SOURCE_CATALYST = 'catalyst'
 
-def tabulate_analyze_dhcp_result(known_mac: dict):
-    tabulate_list = []
-    for mac, props in known_mac.items():
-        ip_address = props.get('ip_address', '')
-        vendor = props.get('vendor', '')
-        tabulate_list.append([mac, ip_address, vendor])
+# 無視するポート、アップリンクやダウンリンクで学習したMACアドレスは端末の場所ではない
+# c2960cx-8pcのGig0/1はアップリンク、c3560c-12pc-sのGig0/2はダウンリンク
+IGNORE_PORTS = {
+    ('c2960cx-8pc', 'GigabitEthernet0/1'),
+    ('c3560c-12pc-s', 'GigabitEthernet0/2'),
+}
 
-    # 2番目の要素 vendor でソートする
-    tabulate_list = sorted(tabulate_list, key=lambda x: x[2], reverse=True)
 
-    return tabulate(tabulate_list, headers=['mac', 'ip', 'vendor'], tablefmt='github')
+def iter_dhcp_entries(since:float=None):
+    """
+    DHCPクライアントの全スナップショットを新しい順に回して(MACアドレス, 属性)を返すジェネレータ
+
+    Args:
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+
+    Yields:
+        tuple: (MacAddress, {'ip_address': ...})
+    """
+    for doc in iter_dhcp_clients_documents(since=since):
+        # d はこんな感じ {'ip': a.b.c.d, 'mac': AA:BB:CC:DD:EE:FF}
+        for d in doc['doc_data']:
+            mac = to_mac(d.get('mac'))
+            if mac is None:
+                continue
+            yield mac, {'ip_address': d.get('ip', '')}
 
 
+def iter_wlc_entries(since:float=None):
+    """
+    WLCクライアントの全スナップショットを新しい順に回して(MACアドレス, 属性)を返すジェネレータ
 
-def analyze_wlc(known_mac: dict):
+    Args:
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
 
-    docs = get_wlc_clients_documents()
-    for doc in docs:
+    Yields:
+        tuple: (MacAddress, {'ip_address': ..., 'device_type': ..., 'hostname': ..., 'ap_name': ..., 'ssid': ...})
+    """
+    for doc in iter_wlc_clients_documents(since=since):
         # {
         #     'timestamp': float型 タイムスタンプ,
         #     'doc_data': [ {'mac_address': a.b.c.d, 'ap_name': ...}, {}, {}]
         # }
-
-        # timestamp = doc['timestamp']
-        doc_data = doc['doc_data']
-        for d in doc_data:
-            mac_address = d.get('mac_address', '').upper()
-            device_type = d.get('device_type', '')
-            hostname = d.get('hostname', '')
-            ip_address = d.get('ip_address', '')
-            ap_name = d.get('ap_name', '')
-            ssid = d.get('wireless_lan_network_name', '')
-
-            if known_mac.get(mac_address, None) is None:
-                known_mac[mac_address] = {}
-                known_mac[mac_address]['ip_address'] = ip_address
-
-            if known_mac[mac_address].get('device_type', None) is None:
-                known_mac[mac_address]['device_type'] = device_type
-
-            if known_mac[mac_address].get('hostname', None) is None:
-                known_mac[mac_address]['hostname'] = hostname
-
-            if known_mac[mac_address].get('ap_name', None) is None:
-                known_mac[mac_address]['ap_name'] = ap_name
-
-            if known_mac[mac_address].get('ssid', None) is None:
-                known_mac[mac_address]['ssid'] = ssid
-
-    return known_mac
-
-
-def tabulate_analyze_wlc_result(known_mac: dict):
-    tabulate_list = []
-    for mac, props in known_mac.items():
-        ip_address = props.get('ip_address', '')
-        vendor = props.get('vendor', '')
-        device_type = props.get('device_type', '')
-        hostname = props.get('hostname', '')
-        ap_name = props.get('ap_name', '')
-        ssid = props.get('ssid', '')
-
-        tabulate_list.append([mac, ip_address, vendor, device_type, hostname, ap_name, ssid])
-
-    # 2番目の要素 vendor でソートする
-    tabulate_list = sorted(tabulate_list, key=lambda x: x[2], reverse=True)
-
-    return tabulate(tabulate_list, headers=['mac', 'ip', 'vendor', 'type', 'hostname', 'ap', 'ssid'], tablefmt='github')
+        for d in doc['doc_data']:
+            mac = to_mac(d.get('mac_address'))
+            if mac is None:
+                continue
+            yield mac, {
+                'ip_address': d.get('ip_address', ''),
+                'device_type': d.get('device_type', ''),
+                'hostname': d.get('hostname', ''),
+                'ap_name': d.get('ap_name', ''),
+                'ssid': d.get('wireless_lan_network_name', ''),
+            }
 
 
-def analyze_catalyst(known_mac: dict):
+def iter_catalyst_entries(since:float=None):
+    """
+    Catalystのmac_address_tableの全スナップショットを新しい順に回して(MACアドレス, 属性)を返すジェネレータ
 
-    docs = get_mac_address_table()
+    全装置のスナップショットがタイムスタンプの順に混ざって返ってくる。
 
-    for doc in docs:
+    Args:
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
 
+    Yields:
+        tuple: (MacAddress, {'device': ..., 'intf': ...})
+    """
+    for doc in iter_documents('mac_address_table', since=since):
         # {
         #   'device_name': xxx,
         #   'doc_type': xxx,
         #   'doc_data': {},
         #   'timestamp': xxx
         # }
-
-        # timestamp = doc['timestamp']
         device_name = doc['device_name']
-        doc_data = doc['doc_data']
 
-        # pprint(doc_data)
         # {'mac_table': {'vlans': {'1': {'mac_addresses': {'0000.5e00.0101': {'interfaces': {'FastEthernet0/7': {'entry_type': 'dynamic',
         #                                                                                                     'interface': 'FastEthernet0/7'}},
         #                                                                     'mac_address': '0000.5e00.0101'},
         #                                                 '002c.c88b.60b8': {'interfaces': {'GigabitEthernet0/2': {'entry_type': 'dynamic',
         #                                                                                                         'interface': 'GigabitEthernet0/2'}},
-        # mac_addresses = Dq(doc_data).raw('[mac_table][vlans][1][mac_addresses]')
-        mac_addresses = doc_data['mac_table']['vlans']['1']['mac_addresses']
+        mac_addresses = doc['doc_data']['mac_table']['vlans']['1']['mac_addresses']
         for mac_addr, d in mac_addresses.items():
-            # macアドレスの形式をxx:xx:xx形式にする
-            mac_address = mac_addr.replace('.', '')
-            mac_address = ':'.join(mac_address[i:i+2] for i in range(0,12,2))
-            mac_address = mac_address.upper()
-            intf = Dq(d).get_values('interface', 0)
-
-            # c2960cx-8pcのGig0/1はアップリンクなので無視
-            if device_name == 'c2960cx-8pc' and intf == 'GigabitEthernet0/1':
+            # interfacesのキーがインタフェース名
+            intf = next(iter(d.get('interfaces', {})), '')
+            if (device_name, intf) in IGNORE_PORTS:
+                continue
+
+            mac = to_mac(mac_addr)
+            if mac is None:
+                continue
+            yield mac, {'device': device_name, 'intf': intf}
+
+
+# 取り込み元ごとのジェネレータ
+SOURCE_ENTRIES = {
+    SOURCE_DHCP: iter_dhcp_entries,
+    SOURCE_WLC: iter_wlc_entries,
+    SOURCE_CATALYST: iter_catalyst_entries,
+}
+
+
+def build_inventory(sources:list, since:float=None) -> dict:
+    """
+    取り込み元を一つずつ一回だけ回して、MACアドレスをキーにした一覧を作る
+
+    どの値を採用するかは次の規則で決める。
+
+    - 同じ取り込み元の中では新しいものが勝つ。新しい順に回すので、一度見たMACアドレスの古い履歴は読み飛ばす
+    - 取り込み元の間ではsourcesに先に書いたものが勝つ。例えばIPアドレスはDHCPにあればWLCの値は使わない
+
+    ベンダーは全ての取り込み元を回し終えてから、まとめて一回だけ調べる。
+
+    Args:
+        sources (list): 取り込み元のリスト、SOURCE_DHCP, SOURCE_WLC, SOURCE_CATALYST
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+
+    Returns:
+        dict: {MacAddress: {'ip_address': ..., 'vendor': ..., ...}}
+    """
+    inventory = {}
+
+    for source in sources:
+        # この取り込み元で既に見たMACアドレス
+        seen = set()
+        for mac, values in SOURCE_ENTRIES[source](since=since):
+            if mac in seen:
                 continue
+            seen.add(mac)
 
-            # c3560c-12pc-sのGig0/2はダウンリンクなので無視
-            if device_name == 'c3560c-12pc-s' and intf == 'GigabitEthernet0/2':
+            props = inventory.get(mac)
+            if props is None:
+                inventory[mac] = values
                 continue
 
-            # print(f'{mac} {intf}')
-            if known_mac.get(mac_address, None) is None:
-                known_mac[mac_address] = {}
-                # このMACアドレスのベンダーコードを調べる
-                searched = search_mac_vendors(mac_address=mac_address)
-                if searched:
-                    known_mac[mac_address]['vendor'] = searched[0]['vendorName']
-                else:
-                    known_mac[mac_address]['vendor'] = ''
+            # 先の取り込み元で埋まっていない属性だけを足す
+            for key, value in values.items():
+                props.setdefault(key, value)
+
+    # このMACアドレスが何かをまとめて調べる
+    set_vendors(inventory)
+
+    return inventory
+
+
+def set_vendors(inventory: dict):
+    """
+    全てのMACアドレスのベンダーを一度にまとめて調べて'vendor'に入れる
+
+    見つからなかったもののうち、プライベートMACアドレスは(private)、それ以外は空文字列にする
+    """
+    mac_list = list(inventory.keys())
+    vendors = search_mac_vendors_many(mac_list)
+    for mac, vendor_name in zip(mac_list, vendors):
+        if vendor_name is None and mac.is_locally_administered:
+            vendor_name = '(private)'
+        inventory[mac]['vendor'] = vendor_name or ''
+
+
+def tabulate_analyze_dhcp_result(known_mac: dict):
+    tabulate_list = []
+    for mac, props in known_mac.items():
+        ip_address = props.get('ip_address', '')
+        vendor = props.get('vendor', '')
+        tabulate_list.append([str(mac), ip_address, vendor])
+
+    # 2番目の要素 vendor でソートする
+    tabulate_list = sorted(tabulate_list, key=lambda x: x[2], reverse=True)
+
+    return tabulate(tabulate_list, headers=['mac', 'ip', 'vendor'], tablefmt='github')
+
+
+
+def tabulate_analyze_wlc_result(known_mac: dict):
+    tabulate_list = []
+    for mac, props in known_mac.items():
+        ip_address = props.get('ip_address', '')
+        vendor = props.get('vendor', '')
+        device_type = props.get('device_type', '')
+        hostname = props.get('hostname', '')
+        ap_name = props.get('ap_name', '')
+        ssid = props.get('ssid', '')
+
+        tabulate_list.append([str(mac), ip_address, vendor, device_type, hostname, ap_name, ssid])
 
-                # IPアドレスはCatalystのMAC学習テーブルからは分からない
-                known_mac[mac_address]['ip_address'] = ''
-            known_mac[mac_address]['device'] = device_name
-            known_mac[mac_address]['intf'] = intf
+    # 2番目の要素 vendor でソートする
+    tabulate_list = sorted(tabulate_list, key=lambda x: x[2], reverse=True)
 
-    return known_mac
+    return tabulate(tabulate_list, headers=['mac', 'ip', 'vendor', 'type', 'hostname', 'ap', 'ssid'], tablefmt='github')
 
 
 def tabulate_analyze_catalyst_result(known_mac: dict):
@@ -204,52 +246,34 @@ def tabulate_analyze_catalyst_result(known_mac: dict):
         device = props.get('device', '')
         intf = props.get('intf', '')
 
-        tabulate_list.append([mac, ip_address, vendor, device_type, hostname, ap_name, ssid, device, intf])
+        tabulate_list.append([str(mac), ip_address, vendor, device_type, hostname, ap_name, ssid, device, intf])
 
     # 2番目の要素 vendor でソートする
     tabulate_list = sorted(tabulate_list, key=lambda x: x[2], reverse=True)
 
-    return tabulate(tabulate_list, headers=['mac', 'ip', 'vendor', 'type', 'hostname', 'ap', 'ssid', device, intf], tablefmt='github')
+    return tabulate(tabulate_list, headers=['mac', 'ip', 'vendor', 'type', 'hostname', 'ap', 'ssid', 'device', 'intf'], tablefmt='github')
 
 
 
 def search_mac_address_in_pyats(mac_address: str):
 
-    # 形式をCiscoの表記に変える
-    mac_address = mac_address.replace(':', '')
-    mac_address = '.'.join(mac_address[i:i+4] for i in range(0, 12, 4))
-    mac_address = mac_address.lower()
-
     history = []
 
-    docs = get_mac_address_table()
-    for doc in docs:
-        ts = doc['timestamp']
-        doc_data = doc['doc_data']
-        device_name = doc['device_name']
-        # pprint(doc_data)
-        # {'mac_table': {'vlans': {'1': {'mac_addresses': {'0000.5e00.0101': {'interfaces': {'FastEthernet0/7': {'entry_type': 'dynamic',
-        #                                                                                                     'interface': 'FastEthernet0/7'}},
-        #                                                                     'mac_address': '0000.5e00.0101'},
-        #                                                 '002c.c88b.60b8': {'interfaces': {'GigabitEthernet0/2': {'entry_type': 'dynamic',
-        #                                                                                                         'interface': 'GigabitEthernet0/2'}},
-        #                                                                     'mac_address': '002c.c88b.60b8'},
-        mac_addresses = doc_data['mac_table']['vlans']['1']['mac_addresses']
-        if mac_address in mac_addresses.keys():
-            intf = Dq(mac_addresses).get_values('interface', 0)
-
-            # c2960cx-8pcのGig0/1はアップリンクなので無視
-            if device_name == 'c2960cx-8pc' and intf == 'GigabitEthernet0/1':
-                continue
+    # MACアドレスの観測インデックスから探す
+    # [{'timestamp': xxx, 'device_name': 'c3560c-12pc-s', 'interface': 'FastEthernet0/7'}, ...]
+    for d in search_device_mac_address_table(mac_address):
+        ts = d['timestamp']
+        device_name = d['device_name']
+        intf = d['interface']
 
-            # c3560c-12pc-sのGig0/2はダウンリンクなので無視
-            if device_name == 'c3560c-12pc-s' and intf == 'GigabitEthernet0/2':
-                continue
+        # アップリンクとダウンリンクは無視
+        if (device_name, intf) in IGNORE_PORTS:
+            continue
 
-            # タイムスタンプ  → datetime型
-            dt = datetime.fromtimestamp(ts)
-            date = dt.strftime("%Y-%m-%d %H:%M:%S")
-            history.append({'date': date, 'device_name': device_name, 'intf': intf})
+        # タイムスタンプ  → datetime型
+        dt = datetime.fromtimestamp(ts)
+        date = dt.strftime("%Y-%m-%d %H:%M:%S")
+        history.append({'date': date, 'device_name': device_name, 'intf': intf})
 
     return history
 
@@ -266,35 +290,43 @@ if __name__ == '__main__':
     parser.add_argument('-w', '--wlc', action='store_true', help='show mac from wlc')
     parser.add_argument('-c', '--catalyst', action='store_true', help='show mac from catalyst')
     parser.add_argument('-s', '--search', dest='search', help='search mac address in catalyst mac table', type=str)
+    parser.add_argument('--hours', dest='hours', help='analyze only the last N hours', type=float)
 
     args = parser.parse_args()
 
     def main():
 
+        # 直近だけを対象にする
+        since = datetime.now().timestamp() - args.hours * 60 * 60 if args.hours else None
+
         if args.dhcp:
-            known_mac = analyze_dhcp()
+            known_mac = build_inventory([SOURCE_DHCP], since=since)
             t = tabulate_analyze_dhcp_result(known_mac=known_mac)
             print(t)
             print('')
             num_of_mac = len(known_mac.keys())
+            # --hoursで絞り込んだ場合などは一件も無いことがある
+            if num_of_mac == 0:
+                print('- no mac addresses')
+                return 0
             unknown_mac_list = list(filter(lambda value: value['vendor'] == '', known_mac.values()))
             num_of_unknown = len(unknown_mac_list)
             unknown_percent = (num_of_unknown / num_of_mac) * 100
             print(f'- total mac addresses: {num_of_mac}')
             print(f'- unknown vendor: {num_of_unknown} ({unknown_percent:.1f})%')
+            num_of_private = len(list(filter(lambda value: value['vendor'] == '(private)', known_mac.values())))
+            private_percent = (num_of_private / num_of_mac) * 100
+            print(f'- private mac address: {num_of_private} ({private_percent:.1f})%')
             return 0
 
         if args.wlc:
-            known_mac = analyze_dhcp()
-            known_mac = analyze_wlc(known_mac)
+            known_mac = build_inventory([SOURCE_DHCP, SOURCE_WLC], since=since)
             t = tabulate_analyze_wlc_result(known_mac=known_mac)
             print(t)
             return 0
 
         if args.catalyst:
-            known_mac = analyze_dhcp()
-            known_mac = analyze_catalyst(known_mac)
-            known_mac = analyze_wlc(known_mac)
+            known_mac = build_inventory([SOURCE_DHCP, SOURCE_WLC, SOURCE_CATALYST], since=since)
             t = tabulate_analyze_catalyst_result(known_mac=known_mac)
             print(t)
             return 0
@@ -311,4 +343,9 @@ if __name__ == '__main__':
         return 0
 
 
-    sys.exit(main())
\ No newline at end of file
+    # db.jsonの読み込みは最初の一回だけにする
+    # 読むだけなのでロックを取り続けず、コレクタの書き込みを待たせない
+    with DbSession(readonly=True):
+        ret = main()
+
+    sys.exit(ret)
\ No newline at end of file
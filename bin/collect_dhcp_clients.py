@@ -25,7 +25,7 @@ if lib_dir not in sys.path:
     sys.path.append(lib_dir)
 
 # lib/db_util/db_util.py
-from db_util import insert_dhcp_clients
+from db_util import ingest_dhcp_clients
 
 # lib/pyats_util/pyats_util.py
 from pyats_util import get_testbed_from_file, get_inventory
@@ -44,7 +44,7 @@ def update_db_func(ip: str, username: str, password: str) -> callable:
     def _update_db():
         timestamp = datetime.now().timestamp()
         dhcp_clients = get_dhcp_clients(ip, username, password)
-        insert_dhcp_clients(dhcp_clients_list=dhcp_clients, timestamp=timestamp)
+        ingest_dhcp_clients(dhcp_clients, timestamp)
 
     return _update_db
 
@@ -58,7 +58,7 @@ def update_db(ip: str, username: str, password: str) -> list:
     dhcp_clients = get_dhcp_clients(ip, username, password)
 
     # データベースに格納
-    insert_dhcp_clients(dhcp_clients_list=dhcp_clients, timestamp=timestamp)
+    ingest_dhcp_clients(dhcp_clients, timestamp)
 
     return dhcp_clients
 
@@ -23,7 +23,7 @@ if lib_dir not in sys.path:
     sys.path.append(lib_dir)
 
 # lib/db_util/db_util.py
-from db_util import insert_device_mac_address_table
+from db_util import ingest_mac_address_tables, normalize_mac
 
 # lib/pyats_util/pyats_util.py
 from pyats_util import get_testbed_devices, parse_command
@@ -40,8 +40,8 @@ def update_db_func(testbed_file:str) -> callable:
     def _update_db():
         timestamp = datetime.now().timestamp()
         parsed = parse_mac_address_table(testbed_file)
-        for name, parsed_data in parsed.items():
-            insert_device_mac_address_table(name, parsed_data, timestamp)
+        # 全装置分をまとめて一回で書き込む
+        ingest_mac_address_tables(parsed, timestamp)
 
     return _update_db
 
@@ -54,9 +54,8 @@ def update_db(testbed_file:str) -> dict:
     # 全てのCatalystを対象にpyATSでparse()する
     parsed = parse_mac_address_table(testbed_file)
 
-    for name, parsed_data in parsed.items():
-        # 装置ごとにデータベースに保存
-        insert_device_mac_address_table(name, parsed_data, timestamp)
+    # 全装置分をまとめて一回で書き込む
+    ingest_mac_address_tables(parsed, timestamp)
 
     return parsed
 
@@ -84,9 +83,7 @@ def get_mac_addresses(parse_result:dict):
             intf = mac_table.q.contains_key_value('mac_addresses', mac_addr).get_values('interface', 0)
             vlan = mac_table.q.contains_key_value('mac_addresses', mac_addr).get_values('vlans', 0)
             # macアドレスの形式をxx:xx:xx形式にする
-            mac = mac_addr.replace('.', '')
-            mac = ':'.join(mac[i:i+2] for i in range(0,12,2))
-            mac = mac.upper()
+            mac = normalize_mac(mac_addr)
             result = {
                 'mac_address': mac,
                 'device': device,
@@ -11,6 +11,7 @@ import logging
 import os
 import sys
 
+from datetime import datetime
 from pprint import pprint
 
 #
@@ -23,10 +24,11 @@ if lib_dir not in sys.path:
     sys.path.append(lib_dir)
 
 # lib/db_util
-from db_util import insert_mac_vendors, get_mac_vendors_all, get_mac_vendors_timestamp, search_mac_vendors, search_list_of_dict
+from db_util import update_mac_vendors, get_mac_vendors_all, get_mac_vendors_timestamp, get_mac_vendors_validators, search_mac_vendors, search_list_of_dict
+from db_util import write_mac_vendors_file, get_mac_vendors_file_timestamp
 
 # lib/mac_vendors_util
-from mac_vendors_util import get_mac_vendors_list, get_last_modified
+from mac_vendors_util import JSON_DIR, parse_last_modified, download_mac_vendors, iter_mac_vendors
 
 logger = logging.getLogger(__name__)
 
@@ -35,40 +37,44 @@ def update_db():
 
     requests_options = {'timeout': 10}
 
-    # headメソッドを使って 'Last-Modified' の情報を取得する
-    timestamp = get_last_modified(requests_options=requests_options)
-    logger.info(f'current timestamp is {timestamp}')
-
-    do_download = False
-
-    # データベースに格納されているタイムスタンプを取得
+    # データベースに格納されているタイムスタンプと、前回ダウンロードしたときのETag, Last-Modifiedを取得
     stored_timestamp = get_mac_vendors_timestamp()
+    validators = get_mac_vendors_validators()
     if stored_timestamp is None:
         logger.info('no data in database, try to download.')
-        do_download = True
+        validators = {'etag': None, 'last_modified': None}
     else:
         logger.info(f'stored timestamp is {stored_timestamp}')
-        if timestamp > stored_timestamp:
-            logger.info(f'new data found, try to download.')
-            do_download = True
-        else:
-            logger.info(f'download skipped, stored data is the newest.')
 
-    if do_download:
-        # ダウンロードして
-        mac_vendors_list = get_mac_vendors_list(requests_options=requests_options)
+    # 条件付きのGETで更新されていれば取得する、前回途中で切れていたら続きから
+    os.makedirs(JSON_DIR, exist_ok=True)
+    path = os.path.join(JSON_DIR, 'mac-vendors-export.json')
+    headers = download_mac_vendors(path, requests_options=requests_options, resume=True, **validators)
 
-        # macPrefixキーの値でソートしてから
-        mac_vendors_list = sorted(mac_vendors_list, key=lambda x: x.get('macPrefix', ''))
+    if headers is None:
+        logger.info(f'download skipped, stored data is the newest.')
+    else:
+        timestamp = parse_last_modified(headers) or datetime.now().timestamp()
+        logger.info(f'current timestamp is {timestamp}')
+
+        if stored_timestamp is not None and timestamp <= stored_timestamp and headers.get('ETag') == validators['etag']:
+            # 条件付きGETに応じないサーバだった場合
+            logger.info(f'downloaded data is not newer than stored data.')
+        else:
+            # ファイルから一つずつ読みながら、変わったベンダーコードだけをデータベースに反映する、検索用のバイナリファイルも一緒に作られる
+            update_mac_vendors(iter_mac_vendors(path), timestamp, etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'))
+            return
 
-        # データベースに格納する
-        insert_mac_vendors(mac_vendors_list=mac_vendors_list, timestamp=timestamp)
+    # データベースは最新だがバイナリファイルが無い、もしくはデータベースと食い違う場合は、ダウンロードせずにデータベースから作る
+    file_timestamp = get_mac_vendors_file_timestamp()
+    if stored_timestamp is not None and file_timestamp != stored_timestamp:
+        logger.info('mac vendors file is missing or does not match the database, rebuild it.')
+        write_mac_vendors_file(get_mac_vendors_all(), stored_timestamp)
 
 
 def search_mac_address(mac_address: str):
-    # データベースから全件を取得する
-    # これは'macPrefix'でソートされているはず
-    mac_vendors_list = get_mac_vendors_all()
+    # データベースから全件を取得して'macPrefix'でソートする
+    mac_vendors_list = sorted(get_mac_vendors_all(), key=lambda x: x.get('macPrefix', ''))
 
     if len(mac_address) < 8:
         return None
@@ -25,7 +25,7 @@ if lib_dir not in sys.path:
     sys.path.append(lib_dir)
 
 # lib/db_util/db_util.py
-from db_util import insert_wlc_clients
+from db_util import ingest_wlc_clients
 
 # lib/pyats_util/pyats_util.py
 from pyats_util import get_testbed_from_file, get_inventory
@@ -46,7 +46,7 @@ def update_db_func(ip: str, username: str, password: str) -> callable:
         timestamp = datetime.now().timestamp()
         with wlc:
             wlc_clients = wlc.get_wlc_clients()
-        insert_wlc_clients(wlc_clients_list=wlc_clients, timestamp=timestamp)
+        ingest_wlc_clients(wlc_clients, timestamp)
 
     return _update_db
 
@@ -61,7 +61,7 @@ def update_db(ip: str, username: str, password: str) -> list:
         wlc_clients = wlc.get_wlc_clients()
 
     # データベースに格納
-    insert_wlc_clients(wlc_clients_list=wlc_clients, timestamp=timestamp)
+    ingest_wlc_clients(wlc_clients, timestamp)
 
     return wlc_clients
 
@@ -36,7 +36,7 @@ from line_util import send_line_notify
 from daemon_util import SingleDaemon
 
 # lib/db_util/dictfilter.py
-from db_util import find_values
+from db_util import find_values, to_mac
 
 #
 # logディレクトリ
@@ -79,24 +79,33 @@ def load_yaml(file_path: str) -> dict:
     return None
 
 
-def get_known_mac_addresses(known_device_file: str = KNOWN_DEVICES_PATH) -> list:
+def get_known_mac_addresses(known_device_file: str = KNOWN_DEVICES_PATH) -> set:
     """
-    KNOWN_DEVICES_PATHに指定されたパスのYAMLファイルをロードして、'mac'キーの値をリストにして返却する
+    KNOWN_DEVICES_PATHに指定されたパスのYAMLファイルをロードして、'mac'キーの値をMacAddressの集合にして返却する
+
+    known_devices.yamlは大文字小文字や区切り文字が混在しているので、MacAddressにそろえて比較する
 
     Args:
         known_device_file (str, optional): YAMLファイルのパス. Defaults to KNOWN_DEVICES_PATH.
 
     Returns:
-        list: 全ての'mac'キーの値をリストにして返却
+        set: 全ての'mac'キーの値をMacAddressにした集合
     """
     # known_devices.yamlをロードする
     known_devices = load_yaml(known_device_file)
     if known_devices is None:
         logger.error(f'known device not found in : {KNOWN_DEVICES_PATH}')
-        return []
+        return set()
 
     # 辞書型の中にある'mac'キーの値を全て取り出して返却する
-    return list(find_values(known_devices, 'mac'))
+    known_mac = set()
+    for mac in find_values(known_devices, 'mac'):
+        mac_address = to_mac(mac)
+        if mac_address is None:
+            logger.error(f'invalid mac address in known devices: {mac}')
+            continue
+        known_mac.add(mac_address)
+    return known_mac
 
 
 def detect_unknown_wlc_clients(wlc_clients: list) -> list:
@@ -119,10 +128,9 @@ def detect_unknown_wlc_clients(wlc_clients: list) -> list:
 
     unknown_mac = []
     for client in wlc_clients:
-        mac = client.get('mac_address', None)
+        mac = to_mac(client.get('mac_address', None))
         if mac is None:
             continue
-        mac = mac.upper()
         if mac not in known_mac:
             unknown_mac.append(client)
     return unknown_mac
@@ -141,7 +149,7 @@ def run_func() -> callable:
     wlc = CiscoWlcHandler(wlc_ip, wlc_username, wlc_password)
 
     # 一度通知したものはここに格納して、次からは発報しない
-    reported_mac = []
+    reported_mac = set()
 
     # この関数を返却する
     def _run():
@@ -168,11 +176,12 @@ def run_func() -> callable:
                 # 'netmask': '255.255.255.0',
                 # 'username': 'N/A',
                 # 'wireless_lan_network_name': 'taka 11ac'},
-                mac = d.get('mac_address')
-                mac = mac.upper()
+                mac = to_mac(d.get('mac_address'))
+                if mac is None:
+                    continue
                 if mac not in reported_mac:
                     logger.info(f'unknown mac detedted: {mac}')
-                    reported_mac.append(mac)
+                    reported_mac.add(mac)
                     message = f'unknown device found.\n{pformat(d)}'
                     logger.error(message)
                     send_line_notify(message)
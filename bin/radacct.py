@@ -38,6 +38,9 @@ if lib_dir not in sys.path:
 # lib/daemon_util/daemon_util.py
 from daemon_util import SingleDaemon
 
+# lib/db_util/mac_address.py
+from db_util import to_mac
+
 #
 # logディレクトリ
 #
@@ -209,29 +212,34 @@ def load_yaml(file_path: str) -> dict:
     return None
 
 
-def get_known_mac_addresses(known_device_file: str = KNOWN_DEVICES_PATH) -> list:
+def get_known_mac_addresses(known_device_file: str = KNOWN_DEVICES_PATH) -> set:
     """
-    KNOWN_DEVICES_PATHに指定されたパスのYAMLファイルをロードして、'mac'キーの値をリストにして返却する
+    KNOWN_DEVICES_PATHに指定されたパスのYAMLファイルをロードして、'mac'キーの値をMacAddressの集合にして返却する
+
+    User-Nameはハイフン区切りなので、文字列のままではなくMacAddressにそろえて比較する
 
     Args:
         known_device_file (str, optional): YAMLファイルのパス. Defaults to KNOWN_DEVICES_PATH.
 
     Returns:
-        list: 全ての'mac'キーの値をリストにして返却
+        set: 全ての'mac'キーの値をMacAddressにした集合
     """
     # known_devices.yamlをロードする
     known_devices = load_yaml(known_device_file)
     if known_devices is None:
         logger.error(f'known device not found in : {KNOWN_DEVICES_PATH}')
-        return []
-
-    # 辞書型の中にある'mac'キーの値を全て取り出して返却する
-    known_mac_list = list(find_values(known_devices, 'mac'))
-
-    # 大文字に変換
-    known_mac_list = [string.upper() for string in known_mac_list]
+        return set()
+
+    # 辞書型の中にある'mac'キーの値を全て取り出してMacAddressにする
+    known_mac = set()
+    for mac in find_values(known_devices, 'mac'):
+        mac_address = to_mac(mac)
+        if mac_address is None:
+            logger.error(f'invalid mac address in known devices: {mac}')
+            continue
+        known_mac.add(mac_address)
 
-    return known_mac_list
+    return known_mac
 
 
 def parse_timestamp(candidate: str) -> datetime:
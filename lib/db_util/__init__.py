@@ -1,5 +1,19 @@
+from .backend import BACKEND_TINYDB, BACKEND_SQLITE, set_backend, migrate
+from .db_session import DbSession
+from .storages import FORMAT_JSON, FORMAT_ORJSON, FORMAT_MSGPACK, set_format, clear_read_cache
+from .retention import RETENTION_MODE_INLINE, RETENTION_MODE_SCHEDULED, set_retention_mode, run_retention
+from .snapshot_history import SNAPSHOT_MODE_FULL, SNAPSHOT_MODE_DELTA, set_snapshot_mode, convert_snapshots
+from .archive import set_archive_days
+from .snapshot_table import SnapshotTable
 from .dhcp_clients_table import *
+from .mac_address import MacAddress, parse_mac, to_mac
+from .mac_observations_table import *
 from .mac_vendors_table import *
+from .mac_vendors_file import is_locally_administered, get_mac_vendors_file_path, write_mac_vendors_file, get_mac_vendors_file_timestamp, search_mac_vendors_file, search_mac_vendors_file_many
 from .pyats_table import *
 from .wlc_clients_table import *
-from .dictfilter import *
\ No newline at end of file
+from .dictfilter import *
+from .events import EVENT_JOIN, EVENT_LEAVE, EVENT_MOVE, subscribe, unsubscribe, read_events, get_event_log_end, set_event_log_days, rotate_event_log
+from .ingest_log import INGEST_MODE_DIRECT, INGEST_MODE_LOG, set_ingest_mode, compact_ingest_log
+from .ingest_log import ingest_dhcp_clients, ingest_wlc_clients, ingest_mac_address_tables
+from .stats import get_table_stats, benchmark
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+#
+# 古いスナップショットのアーカイブ
+#
+# DHCP_CLIENTSやWLC_CLIENTSの履歴を長く残すとデータベースのファイルが大きくなり、
+# 挿入のたびに読み書きする量が増える。
+# そこで一定期間を過ぎたスナップショットはデータベースから取り除き、
+# 月ごとのgzip圧縮したJSONLのファイルに追記して保存する。
+#
+# archive/DHCP_CLIENTS/2023-01.jsonl.gz
+# {"timestamp": xxx, "doc_data": [...]}
+# {"timestamp": xxx, "doc_data": [...]}
+#
+# 追記するたびにgzipのメンバーを一つ足すので、既存の部分を書き換えることはない。
+#
+# 環境変数 DB_UTIL_ARCHIVE_DAYS に日数を指定すると、保存期間を過ぎて削除されるスナップショットは
+# 削除する前にアーカイブに移される。指定しなければこれまで通り削除するだけ。
+#
+# iter_dhcp_clients_documents()などのジェネレータは、指定した範囲がデータベースより古い時刻に及ぶ場合、
+# 続けてアーカイブから読み込む。
+#
+
+import gzip
+import json
+import logging
+import os
+import zlib
+
+from datetime import datetime
+
+try:
+    from .backend import DB_DIR
+    from .db_session import open_db
+    from .snapshot_history import iter_snapshot_documents, get_snapshot_by_timestamp
+except ImportError:
+    from backend import DB_DIR
+    from db_session import open_db
+    from snapshot_history import iter_snapshot_documents, get_snapshot_by_timestamp
+
+# アーカイブを置くディレクトリ
+ARCHIVE_DIR = os.path.join(DB_DIR, 'archive')
+
+# データベースに残す日数、これを過ぎたものはアーカイブに移す
+ARCHIVE_DAYS = float(os.environ.get('DB_UTIL_ARCHIVE_DAYS', '0'))
+
+logger = logging.getLogger(__name__)
+
+
+def get_archive_age() -> float:
+    """
+    アーカイブに移すまでの秒数を返却する、アーカイブしない場合はNone
+    """
+    if ARCHIVE_DAYS > 0:
+        return ARCHIVE_DAYS * 24 * 60 * 60
+    return None
+
+
+def set_archive_days(days:float):
+    global ARCHIVE_DAYS
+    ARCHIVE_DAYS = days
+
+
+def is_archive_enabled() -> bool:
+    return get_archive_age() is not None
+
+
+def _segment_name(timestamp:float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m')
+
+
+def _segment_path(table_name:str, segment:str, archive_dir:str=None) -> str:
+    return os.path.join(archive_dir or ARCHIVE_DIR, table_name, f'{segment}.jsonl.gz')
+
+
+def get_archive_segments(table_name:str, archive_dir:str=None) -> list:
+    """
+    アーカイブのセグメント（YYYY-MM）の一覧を昇順で返却する
+    """
+    table_dir = os.path.join(archive_dir or ARCHIVE_DIR, table_name)
+    if not os.path.isdir(table_dir):
+        return []
+    return sorted(name[:-len('.jsonl.gz')] for name in os.listdir(table_dir) if name.endswith('.jsonl.gz'))
+
+
+def append_archive(table_name:str, docs:list, archive_dir:str=None):
+    """
+    スナップショットをアーカイブに追記する
+
+    Args:
+        table_name (str): テーブル名
+        docs (list): [{'timestamp': xxx, 'doc_data': [...]}, ...]
+        archive_dir (str, optional): アーカイブのディレクトリ. Defaults to ARCHIVE_DIR.
+    """
+    by_segment = {}
+    for doc in docs:
+        by_segment.setdefault(_segment_name(doc['timestamp']), []).append(doc)
+
+    for segment, segment_docs in by_segment.items():
+        path = _segment_path(table_name, segment, archive_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = ''.join(json.dumps({'timestamp': d['timestamp'], 'doc_data': d['doc_data']}) + '\n' for d in segment_docs)
+
+        # gzipのメンバーとして追記する
+        with open(path, 'ab') as f:
+            f.write(gzip.compress(data.encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+
+        logger.info(f'{table_name}: {len(segment_docs)} snapshots archived to {path}')
+
+
+def read_segment(table_name:str, segment:str, archive_dir:str=None) -> list:
+    """
+    セグメントのスナップショットを読み込む、壊れている部分は捨てる
+
+    Returns:
+        list: スナップショットのリスト、タイムスタンプの昇順で重複なし
+    """
+    docs = {}
+    path = _segment_path(table_name, segment, archive_dir)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # gzipのメンバーを一つずつ展開する
+    while data:
+        d = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        try:
+            chunk = d.decompress(data)
+        except zlib.error as e:
+            logger.warning(f'{path}: {e}')
+            break
+        if not d.eof:
+            # 追記している途中で落ちた最後のメンバー
+            logger.warning(f'{path}: incomplete member skipped')
+            break
+        data = d.unused_data
+
+        for line in chunk.decode('utf-8').splitlines():
+            try:
+                doc = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f'{path}: broken record skipped')
+                continue
+            # 移している途中で落ちて二重に追記されたものは一つにする
+            docs.setdefault(doc['timestamp'], doc)
+
+    return [docs[ts] for ts in sorted(docs.keys())]
+
+
+def iter_archived_documents(table_name:str, since:float=None, until:float=None, archive_dir:str=None):
+    """
+    アーカイブのスナップショットを新しい順に返すジェネレータ
+
+    範囲に重なるセグメントだけを読み込む
+
+    Args:
+        table_name (str): テーブル名
+        since (float, optional): これ以降、この値を含む. Defaults to None.
+        until (float, optional): これ以前、この値を含む. Defaults to None.
+        archive_dir (str, optional): アーカイブのディレクトリ. Defaults to ARCHIVE_DIR.
+
+    Yields:
+        dict: {'timestamp': xxx, 'doc_data': [...]}
+    """
+    first = _segment_name(since) if since is not None else None
+    last = _segment_name(until) if until is not None else None
+
+    for segment in reversed(get_archive_segments(table_name, archive_dir)):
+        if last is not None and segment > last:
+            continue
+        if first is not None and segment < first:
+            return
+
+        for doc in reversed(read_segment(table_name, segment, archive_dir)):
+            if until is not None and doc['timestamp'] > until:
+                continue
+            if since is not None and doc['timestamp'] < since:
+                return
+            yield doc
+
+
+def iter_snapshot_documents_with_archive(table_name:str, since:float=None, until:float=None, limit:int=None):
+    """
+    データベースのスナップショットを新しい順に返し、範囲がさらに古い時刻に及ぶ場合はアーカイブから続けて返す
+
+    Args:
+        table_name (str): テーブル名
+        since (float, optional): これ以降、この値を含む. Defaults to None.
+        until (float, optional): これ以前、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
+
+    Yields:
+        dict: {'timestamp': xxx, 'doc_data': [...]}
+    """
+    count = 0
+    for doc in iter_snapshot_documents(table_name, since=since, until=until, limit=limit):
+        yield doc
+        count += 1
+
+    if limit is not None and count >= limit:
+        return
+
+    # データベースに残っている一番古いタイムスタンプより前をアーカイブから探す
+    with open_db() as db:
+        starts = db.timestamps(table_name)
+    oldest = min(starts) if starts else None
+
+    if oldest is not None and since is not None and since >= oldest:
+        return
+
+    archive_until = until
+    if oldest is not None:
+        archive_until = oldest if until is None else min(until, oldest)
+
+    for doc in iter_archived_documents(table_name, since=since, until=archive_until):
+        if oldest is not None and doc['timestamp'] >= oldest:
+            continue
+        yield doc
+        count += 1
+        if limit is not None and count >= limit:
+            return
+
+
+def get_snapshot_by_timestamp_with_archive(table_name:str, timestamp:float):
+    """
+    タイムスタンプを指定してスナップショットを返却する、データベースになければアーカイブから探す
+    """
+    doc = get_snapshot_by_timestamp(table_name, timestamp)
+    if doc is not None:
+        return doc
+
+    for doc in iter_archived_documents(table_name, since=timestamp, until=timestamp):
+        return doc
+
+    return None
+
+
+def prune_archive(table_name:str, max_age:float, now:float, archive_dir:str=None) -> list:
+    """
+    全体がmax_ageより古いセグメントを削除する
+
+    Returns:
+        list: 削除したセグメントのリスト
+    """
+    oldest = _segment_name(now - max_age)
+    deleted = []
+    for segment in get_archive_segments(table_name, archive_dir):
+        if segment < oldest:
+            os.remove(_segment_path(table_name, segment, archive_dir))
+            deleted.append(segment)
+    return deleted
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_archive():
+        try:
+            from db_session import DbSession
+            from snapshot_history import insert_snapshot
+        except ImportError:
+            from .db_session import DbSession
+            from .snapshot_history import insert_snapshot
+
+        table_name = 'TEST_SNAPSHOTS'
+        jan = datetime(2023, 1, 31, 23).timestamp()
+        hour = 60 * 60
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_dir = os.path.join(tmp_dir, 'archive')
+
+            docs = [{'timestamp': jan + i * hour, 'doc_data': [{'ip': str(i)}]} for i in range(4)]
+            append_archive(table_name, docs[:2], archive_dir=archive_dir)
+            append_archive(table_name, docs[1:3], archive_dir=archive_dir)
+            assert ['2023-01', '2023-02'] == get_archive_segments(table_name, archive_dir=archive_dir)
+
+            # 二重に追記されたものは一つになる
+            archived = list(iter_archived_documents(table_name, archive_dir=archive_dir))
+            assert [docs[2], docs[1], docs[0]] == archived
+
+            archived = list(iter_archived_documents(table_name, since=docs[1]['timestamp'], until=docs[1]['timestamp'], archive_dir=archive_dir))
+            assert [docs[1]] == archived
+
+            # 追記の途中で落ちた場合
+            with open(_segment_path(table_name, '2023-02', archive_dir), 'ab') as f:
+                f.write(gzip.compress(b'{"timestamp": 1.0}\n')[:10])
+            assert [docs[1], docs[2]] == read_segment(table_name, '2023-02', archive_dir=archive_dir)
+
+            assert ['2023-01'] == prune_archive(table_name, hour, now=docs[3]['timestamp'], archive_dir=archive_dir)
+
+            # データベースとアーカイブを続けて読む
+            global ARCHIVE_DIR
+            ARCHIVE_DIR = archive_dir
+            with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                insert_snapshot(table_name, docs[3]['timestamp'], docs[3]['doc_data'])
+                assert [docs[3], docs[2], docs[1]] == list(iter_snapshot_documents_with_archive(table_name))
+                assert [docs[3], docs[2]] == list(iter_snapshot_documents_with_archive(table_name, limit=2))
+                assert [docs[3]] == list(iter_snapshot_documents_with_archive(table_name, since=docs[3]['timestamp']))
+                assert docs[2] == get_snapshot_by_timestamp_with_archive(table_name, docs[2]['timestamp'])
+
+        logger.info('test archive pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-l', '--list', dest='list', metavar='TABLE', help='list archive segments')
+    parser.add_argument('-p', '--prune-days', dest='prune_days', type=float, metavar='DAYS', help='delete segments older than DAYS')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_archive()
+            return 0
+
+        if args.list:
+            for segment in get_archive_segments(args.list):
+                docs = read_segment(args.list, segment)
+                print(f'{segment}: {len(docs)} snapshots')
+            return 0
+
+        if args.prune_days:
+            now = datetime.now().timestamp()
+            for table_name in ('DHCP_CLIENTS', 'WLC_CLIENTS'):
+                for segment in prune_archive(table_name, args.prune_days * 24 * 60 * 60, now):
+                    print(f'{table_name}: {segment} deleted')
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
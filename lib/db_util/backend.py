@@ -0,0 +1,828 @@
+#!/usr/bin/env python
+
+#
+# データベースのバックエンド
+#
+# db_utilの各テーブルはこのモジュールのバックエンドを経由してドキュメントを読み書きする。
+#
+# - TinyDBBackend  これまで通りTinyDBのJSONファイル(db.json)に格納する
+# - SQLiteBackend  SQLiteのファイル(db.sqlite3)に格納する
+# - ShardedBackend テーブルごとに別のJSONファイル(db.d/テーブル名.json)に格納する
+#                  履歴を持つテーブルはさらに月ごとのファイル(db.d/テーブル名/YYYY-MM.json)に分ける
+#
+# どれを使うかは環境変数 DB_UTIL_BACKEND で指定する（tinydb, sqlite, sharded のいずれか）。
+# TinyDBBackendとShardedBackendのファイルの形式は環境変数 DB_UTIL_FORMAT で指定する（storages.py参照）。
+# コレクタは別プロセスで動くので.envrcに書いておくとよい。
+#
+# export DB_UTIL_BACKEND=sqlite
+#
+# 検索条件はdictで指定する。値の種類によって意味が変わる。
+#
+# {'device_name': 'c2960cx-8pc'}           一致
+# {'timestamp': [1.0, 2.0]}                 いずれかに一致
+# {'timestamp': EXISTS}                     キーが存在する
+# {'timestamp': Range(since=1.0)}           範囲に含まれる（両端を含む、Noneは制限なし）
+#
+# SQLiteBackendはtimestamp, device_name, doc_type, mac, macPrefixを列として持ち、インデックスを張る。
+# それ以外のキーを使った検索は取り出したあとにPythonで絞り込む。
+#
+# ShardedBackendはtimestampの条件から該当する月のファイルだけを開く。
+# 1時間ごとのコレクタが書き込むのは今月のファイルだけになり、MAC_VENDORSのような大きなテーブルは読み込まない。
+#
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+
+from contextlib import contextmanager
+from datetime import datetime
+
+#
+# tinydb
+#
+from tinydb import Query, TinyDB
+
+try:
+    from .storages import FORMAT_EXTENSIONS, SharedCachingMiddleware, get_format, get_storage_class
+except ImportError:
+    from storages import FORMAT_EXTENSIONS, SharedCachingMiddleware, get_format, get_storage_class
+
+# バックエンドの種類
+BACKEND_TINYDB = 'tinydb'
+BACKEND_SQLITE = 'sqlite'
+BACKEND_SHARDED = 'sharded'
+
+# 使用するバックエンド
+DB_BACKEND = os.environ.get('DB_UTIL_BACKEND', BACKEND_TINYDB)
+
+# データベースのファイル
+DB_DIR = os.path.dirname(__file__)
+DB_PATH = os.path.join(DB_DIR, 'db.json')
+SQLITE_DB_PATH = os.path.join(DB_DIR, 'db.sqlite3')
+SHARDED_DB_PATH = os.path.join(DB_DIR, 'db.d')
+
+# ShardedBackendで月ごとのファイルに分けるテーブル
+PARTITIONED_TABLES = {'DHCP_CLIENTS', 'WLC_CLIENTS', 'PYATS'}
+
+# キーが存在することを表す検索条件
+EXISTS = object()
+
+logger = logging.getLogger(__name__)
+
+
+class Range:
+    """
+    値が範囲に含まれることを表す検索条件
+
+    Args:
+        since (float, optional): 下限、この値を含む. Defaults to None.
+        until (float, optional): 上限、この値を含む. Defaults to None.
+    """
+
+    def __init__(self, since:float=None, until:float=None) -> None:
+        self.since = since
+        self.until = until
+
+
+    def __contains__(self, value) -> bool:
+        if not isinstance(value, (int, float)):
+            return False
+        if self.since is not None and value < self.since:
+            return False
+        if self.until is not None and value > self.until:
+            return False
+        return True
+
+
+    def __repr__(self) -> str:
+        return f'Range(since={self.since}, until={self.until})'
+
+
+def get_backend_name() -> str:
+    return DB_BACKEND
+
+
+def set_backend(backend:str):
+    """
+    使用するバックエンドを切り替える
+
+    Args:
+        backend (str): BACKEND_TINYDB, BACKEND_SQLITE, BACKEND_SHARDED のいずれか
+    """
+    global DB_BACKEND
+
+    if backend not in (BACKEND_TINYDB, BACKEND_SQLITE, BACKEND_SHARDED):
+        raise ValueError(f'unknown backend: {backend}')
+
+    DB_BACKEND = backend
+
+
+def get_default_db_path(backend:str=None) -> str:
+    backend = backend or DB_BACKEND
+    if backend == BACKEND_SQLITE:
+        return SQLITE_DB_PATH
+    if backend == BACKEND_SHARDED:
+        return SHARDED_DB_PATH
+    return os.path.join(DB_DIR, 'db' + FORMAT_EXTENSIONS[get_format()])
+
+
+def get_lock_path(backend:str=None, db_path:str=None) -> str:
+    """
+    読み込んでから書き戻すまでの間に排他ロックを取るファイルのパスを返却する
+
+    SQLiteは自分でロックを取るのでNoneを返却する
+
+    Args:
+        backend (str, optional): バックエンドの種類. Defaults to DB_BACKEND.
+        db_path (str, optional): ファイルのパス. Defaults to バックエンドごとの既定のパス.
+
+    Returns:
+        str: ロックファイルのパス
+    """
+    backend = backend or DB_BACKEND
+    db_path = db_path or get_default_db_path(backend)
+
+    if backend == BACKEND_SQLITE:
+        return None
+
+    if backend == BACKEND_SHARDED:
+        return os.path.join(db_path, '.lock')
+
+    return db_path + '.lock'
+
+
+def create_backend(backend:str=None, db_path:str=None, caching:bool=False, lock_path:str=None):
+    """
+    バックエンドのオブジェクトを作成する
+
+    Args:
+        backend (str, optional): バックエンドの種類. Defaults to DB_BACKEND.
+        db_path (str, optional): ファイルのパス. Defaults to バックエンドごとの既定のパス.
+        caching (bool, optional): 読み込みをキャッシュして書き込みをまとめるか. Defaults to False.
+        lock_path (str, optional): ファイルを読む間だけ共有ロックを取るロックファイル、SQLiteでは使わない. Defaults to None.
+
+    Returns:
+        TinyDBBackend, SQLiteBackend or ShardedBackend: バックエンド
+    """
+    backend = backend or DB_BACKEND
+    db_path = db_path or get_default_db_path(backend)
+
+    if backend == BACKEND_TINYDB:
+        return TinyDBBackend(db_path=db_path, caching=caching, lock_path=lock_path)
+
+    if backend == BACKEND_SQLITE:
+        return SQLiteBackend(db_path=db_path, caching=caching)
+
+    if backend == BACKEND_SHARDED:
+        return ShardedBackend(db_path=db_path, caching=caching, lock_path=lock_path)
+
+    raise ValueError(f'unknown backend: {backend}')
+
+
+def match_cond(doc:dict, cond:dict) -> bool:
+    """
+    ドキュメントが検索条件に一致するか
+
+    Args:
+        doc (dict): ドキュメント
+        cond (dict): 検索条件
+
+    Returns:
+        bool: 一致すればTrue
+    """
+    if not cond:
+        return True
+
+    for k, v in cond.items():
+        if v is EXISTS:
+            if k not in doc:
+                return False
+        elif isinstance(v, Range):
+            if k not in doc or doc[k] not in v:
+                return False
+        elif isinstance(v, (list, tuple, set, frozenset)):
+            if k not in doc or doc[k] not in v:
+                return False
+        else:
+            if k not in doc or doc[k] != v:
+                return False
+
+    return True
+
+
+class TinyDBBackend:
+
+    def __init__(self, db_path:str=DB_PATH, caching:bool=False, storage_format:str=None, lock_path:str=None) -> None:
+        self.db_path = db_path
+        self.caching = caching
+
+        storage = get_storage_class(storage_format)
+
+        # パースした結果はプロセス内で共有し、ファイルが書き換えられていなければ使い回す
+        # キャッシュする場合は書き込みをまとめて行い、そうでなければその都度書き出す
+        self.db = TinyDB(db_path, storage=SharedCachingMiddleware(storage, write_through=not caching, lock_path=lock_path))
+
+
+    @staticmethod
+    def _query(cond:dict):
+        q = Query()
+        query = None
+        for k, v in cond.items():
+            if v is EXISTS:
+                c = q[k].exists()
+            elif isinstance(v, Range):
+                c = q[k].test(lambda value, r=v: value in r)
+            elif isinstance(v, (list, tuple, set, frozenset)):
+                c = q[k].one_of(list(v))
+            else:
+                c = q[k] == v
+            query = c if query is None else (query & c)
+        return query
+
+
+    def insert(self, table_name:str, doc:dict):
+        self.db.table(table_name).insert(doc)
+
+
+    def insert_multiple(self, table_name:str, docs:list):
+        self.db.table(table_name).insert_multiple(docs)
+
+
+    def all(self, table_name:str) -> list:
+        return self.db.table(table_name).all()
+
+
+    def search(self, table_name:str, cond:dict=None) -> list:
+        if not cond:
+            return self.all(table_name)
+        return self.db.table(table_name).search(self._query(cond))
+
+
+    def get(self, table_name:str, cond:dict):
+        return self.db.table(table_name).get(self._query(cond))
+
+
+    def timestamps(self, table_name:str, cond:dict=None) -> list:
+        return [doc['timestamp'] for doc in self.search(table_name, cond) if 'timestamp' in doc]
+
+
+    def remove(self, table_name:str, cond:dict):
+        self.db.table(table_name).remove(self._query(cond))
+
+
+    def drop_table(self, table_name:str):
+        self.db.drop_table(table_name)
+
+
+    def tables(self) -> set:
+        return self.db.tables()
+
+
+    def flush(self):
+        if self.caching:
+            self.db.storage.flush()
+
+
+    def close(self, discard:bool=False):
+        """
+        Args:
+            discard (bool, optional): 溜まっている書き込みを書き出さずに捨てるかどうか. Defaults to False.
+        """
+        if discard:
+            self.db.storage.discard()
+
+        # CachingMiddlewareはclose()で溜まっている書き込みをフラッシュする
+        self.db.close()
+
+
+class SQLiteBackend:
+
+    # 列として持つキーとその列名
+    INDEXED_FIELDS = {
+        'timestamp': 'timestamp',
+        'device_name': 'device_name',
+        'doc_type': 'doc_type',
+        'mac': 'mac',
+        'macPrefix': 'mac_prefix',
+    }
+
+    SCHEMA = [
+        '''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            timestamp REAL,
+            device_name TEXT,
+            doc_type TEXT,
+            mac TEXT,
+            mac_prefix TEXT,
+            body TEXT NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_documents_timestamp ON documents (table_name, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_device ON documents (table_name, device_name, doc_type, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_mac ON documents (table_name, mac)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_mac_prefix ON documents (table_name, mac_prefix)',
+    ]
+
+    def __init__(self, db_path:str=SQLITE_DB_PATH, caching:bool=False) -> None:
+        self.db_path = db_path
+        self.caching = caching
+
+        # 他のプロセスが書き込み中なら最大30秒待つ
+        self.conn = sqlite3.connect(db_path, timeout=30)
+
+        # WALモードにすると書き込み中でも読み込みがブロックされない
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        self.conn.commit()
+
+
+    def _where(self, table_name:str, cond:dict):
+        """
+        検索条件からWHERE句を作る
+
+        インデックスのある列で表現できない条件はPythonで絞り込むために返却する
+
+        Returns:
+            tuple: (WHERE句, パラメータ, 残った条件)
+        """
+        clauses = ['table_name = ?']
+        params = [table_name]
+        rest = {}
+
+        for k, v in (cond or {}).items():
+            column = self.INDEXED_FIELDS.get(k)
+            if column is None:
+                rest[k] = v
+            elif v is EXISTS:
+                clauses.append(f'{column} IS NOT NULL')
+            elif isinstance(v, Range):
+                clauses.append(f'{column} IS NOT NULL')
+                if v.since is not None:
+                    clauses.append(f'{column} >= ?')
+                    params.append(v.since)
+                if v.until is not None:
+                    clauses.append(f'{column} <= ?')
+                    params.append(v.until)
+            elif isinstance(v, (list, tuple, set, frozenset)):
+                v = list(v)
+                if not v:
+                    clauses.append('0')
+                else:
+                    clauses.append(f'{column} IN ({", ".join("?" * len(v))})')
+                    params.extend(v)
+            else:
+                clauses.append(f'{column} = ?')
+                params.append(v)
+
+        return ' AND '.join(clauses), params, rest
+
+
+    def _row_values(self, table_name:str, doc:dict) -> tuple:
+        values = [table_name]
+        for k in self.INDEXED_FIELDS.keys():
+            v = doc.get(k)
+            # 文字列と数値以外は列に入れない
+            if not isinstance(v, (str, int, float)):
+                v = None
+            values.append(v)
+        values.append(json.dumps(doc))
+        return tuple(values)
+
+
+    def _commit(self):
+        if not self.caching:
+            self.conn.commit()
+
+
+    def insert(self, table_name:str, doc:dict):
+        self.insert_multiple(table_name, [doc])
+
+
+    def insert_multiple(self, table_name:str, docs:list):
+        columns = ', '.join(['table_name'] + list(self.INDEXED_FIELDS.values()) + ['body'])
+        placeholders = ', '.join('?' * (len(self.INDEXED_FIELDS) + 2))
+        self.conn.executemany(
+            f'INSERT INTO documents ({columns}) VALUES ({placeholders})',
+            (self._row_values(table_name, doc) for doc in docs))
+        self._commit()
+
+
+    def all(self, table_name:str) -> list:
+        return self.search(table_name)
+
+
+    def search(self, table_name:str, cond:dict=None) -> list:
+        where, params, rest = self._where(table_name, cond)
+        cursor = self.conn.execute(f'SELECT body FROM documents WHERE {where} ORDER BY id', params)
+        docs = [json.loads(row[0]) for row in cursor]
+        if rest:
+            docs = [doc for doc in docs if match_cond(doc, rest)]
+        return docs
+
+
+    def get(self, table_name:str, cond:dict):
+        docs = self.search(table_name, cond)
+        if docs:
+            return docs[0]
+        return None
+
+
+    def timestamps(self, table_name:str, cond:dict=None) -> list:
+        where, params, rest = self._where(table_name, cond)
+        if rest:
+            return [doc['timestamp'] for doc in self.search(table_name, cond) if 'timestamp' in doc]
+
+        # 本文を読まずにインデックスだけで済ませる
+        cursor = self.conn.execute(f'SELECT timestamp FROM documents WHERE {where} AND timestamp IS NOT NULL', params)
+        return [row[0] for row in cursor]
+
+
+    def remove(self, table_name:str, cond:dict):
+        where, params, rest = self._where(table_name, cond)
+
+        if rest:
+            # インデックスのない条件は一件ずつ確認して削除する
+            cursor = self.conn.execute(f'SELECT id, body FROM documents WHERE {where}', params)
+            ids = [row[0] for row in cursor if match_cond(json.loads(row[1]), rest)]
+            self.conn.executemany('DELETE FROM documents WHERE id = ?', [(i,) for i in ids])
+        else:
+            self.conn.execute(f'DELETE FROM documents WHERE {where}', params)
+
+        self._commit()
+
+
+    def drop_table(self, table_name:str):
+        self.conn.execute('DELETE FROM documents WHERE table_name = ?', (table_name,))
+        self._commit()
+
+
+    def tables(self) -> set:
+        cursor = self.conn.execute('SELECT DISTINCT table_name FROM documents')
+        return {row[0] for row in cursor}
+
+
+    def flush(self):
+        self.conn.commit()
+
+
+    def close(self, discard:bool=False):
+        if discard:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+        self.conn.close()
+
+
+class ShardedBackend:
+    """
+    テーブルごと、履歴を持つテーブルは月ごとに別のTinyDBファイルに格納するバックエンド
+
+    db_pathはディレクトリで、この中にファイルを作る。
+    timestampを持たないドキュメントは none.json に格納する。
+    """
+
+    # timestampを持たないドキュメントを格納するパーティション
+    NO_PARTITION = 'none'
+
+    def __init__(self, db_path:str=SHARDED_DB_PATH, caching:bool=False, storage_format:str=None, lock_path:str=None) -> None:
+        self.db_path = db_path
+        self.caching = caching
+        self.storage_format = storage_format or get_format()
+        self.lock_path = lock_path
+
+        # シャードのファイルの拡張子
+        self.ext = FORMAT_EXTENSIONS[self.storage_format]
+
+        # キャッシュする場合に開いたままにしておくシャード
+        self._shards = {}
+
+        os.makedirs(db_path, exist_ok=True)
+
+
+    @staticmethod
+    def _is_partitioned(table_name:str) -> bool:
+        return table_name in PARTITIONED_TABLES
+
+
+    @classmethod
+    def _partition_of(cls, doc:dict) -> str:
+        ts = doc.get('timestamp')
+        if not isinstance(ts, (int, float)):
+            return cls.NO_PARTITION
+        return datetime.fromtimestamp(ts).strftime('%Y-%m')
+
+
+    @staticmethod
+    def _partition_range(partition:str) -> tuple:
+        """
+        パーティションに含まれるタイムスタンプの範囲 [start, end) を返却する
+        """
+        start = datetime.strptime(partition, '%Y-%m')
+        if start.month == 12:
+            end = start.replace(year=start.year + 1, month=1)
+        else:
+            end = start.replace(month=start.month + 1)
+        return start.timestamp(), end.timestamp()
+
+
+    def _shard_path(self, table_name:str, partition:str=None) -> str:
+        if partition is None:
+            return os.path.join(self.db_path, f'{table_name}{self.ext}')
+        return os.path.join(self.db_path, table_name, f'{partition}{self.ext}')
+
+
+    def _partitions(self, table_name:str) -> list:
+        """
+        存在するパーティションの一覧を返却する、パーティションに分けないテーブルは[None]
+        """
+        if not self._is_partitioned(table_name):
+            return [None]
+
+        partitions = set()
+
+        table_dir = os.path.join(self.db_path, table_name)
+        if os.path.isdir(table_dir):
+            partitions.update(name[:-len(self.ext)] for name in os.listdir(table_dir) if name.endswith(self.ext))
+
+        # まだファイルに書き出していないシャード
+        partitions.update(p for (t, p) in self._shards.keys() if t == table_name)
+
+        return sorted(partitions)
+
+
+    def _select_partitions(self, table_name:str, cond:dict) -> list:
+        """
+        検索条件のtimestampに該当するパーティションだけを返却する
+        """
+        partitions = self._partitions(table_name)
+
+        v = (cond or {}).get('timestamp')
+        if partitions == [None] or v is None or v is EXISTS:
+            return partitions
+
+        if isinstance(v, Range):
+            selected = []
+            for partition in partitions:
+                if partition == self.NO_PARTITION:
+                    continue
+                start, end = self._partition_range(partition)
+                if v.since is not None and end <= v.since:
+                    continue
+                if v.until is not None and start > v.until:
+                    continue
+                selected.append(partition)
+            return selected
+
+        values = v if isinstance(v, (list, tuple, set, frozenset)) else [v]
+        wanted = {self._partition_of({'timestamp': ts}) for ts in values}
+        return [p for p in partitions if p in wanted]
+
+
+    def _exists(self, table_name:str, partition:str) -> bool:
+        return (table_name, partition) in self._shards or os.path.exists(self._shard_path(table_name, partition))
+
+
+    @contextmanager
+    def _open_shard(self, table_name:str, partition:str=None):
+        key = (table_name, partition)
+
+        shard = self._shards.get(key)
+        if shard is not None:
+            yield shard
+            return
+
+        path = self._shard_path(table_name, partition)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        shard = TinyDBBackend(db_path=path, caching=self.caching, storage_format=self.storage_format, lock_path=self.lock_path)
+        if self.caching:
+            self._shards[key] = shard
+            yield shard
+            return
+
+        try:
+            yield shard
+        finally:
+            shard.close()
+
+
+    def insert(self, table_name:str, doc:dict):
+        self.insert_multiple(table_name, [doc])
+
+
+    def insert_multiple(self, table_name:str, docs:list):
+        by_partition = {}
+        for doc in docs:
+            partition = self._partition_of(doc) if self._is_partitioned(table_name) else None
+            by_partition.setdefault(partition, []).append(doc)
+
+        for partition, partition_docs in by_partition.items():
+            with self._open_shard(table_name, partition) as shard:
+                shard.insert_multiple(table_name, partition_docs)
+
+
+    def all(self, table_name:str) -> list:
+        return self.search(table_name)
+
+
+    def search(self, table_name:str, cond:dict=None) -> list:
+        docs = []
+        for partition in self._select_partitions(table_name, cond):
+            if not self._exists(table_name, partition):
+                continue
+            with self._open_shard(table_name, partition) as shard:
+                docs.extend(shard.search(table_name, cond))
+        return docs
+
+
+    def get(self, table_name:str, cond:dict):
+        for partition in self._select_partitions(table_name, cond):
+            if not self._exists(table_name, partition):
+                continue
+            with self._open_shard(table_name, partition) as shard:
+                doc = shard.get(table_name, cond)
+            if doc is not None:
+                return doc
+        return None
+
+
+    def timestamps(self, table_name:str, cond:dict=None) -> list:
+        timestamps = []
+        for partition in self._select_partitions(table_name, cond):
+            if partition == self.NO_PARTITION or not self._exists(table_name, partition):
+                continue
+            with self._open_shard(table_name, partition) as shard:
+                timestamps.extend(shard.timestamps(table_name, cond))
+        return timestamps
+
+
+    def remove(self, table_name:str, cond:dict):
+        for partition in self._select_partitions(table_name, cond):
+            if not self._exists(table_name, partition):
+                continue
+            with self._open_shard(table_name, partition) as shard:
+                shard.remove(table_name, cond)
+
+
+    def drop_table(self, table_name:str):
+        # 開いたままのシャードは閉じると書き出してしまうので、先に閉じてから消す
+        for key in [k for k in self._shards.keys() if k[0] == table_name]:
+            self._shards.pop(key).close()
+
+        path = self._shard_path(table_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+        table_dir = os.path.join(self.db_path, table_name)
+        if os.path.isdir(table_dir):
+            shutil.rmtree(table_dir)
+
+
+    def tables(self) -> set:
+        names = set()
+        for name in os.listdir(self.db_path):
+            if name.startswith('.'):
+                continue
+            if name.endswith(self.ext):
+                names.add(name[:-len(self.ext)])
+            elif os.path.isdir(os.path.join(self.db_path, name)):
+                names.add(name)
+        names.update(t for (t, p) in self._shards.keys())
+        return names
+
+
+    def flush(self):
+        for shard in self._shards.values():
+            shard.flush()
+
+
+    def close(self, discard:bool=False):
+        for shard in self._shards.values():
+            shard.close(discard=discard)
+        self._shards = {}
+
+
+def migrate(src_backend:str, dst_backend:str, src_path:str=None, dst_path:str=None):
+    """
+    バックエンド間で全てのテーブルをコピーする
+
+    例： db.jsonの内容をSQLiteに移す
+    migrate(BACKEND_TINYDB, BACKEND_SQLITE)
+
+    Args:
+        src_backend (str): コピー元のバックエンド
+        dst_backend (str): コピー先のバックエンド
+        src_path (str, optional): コピー元のファイル. Defaults to None.
+        dst_path (str, optional): コピー先のファイル. Defaults to None.
+    """
+    src = create_backend(backend=src_backend, db_path=src_path)
+    dst = create_backend(backend=dst_backend, db_path=dst_path, caching=True)
+
+    try:
+        for table_name in sorted(src.tables()):
+            docs = src.all(table_name)
+            dst.drop_table(table_name)
+            dst.insert_multiple(table_name, docs)
+            logger.info(f'{table_name}: {len(docs)} documents copied')
+    finally:
+        dst.close()
+        src.close()
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_backend(backend:str):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'db')
+            db = create_backend(backend=backend, db_path=db_path)
+
+            db.insert('PYATS', {'device_name': 'sw1', 'doc_type': 'mac_address_table', 'doc_data': {}, 'timestamp': 1.0})
+            db.insert('PYATS', {'device_name': 'sw1', 'doc_type': 'mac_address_table', 'doc_data': {}, 'timestamp': 2.0})
+            db.insert('PYATS', {'device_name': 'sw2', 'doc_type': 'intf_info', 'doc_data': {}, 'timestamp': 2.0})
+            db.insert_multiple('MAC_VENDORS', [
+                {'timestamp': 1.0},
+                {'macPrefix': '98:86:8B', 'vendorName': 'Juniper Networks'},
+                {'macPrefix': '8C:5D:B2:9', 'vendorName': 'ISSENDORFF KG'},
+            ])
+
+            assert 2 == len(db.search('PYATS', {'device_name': 'sw1', 'doc_type': 'mac_address_table'}))
+            assert 2 == len(db.search('PYATS', {'timestamp': [1.0, 2.0], 'device_name': 'sw1'}))
+            assert 1.0 == db.get('MAC_VENDORS', {'timestamp': EXISTS})['timestamp']
+            assert 2 == len(db.search('MAC_VENDORS', {'macPrefix': EXISTS}))
+            assert 'ISSENDORFF KG' == db.get('MAC_VENDORS', {'macPrefix': ['8C:5D:B2', '8C:5D:B2:9']})['vendorName']
+            assert 1 == len(db.search('MAC_VENDORS', {'vendorName': 'Juniper Networks'}))
+
+            assert 2 == len(db.search('PYATS', {'timestamp': Range(since=2.0)}))
+            assert [1.0, 2.0] == sorted(db.timestamps('PYATS', {'device_name': 'sw1'}))
+            assert [1.0] == db.timestamps('MAC_VENDORS')
+            assert 1 == len(db.search('PYATS', {'timestamp': Range(since=0.5, until=1.5)}))
+
+            db.remove('PYATS', {'device_name': 'sw1', 'timestamp': [1.0]})
+            assert 2 == len(db.all('PYATS'))
+
+            db.drop_table('MAC_VENDORS')
+            assert [] == db.all('MAC_VENDORS')
+            db.close()
+
+        logger.info(f'test {backend} backend pass')
+
+    def test_sharded_partitions():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'db.d')
+            db = ShardedBackend(db_path=db_path)
+
+            jan = datetime(2023, 1, 15).timestamp()
+            feb = datetime(2023, 2, 15).timestamp()
+            db.insert('DHCP_CLIENTS', {'timestamp': jan, 'doc_data': []})
+            db.insert('DHCP_CLIENTS', {'timestamp': feb, 'doc_data': []})
+            db.insert('MAC_VENDORS', {'timestamp': feb})
+
+            assert os.path.exists(os.path.join(db_path, 'DHCP_CLIENTS', '2023-01.json'))
+            assert os.path.exists(os.path.join(db_path, 'DHCP_CLIENTS', '2023-02.json'))
+            assert os.path.exists(os.path.join(db_path, 'MAC_VENDORS.json'))
+            assert {'DHCP_CLIENTS', 'MAC_VENDORS'} == db.tables()
+
+            assert ['2023-02'] == db._select_partitions('DHCP_CLIENTS', {'timestamp': Range(since=feb)})
+            assert ['2023-01'] == db._select_partitions('DHCP_CLIENTS', {'timestamp': [jan]})
+            assert [feb] == [d['timestamp'] for d in db.search('DHCP_CLIENTS', {'timestamp': Range(since=feb)})]
+
+            db.drop_table('DHCP_CLIENTS')
+            assert {'MAC_VENDORS'} == db.tables()
+            db.close()
+
+        logger.info('test sharded partitions pass')
+
+    parser = argparse.ArgumentParser(description='database backend')
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('--migrate', nargs=2, metavar=('SRC', 'DST'), help='copy all tables, e.g. --migrate tinydb sharded')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_backend(BACKEND_TINYDB)
+            test_backend(BACKEND_SQLITE)
+            test_backend(BACKEND_SHARDED)
+            test_sharded_partitions()
+            return 0
+
+        if args.migrate:
+            migrate(args.migrate[0], args.migrate[1])
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
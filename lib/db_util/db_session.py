@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+#
+# データベースのセッション
+#
+# 関数を呼ぶたびに TinyDB(DB_PATH) を開くと、そのたびにdb.jsonを全部読み込んでパースすることになる。
+# MAC_VENDORSテーブルのように大きなテーブルが同居しているとこれが非常に重いので、
+# 一度開いたデータベースを使い回すためのセッションを用意する。
+#
+# 使い方
+#
+# with DbSession():
+#     docs = get_dhcp_clients_documents()
+#     searched = search_mac_vendors('28:84:FA:EA:5F:0C')
+#
+# withの中で呼ばれたdb_utilの関数は同じバックエンドを共有する。
+# 読み込みはメモリ上のキャッシュから行い、書き込みはまとめてwithを抜けるときにファイルに書き出す。
+# SQLiteの場合はwithの間が一つのトランザクションになる。
+# セッションの外で呼ばれた場合はこれまで通りその都度開く。
+#
+# 別のプロセスのコレクタと書き込みが重ならないように、開いている間はファイルロックを取る（file_lock.py参照）。
+# セッションは読み込みから書き戻しまでの間だけ開くこと。
+#
+# analyze.pyのように読むだけのものは DbSession(readonly=True) とする。
+# 開いている間ロックを取り続けることはせず、ファイルを読む間だけ共有ロックを取るので、
+# 長いレポートを作っている間もコレクタの書き込みを待たせない。
+# 読み込み専用のセッションの中で書き込まれたもの（インデックスの作り直しなど）はファイルに書き出さずに捨てる。
+#
+
+import logging
+
+from contextlib import contextmanager
+
+try:
+    from .backend import create_backend, get_backend_name, get_default_db_path, get_lock_path
+    from .file_lock import FileLock
+except ImportError:
+    from backend import create_backend, get_backend_name, get_default_db_path, get_lock_path
+    from file_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# 現在有効なセッションのスタック
+_sessions = []
+
+
+class DbSession:
+    """
+    データベースを開いたままにしておくセッション
+
+    withで使う他、デーモンのように長時間動くものは open() と close() を自分で呼んでもよい。
+
+    Args:
+        db_path (str, optional): ファイルのパス. Defaults to バックエンドごとの既定のパス.
+        backend (str, optional): バックエンドの種類. Defaults to DB_UTIL_BACKEND.
+        readonly (bool, optional): 読むだけのセッションにするかどうか. Defaults to False.
+    """
+
+    def __init__(self, db_path:str=None, backend:str=None, readonly:bool=False) -> None:
+        self.backend = backend or get_backend_name()
+        self.db_path = db_path or get_default_db_path(self.backend)
+        self.readonly = readonly
+        self.db = None
+        self.lock = None
+
+
+    def open(self):
+        if self.db is not None:
+            return self
+
+        lock_path = get_lock_path(self.backend, self.db_path)
+
+        if self.readonly:
+            # ファイルを読む間だけ共有ロックを取る
+            self.db = create_backend(backend=self.backend, db_path=self.db_path, caching=True, lock_path=lock_path)
+            _sessions.append(self)
+            logger.debug(f'readonly session opened: {self.db_path}')
+            return self
+
+        # 読み込んでから書き戻すまで他のプロセスに書き込ませない
+        if lock_path is not None:
+            self.lock = FileLock(lock_path).acquire()
+
+        try:
+            self.db = create_backend(backend=self.backend, db_path=self.db_path, caching=True)
+        except Exception:
+            self._release()
+            raise
+
+        _sessions.append(self)
+        logger.debug(f'session opened: {self.db_path}')
+        return self
+
+
+    def flush(self):
+        """
+        溜まっている書き込みをファイルに書き出す、読み込み専用のセッションでは何もしない
+        """
+        if self.db is not None and not self.readonly:
+            self.db.flush()
+
+
+    def close(self):
+        if self.db is None:
+            return
+
+        # 溜まっている書き込みはclose()でフラッシュされる、読み込み専用のセッションでは捨てる
+        try:
+            self.db.close(discard=self.readonly)
+        finally:
+            self.db = None
+            self._release()
+
+        if self in _sessions:
+            _sessions.remove(self)
+        logger.debug(f'session closed: {self.db_path}')
+
+
+    def _release(self):
+        if self.lock is not None:
+            self.lock.release()
+            self.lock = None
+
+
+    def __enter__(self):
+        return self.open()
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_session(db_path:str=None):
+    """
+    db_pathを開いている有効なセッションを返却する
+
+    db_pathを省略した場合は最後に開いたセッションを返却する。
+
+    Args:
+        db_path (str, optional): ファイルのパス. Defaults to None.
+
+    Returns:
+        DbSession: 有効なセッション、存在しなければNone
+    """
+    if db_path is None:
+        return _sessions[-1] if _sessions else None
+
+    for session in reversed(_sessions):
+        if session.db_path == db_path:
+            return session
+    return None
+
+
+@contextmanager
+def open_db(db_path:str=None):
+    """
+    バックエンドを返却するコンテキストマネージャ
+
+    セッションが有効ならそのバックエンドを使い回し、そうでなければその都度開いて閉じる。
+
+    with open_db() as db:
+        docs = db.search(table_name, {'timestamp': timestamp})
+
+    Args:
+        db_path (str, optional): ファイルのパス. Defaults to 有効なセッション、無ければ既定のパス.
+
+    Yields:
+        TinyDBBackend or SQLiteBackend: バックエンド
+    """
+    session = get_session(db_path)
+    if session is not None:
+        yield session.db
+        return
+
+    lock_path = get_lock_path(db_path=db_path)
+    lock = FileLock(lock_path).acquire() if lock_path is not None else None
+    try:
+        db = create_backend(db_path=db_path)
+        try:
+            yield db
+        finally:
+            db.close()
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+@contextmanager
+def ensure_session(db_path:str=None):
+    """
+    セッションが無ければwithの間だけセッションを開くコンテキストマネージャ
+
+    挿入して古いものを削除する、のように複数回の読み書きをする処理を一回の読み込みと書き込みにまとめる。
+
+    Args:
+        db_path (str, optional): ファイルのパス. Defaults to 有効なセッション、無ければ既定のパス.
+
+    Yields:
+        DbSession: 有効なセッション
+    """
+    session = get_session(db_path)
+    if session is not None:
+        yield session
+        return
+
+    with DbSession(db_path=db_path) as session:
+        yield session
+
+
+if __name__ == '__main__':
+
+    import os
+    import sys
+    import tempfile
+
+    from tinydb import TinyDB
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_session():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'db.json')
+
+            with DbSession(db_path=db_path, backend='tinydb') as session:
+                with open_db(db_path) as db:
+                    db.insert('TEST', {'timestamp': 1.0})
+
+                # セッションの中では同じバックエンドを使う
+                with open_db(db_path) as db:
+                    assert db is session.db
+                    assert 1 == len(db.all('TEST'))
+
+                # まだファイルには書き出されていない
+                with TinyDB(db_path) as db:
+                    assert 0 == len(db.table('TEST').all())
+
+            # セッションを閉じるとファイルに書き出される
+            with TinyDB(db_path) as db:
+                assert 1 == len(db.table('TEST').all())
+
+            assert get_session(db_path) is None
+
+            # 読み込み専用のセッションは開いている間ロックを取らず、書き込みは捨てる
+            with DbSession(db_path=db_path, backend='tinydb', readonly=True):
+                with open_db(db_path) as db:
+                    assert 1 == len(db.all('TEST'))
+                    db.insert('TEST', {'timestamp': 2.0})
+                    assert 2 == len(db.all('TEST'))
+
+                # ロックを取り続けていないので、コレクタはすぐに排他ロックを取れる
+                with FileLock(get_lock_path('tinydb', db_path), timeout=0):
+                    pass
+
+            with DbSession(db_path=db_path, backend='tinydb') as session:
+                with open_db(db_path) as db:
+                    assert 1 == len(db.all('TEST'))
+
+        logger.info('test session pass')
+
+    def main():
+        test_session()
+        return 0
+
+    sys.exit(main())
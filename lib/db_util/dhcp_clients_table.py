@@ -1,18 +1,17 @@
 #!/usr/bin/env python
 
 import logging
-import os
 
 from datetime import datetime
 
-#
-# tinydb
-#
-from tinydb import Query, TinyDB
-
-# JSONファイル
-DB_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(DB_DIR, 'db.json')
+try:
+    from .db_session import open_db
+    from .snapshot_table import SnapshotTable
+    from .mac_observations_table import SOURCE_DHCP, dhcp_observations, normalize_mac
+except ImportError:
+    from db_session import open_db
+    from snapshot_table import SnapshotTable
+    from mac_observations_table import SOURCE_DHCP, dhcp_observations, normalize_mac
 
 # テーブルの種類
 TABLE_DHCP_CLIENTS = 'DHCP_CLIENTS'
@@ -25,15 +24,38 @@ logger = logging.getLogger(__name__)
 #
 # DHCPクライアント情報
 #
+# {
+#     'timestamp': float型タイムスタンプ,
+#     'doc_data': [ {'ip': a.b.c.d, 'mac': AA:BB:CC:DD:EE:FF}, {}, {}],
+# }
+#
+
+DHCP_CLIENTS_TABLE = SnapshotTable(
+    TABLE_DHCP_CLIENTS,
+    DEFAULT_DHCP_MAX_HISTORY,
+    source_key=SOURCE_DHCP,
+    mac_key='mac',
+    observations=dhcp_observations,
+    archive=True
+)
+
+
+def get_dhcp_clients_table(table_name:str=TABLE_DHCP_CLIENTS) -> SnapshotTable:
+    """
+    テーブル名に対応するSnapshotTableを返却する
+
+    TABLE_DHCP_CLIENTS以外（テスト用など）はMACアドレスの観測インデックスや差分履歴を作らない
+    """
+    if table_name == TABLE_DHCP_CLIENTS:
+        return DHCP_CLIENTS_TABLE
+    return SnapshotTable(table_name, DEFAULT_DHCP_MAX_HISTORY, archive=True)
+
 
 def insert_dhcp_clients(dhcp_clients_list:list, timestamp:float, max_history:int=DEFAULT_DHCP_MAX_HISTORY, table_name:str=TABLE_DHCP_CLIENTS):
     """
     DHCPクライアントの情報をテーブルに格納する
 
-    {
-        'timestamp': float型タイムスタンプ,
-        'doc_data': [ {'ip': a.b.c.d, 'mac': AA:BB:CC:DD:EE:FF}, {}, {}],
-    }
+    DB_UTIL_SNAPSHOT_MODE=deltaの場合は直前との差分で格納する（snapshot_history.py参照）
 
     Args:
         dhcp_clients_list (list): doc_dataとして格納する配列
@@ -41,68 +63,21 @@ def insert_dhcp_clients(dhcp_clients_list:list, timestamp:float, max_history:int
         max_history (int, optional): 蓄積する数 Defaults to DEFAULT_DHCP_MAX_HISTORY.
         table_name (str, optional): テーブル名 Defaults to TABLE_DHCP_CLIENTS.
     """
-
-    # 格納するドキュメント
-    doc = {}
-
-    # タイムスタンプを付与
-    doc['timestamp'] = timestamp
-
-    # ドキュメントデータを付与
-    doc['doc_data'] = dhcp_clients_list
-
-    # テーブルに格納
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        table.insert(doc)
-
-    # max_historyを超えた古いものを削除
-    delete_old_dhcp_clients(max_history)
+    get_dhcp_clients_table(table_name).insert(dhcp_clients_list, timestamp, max_history=max_history)
 
 
 def delete_old_dhcp_clients(max_history:int, table_name:str=TABLE_DHCP_CLIENTS):
-
-    q = Query()
-
-    # 降順のタイムスタンプの一覧を取得
-    timestamps = get_dhcp_clients_timestamps(table_name=table_name)
-
-    # max_historyを超えたものを削除
-    if len(timestamps) > max_history:
-        should_be_deleted = timestamps[max_history:]
-        with TinyDB(DB_PATH) as db:
-            table = db.table(table_name)
-
-            for ts in should_be_deleted:
-                table.remove(q.timestamp == ts)
+    get_dhcp_clients_table(table_name).delete_old(max_history)
 
 
 def get_dhcp_clients_timestamps(table_name:str=TABLE_DHCP_CLIENTS):
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-
-        # timestampキーの一覧を取り出す
-        timestamps = [doc['timestamp'] for doc in table.all()]
-
-    # 降順にソートする
-    timestamps.sort(reverse=True)
-
-    return timestamps
+    # 降順のタイムスタンプの一覧
+    return get_dhcp_clients_table(table_name).timestamps()
 
 
 def get_dhcp_clients_dates(table_name:str=TABLE_DHCP_CLIENTS):
-
-    timestamps = get_dhcp_clients_timestamps(table_name=table_name)
-
-    # datetimeオブジェクトに変換
-    datetimes = [datetime.fromtimestamp(ts) for ts in timestamps]
-
-    # 分かりやすく日付の文字列に変換
-    dates = [dt.strftime("%Y-%m-%d %H:%M:%S") for dt in datetimes]
-
-    return dates
-
+    return get_dhcp_clients_table(table_name).dates()
 
 
 def get_dhcp_clients_documents(table_name:str=TABLE_DHCP_CLIENTS):
@@ -115,79 +90,101 @@ def get_dhcp_clients_documents(table_name:str=TABLE_DHCP_CLIENTS):
     Returns:
         list: ドキュメントのリスト
     """
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        return sorted(table.all(), key=lambda d: d['timestamp'], reverse=True)
+    return get_dhcp_clients_table(table_name).documents()
 
 
-def get_dhcp_clients_by_mac(mac_address:str, table_name:str=TABLE_DHCP_CLIENTS):
+def iter_dhcp_clients_documents(since:float=None, until:float=None, limit:int=None, table_name:str=TABLE_DHCP_CLIENTS):
+    """
+    ドキュメントを新しい順に一つずつ返すジェネレータ
 
-    # 大文字に変換
-    mac_address = mac_address.upper()
+    範囲がデータベースより古い時刻に及ぶ場合はアーカイブからも読み込む
 
-    results = []
+    Args:
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+        until (float, optional): これ以前のタイムスタンプ、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
+        table_name (str, optional): テーブル名. Defaults to TABLE_DHCP_CLIENTS.
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        # tinydbではドキュメントの一部を取り出すのは困難なので全てのドキュメントを確認する
-        for doc in table.all():
-            timestamp = doc['timestamp']
-            dhcp_clients_list = doc['doc_data']
-            filtered = list(filter(lambda d: d['mac'] == mac_address, dhcp_clients_list))
-            if filtered:
-                # 先頭一つを取り出す
-                filtered = filtered[0]
-                filtered.update({'timestamp': timestamp})
-                results.append(filtered)
+    Yields:
+        dict: ドキュメント
+    """
+    yield from get_dhcp_clients_table(table_name).iter_documents(since=since, until=until, limit=limit)
 
-    return results
 
+def build_dhcp_clients_observations(table_name:str=TABLE_DHCP_CLIENTS):
+    """
+    DHCPクライアントの全履歴からMACアドレスの観測インデックスを作り直す
 
-def get_dhcp_clients_by_timestamp(timestamp:float, table_name:str=TABLE_DHCP_CLIENTS):
-    q = Query()
+    Args:
+        table_name (str, optional): テーブル名. Defaults to TABLE_DHCP_CLIENTS.
+    """
+    get_dhcp_clients_table(table_name).build_observations()
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        return table.get(q.timestamp == timestamp)
 
+def get_dhcp_clients_by_mac(mac_address:str, table_name:str=TABLE_DHCP_CLIENTS):
+    """
+    MACアドレスを払い出したスナップショットを古い順に返却する
 
-def get_dhcp_clients_diff(table_name:str=TABLE_DHCP_CLIENTS):
+    Args:
+        mac_address (str): MACアドレス
+        table_name (str, optional): テーブル名. Defaults to TABLE_DHCP_CLIENTS.
 
-    # このタイムスタンプは新しい順に並んでいる
-    timestamps = get_dhcp_clients_timestamps(table_name=table_name)
+    Returns:
+        list: [{'ip': a.b.c.d, 'mac': AA:BB:CC:DD:EE:FF, 'timestamp': xxx}, ...]
+    """
 
-    # 最小で2個のデータがないと比較できない
-    if len(timestamps) < 2:
-        return None
+    # MACアドレスの観測インデックスから探す
+    found = get_dhcp_clients_table(table_name).find_mac(mac_address)
+    if found is not None:
+        mac_address = normalize_mac(mac_address)
+        return [{'ip': run.get('ip', ''), 'mac': mac_address, 'timestamp': ts} for ts, run in found]
 
-    timestamps_before = timestamps[1:]  # リストを右に一つずらす
-    timestamps.pop() # 一番右を削除してリストの要素数を揃える
+    # AA:BB:CC:DD:EE:FFの形式にそろえる
+    mac_address = normalize_mac(mac_address)
 
     results = []
 
-    for ts_after, ts_before in zip(timestamps, timestamps_before):
-        after_doc = get_dhcp_clients_by_timestamp(ts_after)
-        before_doc = get_dhcp_clients_by_timestamp(ts_before)
+    # ドキュメントの一部を取り出すのは困難なので全てのスナップショットを確認する
+    for doc in reversed(get_dhcp_clients_documents(table_name=table_name)):
+        timestamp = doc['timestamp']
+        dhcp_clients_list = doc['doc_data']
+        filtered = list(filter(lambda d: normalize_mac(d['mac']) == mac_address, dhcp_clients_list))
+        if filtered:
+            # 先頭一つを取り出す
+            # セッションのキャッシュを書き換えないようにコピーする
+            filtered = dict(filtered[0])
+            filtered.update({'timestamp': timestamp})
+            results.append(filtered)
+
+    return results
 
-        after_data = after_doc.get('doc_data', [])
-        before_data = before_doc.get('doc_data', [])
 
-        # ひとつ前と比較して違いがあれば
-        if after_data != before_data:
+def get_dhcp_clients_by_timestamp(timestamp:float, table_name:str=TABLE_DHCP_CLIENTS):
+    return get_dhcp_clients_table(table_name).by_timestamp(timestamp)
 
-            diff = {}
-            diff['timestamp_before'] = ts_before
-            diff['timestamp_after'] = ts_after
 
-            added = [d for d in after_data if d not in before_data]
-            diff['add'] = added
+def build_dhcp_clients_diffs(table_name:str=TABLE_DHCP_CLIENTS):
+    """
+    DHCPクライアントの全履歴から差分履歴を作り直す
 
-            deleted = [p for p in before_data if p not in after_data]
-            diff['delete'] = deleted
+    Args:
+        table_name (str, optional): テーブル名. Defaults to TABLE_DHCP_CLIENTS.
+    """
+    get_dhcp_clients_table(table_name).build_diffs()
 
-            results.append(diff)
 
-    return results
+def get_dhcp_clients_diff(since:float=None, table_name:str=TABLE_DHCP_CLIENTS):
+    """
+    隣り合うスナップショットの差分を新しい順に返却する、違いがないものは含まない
+
+    Args:
+        since (float, optional): 新しい方のタイムスタンプがこれ以降、この値を含む. Defaults to None.
+        table_name (str, optional): テーブル名. Defaults to TABLE_DHCP_CLIENTS.
+
+    Returns:
+        list: [{'timestamp_before': xxx, 'timestamp_after': xxx, 'add': [...], 'delete': [...]}, ...]
+    """
+    return get_dhcp_clients_table(table_name).diff(since=since)
 
 
 if __name__ == '__main__':
@@ -231,7 +228,7 @@ if __name__ == '__main__':
             {'ip': '192.168.122.109', 'mac': '3C:22:FB:7B:85:0E'}
         ]
 
-        with TinyDB(DB_PATH) as db:
+        with open_db() as db:
             db.drop_table(table_name)
 
         timestamp = datetime.now().timestamp()
@@ -247,7 +244,7 @@ if __name__ == '__main__':
         searched = get_dhcp_clients_by_mac(mac_address='28:84:FA:EA:5F:0C', table_name=table_name)
         print(searched)
 
-        with TinyDB(DB_PATH) as db:
+        with open_db() as db:
             db.drop_table(table_name)
 
     parser = argparse.ArgumentParser()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+#
+# 変化のイベント
+#
+# 端末が接続した、離れた、移動した、を知りたい場合にスナップショットを定期的に読み直すのではなく、
+# スナップショットを格納したときに直前との差分からイベントを作って通知する。
+#
+# join:  直前のスナップショットにはなく、今回現れたMACアドレス
+# leave: 直前のスナップショットにあり、今回なくなったMACアドレス
+# move:  両方にあるが属性（IPアドレス、AP、インタフェースなど）が変わったMACアドレス
+#
+# { 'event': 'join', 'source': 'dhcp', 'timestamp': xxx, 'mac': 'AA:BB:CC:DD:EE:FF', 'after': {...} }
+# { 'event': 'leave', 'source': 'wlc', 'timestamp': xxx, 'mac': 'AA:BB:CC:DD:EE:FF', 'before': {...} }
+# { 'event': 'move', 'source': 'mac_address_table/c3560c-12pc-s', 'timestamp': xxx, 'mac': 'AA:BB:CC:DD:EE:FF', 'before': {...}, 'after': {...} }
+#
+# 同じプロセスの中ではsubscribe()で登録した関数を呼び出す。
+# 別のプロセスで動いているデーモンのために、追記専用のJSONLのファイルにも書き込む。
+# デーモンは前回読んだ位置を覚えておき、read_events()でそこから後ろだけを読めばよい。
+#
+# ファイルは環境変数 DB_UTIL_EVENT_LOG で指定する。空文字列を指定するとファイルには書き込まない。
+#
+# 追記し続けるとファイルが大きくなるので、retention.pyの定期実行でrotate_event_log()を呼び出し、
+# その時点のファイルを日時を付けた名前に変えて新しいファイルに切り替える。
+# 切り替えたファイルは環境変数 DB_UTIL_EVENT_LOG_DAYS の日数を過ぎたら削除する。
+#
+# events.jsonl
+# events.jsonl.20230101-030000
+# events.jsonl.20230102-030000
+#
+# read_events()が返す位置はファイルのinode番号とファイル内の位置の組になっている。
+# 前回読んだファイルが切り替えられていたら、切り替えたファイルの残りを読んでから新しいファイルを先頭から読む。
+#
+
+import fcntl
+import json
+import logging
+import os
+import time
+
+from datetime import datetime
+
+try:
+    from .backend import DB_DIR
+    from .mac_observations_table import normalize_mac
+except ImportError:
+    from backend import DB_DIR
+    from mac_observations_table import normalize_mac
+
+# イベントの種類
+EVENT_JOIN = 'join'
+EVENT_LEAVE = 'leave'
+EVENT_MOVE = 'move'
+
+# イベントを書き込むファイル
+EVENT_LOG_PATH = os.environ.get('DB_UTIL_EVENT_LOG', os.path.join(DB_DIR, 'events.jsonl'))
+
+# 切り替えたファイルを残す日数
+EVENT_LOG_DAYS = float(os.environ.get('DB_UTIL_EVENT_LOG_DAYS', '7'))
+
+logger = logging.getLogger(__name__)
+
+# subscribe()で登録された関数
+_subscribers = []
+
+
+def subscribe(callback:callable) -> callable:
+    """
+    イベントを受け取る関数を登録する、デコレータとしても使える
+
+    Args:
+        callback (callable): イベントの辞書を一つ受け取る関数
+
+    Returns:
+        callable: 登録した関数
+    """
+    if callback not in _subscribers:
+        _subscribers.append(callback)
+    return callback
+
+
+def unsubscribe(callback:callable):
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+
+def set_event_log_path(log_path:str):
+    global EVENT_LOG_PATH
+    EVENT_LOG_PATH = log_path
+
+
+def set_event_log_days(days:float):
+    global EVENT_LOG_DAYS
+    EVENT_LOG_DAYS = days
+
+
+def get_event_log_age() -> float:
+    """
+    切り替えたファイルを残す秒数を返却する
+    """
+    return EVENT_LOG_DAYS * 24 * 60 * 60
+
+
+def diff_events(source_key:str, diff:dict, mac_key:str) -> list:
+    """
+    スナップショットの差分からイベントを作る
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        diff (dict): update_snapshot_diffs()が返した差分
+        mac_key (str): 要素のMACアドレスのキー 例： 'mac', 'mac_address'
+
+    Returns:
+        list: イベントのリスト、MACアドレスの順
+    """
+    if not diff:
+        return []
+
+    before = {}
+    for d in diff['delete']:
+        if d.get(mac_key):
+            before.setdefault(normalize_mac(d[mac_key]), d)
+
+    after = {}
+    for d in diff['add']:
+        if d.get(mac_key):
+            after.setdefault(normalize_mac(d[mac_key]), d)
+
+    timestamp = diff['timestamp_after']
+
+    events = []
+    for mac in sorted(before.keys() | after.keys()):
+        event = {'source': source_key, 'timestamp': timestamp, 'mac': mac}
+        if mac not in before:
+            event.update({'event': EVENT_JOIN, 'after': after[mac]})
+        elif mac not in after:
+            event.update({'event': EVENT_LEAVE, 'before': before[mac]})
+        else:
+            event.update({'event': EVENT_MOVE, 'before': before[mac], 'after': after[mac]})
+        events.append(event)
+
+    return events
+
+
+def publish_events(events:list, log_path:str=None):
+    """
+    イベントをファイルに追記し、登録されている関数を呼び出す
+
+    呼び出した関数で例外が起きてもスナップショットの格納は止めない
+
+    Args:
+        events (list): イベントのリスト
+        log_path (str, optional): 書き込むファイル. Defaults to EVENT_LOG_PATH.
+    """
+    if not events:
+        return
+
+    log_path = EVENT_LOG_PATH if log_path is None else log_path
+    if log_path:
+        data = ''.join(json.dumps(event) + '\n' for event in events).encode('utf-8')
+        while True:
+            fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # ロックを待つ間にファイルが切り替えられていたら開き直す
+                if _same_file(fd, log_path):
+                    os.write(fd, data)
+                    break
+            finally:
+                os.close(fd)
+
+    for callback in list(_subscribers):
+        for event in events:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.exception(f'event callback failed: {e}')
+
+
+def _same_file(fd:int, path:str) -> bool:
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def get_rotated_event_logs(log_path:str=None) -> list:
+    """
+    切り替えたファイルのパスの一覧を古い順で返却する
+    """
+    log_path = log_path or EVENT_LOG_PATH
+    if not log_path:
+        return []
+    log_dir = os.path.dirname(log_path) or '.'
+    prefix = os.path.basename(log_path) + '.'
+    if not os.path.isdir(log_dir):
+        return []
+    return [os.path.join(log_dir, name) for name in sorted(os.listdir(log_dir)) if name.startswith(prefix)]
+
+
+def rotate_event_log(max_age:float=None, now:float=None, log_path:str=None) -> list:
+    """
+    イベントのファイルを日時を付けた名前に変えて切り替え、古くなった切り替え済みのファイルを削除する
+
+    Args:
+        max_age (float, optional): 切り替えたファイルを残す秒数. Defaults to EVENT_LOG_DAYS.
+        now (float, optional): 現在時刻. Defaults to time.time().
+        log_path (str, optional): 切り替えるファイル. Defaults to EVENT_LOG_PATH.
+
+    Returns:
+        list: 削除したファイルのパスのリスト
+    """
+    log_path = log_path or EVENT_LOG_PATH
+    if not log_path:
+        return []
+    max_age = get_event_log_age() if max_age is None else max_age
+    now = now or time.time()
+
+    if os.path.exists(log_path) and os.path.getsize(log_path) > 0:
+        rotated_path = f"{log_path}.{datetime.fromtimestamp(now).strftime('%Y%m%d-%H%M%S')}"
+        fd = os.open(log_path, os.O_RDONLY)
+        try:
+            # 書き込み中のpublish_events()が終わるのを待ってから名前を変える
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if _same_file(fd, log_path) and not os.path.exists(rotated_path):
+                os.rename(log_path, rotated_path)
+                logger.info(f'{log_path}: rotated to {rotated_path}')
+        finally:
+            os.close(fd)
+
+    # 最後に書き込まれた時刻が残す期間を過ぎたものを削除する
+    deleted = []
+    for path in get_rotated_event_logs(log_path):
+        if os.path.getmtime(path) < now - max_age:
+            os.remove(path)
+            deleted.append(path)
+            logger.info(f'{path}: deleted')
+
+    return deleted
+
+
+def _read_lines(path:str, position:int) -> tuple:
+    events = []
+    with open(path, 'rb') as f:
+        f.seek(position)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            position += len(line)
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f'{path}: broken event skipped')
+    return events, position
+
+
+def get_event_log_end(log_path:str=None) -> tuple:
+    """
+    ファイルの末尾の位置を返却する、これから書き込まれるイベントだけを読みたいときにread_events()に渡す
+    """
+    log_path = log_path or EVENT_LOG_PATH
+    try:
+        st = os.stat(log_path)
+    except (FileNotFoundError, TypeError):
+        return 0
+    return (st.st_ino, st.st_size)
+
+
+def read_events(offset=0, log_path:str=None) -> tuple:
+    """
+    ファイルに書き込まれたイベントを指定した位置から読み込む
+
+    書き込み途中の最後の行は読まずに、次回その行から読めるように位置を返す。
+    前回読んだファイルが切り替えられていたら、切り替えたファイルの残りを読んでから新しいファイルを読む。
+
+    Args:
+        offset (tuple|int, optional): 読み始める位置、前回返された値を渡す. Defaults to 0.
+        log_path (str, optional): 読み込むファイル. Defaults to EVENT_LOG_PATH.
+
+    Returns:
+        tuple: (イベントのリスト, 次に読み始める位置)
+    """
+    log_path = log_path or EVENT_LOG_PATH
+
+    events = []
+    if not log_path or not os.path.exists(log_path):
+        return events, offset
+
+    # 以前の整数の位置は今のファイルの中の位置とみなす
+    if isinstance(offset, int):
+        inode, position = None, offset
+    else:
+        inode, position = offset
+
+    st = os.stat(log_path)
+    if inode is not None and inode != st.st_ino:
+        # 前回読んだファイルが切り替えられている
+        for path in get_rotated_event_logs(log_path):
+            if os.stat(path).st_ino == inode:
+                events, _ = _read_lines(path, position)
+                break
+        else:
+            logger.warning(f'{log_path}: rotated file not found, events may be lost')
+        position = 0
+
+    # ファイルが作り直されて短くなっていたら先頭から読む
+    if st.st_size < position:
+        position = 0
+
+    read, position = _read_lines(log_path, position)
+    events.extend(read)
+
+    return events, (st.st_ino, position)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+    import time
+
+    from datetime import datetime
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_events():
+        a = {'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}
+        b = {'ip': '192.168.122.107', 'mac': '04:03:D6:D8:57:5F'}
+        b2 = {'ip': '192.168.122.108', 'mac': '04:03:D6:D8:57:5F'}
+        c = {'ip': '192.168.122.109', 'mac': '3C:22:FB:7B:85:0E'}
+
+        diff = {'timestamp_before': 1.0, 'timestamp_after': 2.0, 'add': [b2, c], 'delete': [a, b]}
+        events = diff_events('dhcp', diff, 'mac')
+        assert [(EVENT_MOVE, b['mac']), (EVENT_LEAVE, a['mac']), (EVENT_JOIN, c['mac'])] == [(e['event'], e['mac']) for e in events]
+        assert [] == diff_events('dhcp', None, 'mac')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'events.jsonl')
+
+            received = []
+            subscribe(received.append)
+
+            @subscribe
+            def broken(event):
+                raise ValueError('broken callback')
+
+            publish_events(events, log_path=log_path)
+            unsubscribe(received.append)
+            unsubscribe(broken)
+            assert events == received
+
+            read, offset = read_events(log_path=log_path)
+            assert events == read
+
+            # 書き込み途中の行は次回に読む
+            with open(log_path, 'a') as f:
+                f.write('{"event": "jo')
+            assert ([], offset) == read_events(offset, log_path=log_path)
+
+            # 以前の整数の位置も受け付ける
+            assert events[1:] == read_events(len(json.dumps(events[0])) + 1, log_path=log_path)[0]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'events.jsonl')
+            day = 24 * 60 * 60
+            now = time.time()
+
+            publish_events(events[:1], log_path=log_path)
+            read, offset = read_events(log_path=log_path)
+            assert events[:1] == read
+
+            # 読み終わる前に切り替えられても、残りを読んでから新しいファイルを読む
+            publish_events(events[1:2], log_path=log_path)
+            assert [] == rotate_event_log(max_age=day, now=now - 2 * day, log_path=log_path)
+            assert not os.path.exists(log_path)
+            assert 1 == len(get_rotated_event_logs(log_path))
+            publish_events(events[2:], log_path=log_path)
+            read, offset = read_events(offset, log_path=log_path)
+            assert events[1:] == read
+            assert ([], offset) == read_events(offset, log_path=log_path)
+
+            # 空のファイルは切り替えない
+            open(log_path, 'w').close()
+            assert [] == rotate_event_log(max_age=day, now=now - day, log_path=log_path)
+            assert os.path.exists(log_path)
+            assert 1 == len(get_rotated_event_logs(log_path))
+
+            # 最後に書き込まれてから残す期間を過ぎたものを削除する
+            first = get_rotated_event_logs(log_path)[0]
+            os.utime(first, (now - 2 * day, now - 2 * day))
+            assert [first] == rotate_event_log(max_age=day, now=now, log_path=log_path)
+            assert [] == get_rotated_event_logs(log_path)
+
+            # 末尾からは新しいイベントだけを読む
+            publish_events(events[:1], log_path=log_path)
+            offset = get_event_log_end(log_path)
+            publish_events(events[1:2], log_path=log_path)
+            assert events[1:2] == read_events(offset, log_path=log_path)[0]
+
+        logger.info('test events pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-f', '--follow', action='store_true', default=False, help='print events as they are written')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_events()
+            return 0
+
+        if args.follow:
+            offset = get_event_log_end()
+            try:
+                while True:
+                    events, offset = read_events(offset)
+                    for event in events:
+                        dt = datetime.fromtimestamp(event['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+                        print(f"{dt} {event['event']:5} {event['source']} {event['mac']}")
+                    sys.stdout.flush()
+                    time.sleep(1)
+            except (BrokenPipeError, IOError):
+                sys.stderr.close()
+            except KeyboardInterrupt:
+                pass
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
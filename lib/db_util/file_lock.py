@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+#
+# データベースのファイルロック
+#
+# コレクタはそれぞれ別のプロセスで動いていて、同じdb.jsonを読み込んで書き戻している。
+# ロックなしで重なると片方の書き込みが失われるので、読み込んでから書き戻すまでの間は排他ロックを取る。
+#
+# ロックはdb.jsonと同じ場所のdb.json.lockに対してfcntl.flock()で取る。
+# プロセスが落ちればロックは自動的に解放される。
+# 同じプロセスの中で同じファイルのロックを重ねて取った場合は数えるだけにする。
+#
+# ロックを取っている間はファイルを読んで書くだけにして、装置からの採取などはロックの外で行うこと。
+#
+# 読むだけの場合はshared=Trueで共有ロックを取る。共有ロックどうしは重なってもよいので、
+# 読み込み同士は待たず、書き込みは読み込みが終わるのを待つだけになる。
+# 排他ロックを取っている間に同じファイルの共有ロックを取った場合は数えるだけにする。
+# 共有ロックから排他ロックへの格上げはflock()では不可分に行えないのでRuntimeErrorにする。
+#
+
+import fcntl
+import logging
+import os
+import time
+
+# ロックを待つ最大の秒数
+DEFAULT_LOCK_TIMEOUT = 60
+
+# ロックを取れるまで確認する間隔
+LOCK_POLL_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+# このプロセスが取っているロック {ロックファイルのパス: [fd, 回数, 排他ロックかどうか]}
+_held = {}
+
+
+class FileLock:
+    """
+    fcntl.flock()を使った排他ロック、または共有ロック
+
+    with FileLock('/path/to/db.json.lock'):
+        ...
+
+    Args:
+        lock_path (str): ロックファイルのパス
+        timeout (float, optional): ロックを待つ最大の秒数. Defaults to DEFAULT_LOCK_TIMEOUT.
+        shared (bool, optional): 読み込みだけのための共有ロックにするかどうか. Defaults to False.
+    """
+
+    def __init__(self, lock_path:str, timeout:float=DEFAULT_LOCK_TIMEOUT, shared:bool=False) -> None:
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self.shared = shared
+
+
+    def acquire(self):
+        held = _held.get(self.lock_path)
+        if held is not None:
+            if not self.shared and not held[2]:
+                raise RuntimeError(f'could not upgrade shared lock: {self.lock_path}')
+            held[1] += 1
+            return self
+
+        # シャードのディレクトリのようにまだ作られていない場合がある
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o664)
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise TimeoutError(f'could not lock {self.lock_path} in {self.timeout} seconds')
+                time.sleep(LOCK_POLL_INTERVAL)
+
+        _held[self.lock_path] = [fd, 1, not self.shared]
+        logger.debug(f'locked: {self.lock_path}')
+        return self
+
+
+    def release(self):
+        held = _held.get(self.lock_path)
+        if held is None:
+            return
+
+        held[1] -= 1
+        if held[1] > 0:
+            return
+
+        del _held[self.lock_path]
+        fcntl.flock(held[0], fcntl.LOCK_UN)
+        os.close(held[0])
+        logger.debug(f'unlocked: {self.lock_path}')
+
+
+    def __enter__(self):
+        return self.acquire()
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+if __name__ == '__main__':
+
+    import multiprocessing
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def increment(counter_path:str, lock_path:str, num:int):
+        for _ in range(num):
+            with FileLock(lock_path):
+                with open(counter_path) as f:
+                    value = int(f.read())
+                with open(counter_path, 'w') as f:
+                    f.write(str(value + 1))
+
+    def try_lock(lock_path:str, shared:bool, result):
+        # forkした親のロックは別のプロセスのものとして扱う
+        _held.clear()
+        try:
+            FileLock(lock_path, timeout=0.2, shared=shared).acquire()
+            result.put(True)
+        except TimeoutError:
+            result.put(False)
+
+    def test_file_lock():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            counter_path = os.path.join(tmp_dir, 'counter')
+            lock_path = counter_path + '.lock'
+            with open(counter_path, 'w') as f:
+                f.write('0')
+
+            # 複数のプロセスから同時に読んで書き戻しても失われない
+            procs = [multiprocessing.Process(target=increment, args=(counter_path, lock_path, 50)) for _ in range(4)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+
+            with open(counter_path) as f:
+                assert 200 == int(f.read())
+
+            # 同じプロセスの中では重ねて取れる
+            with FileLock(lock_path):
+                with FileLock(lock_path):
+                    pass
+                with FileLock(lock_path, shared=True):
+                    pass
+                assert lock_path in _held
+            assert lock_path not in _held
+
+            # 共有ロックは他のプロセスの共有ロックと重なってよいが、排他ロックとは重ならない
+            with FileLock(lock_path, shared=True):
+                # 共有ロックから排他ロックへは格上げしない
+                try:
+                    FileLock(lock_path).acquire()
+                    assert False
+                except RuntimeError:
+                    pass
+
+                ctx = multiprocessing.get_context('fork')
+                result = ctx.Queue()
+                for shared, expected in ((True, True), (False, False)):
+                    p = ctx.Process(target=try_lock, args=(lock_path, shared, result))
+                    p.start()
+                    p.join()
+                    assert expected == result.get(timeout=5)
+
+        logger.info('test file lock pass')
+
+    def main():
+        test_file_lock()
+        return 0
+
+    sys.exit(main())
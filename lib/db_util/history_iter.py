@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+#
+# 履歴を持つテーブルを新しい順に少しずつ取り出すイテレータ
+#
+# get_dhcp_clients_documents()などは全てのドキュメントを取り出してからソートしているので、
+# 最新の一つや直近の一日分だけが欲しい場合でも全件がメモリに載る。
+#
+# ここではまずタイムスタンプだけを取り出してソートし、二分探索で範囲を決めてから、
+# 新しい方からCHUNK_SIZE個ずつドキュメントを取り出して返す。
+#
+# for doc in iter_history_documents('PYATS', {'doc_type': 'mac_address_table'}, since=time.time() - 24*60*60):
+#     ...
+#
+
+import logging
+
+from bisect import bisect_left, bisect_right
+
+try:
+    from .db_session import open_db
+except ImportError:
+    from db_session import open_db
+
+# 一度に取り出すタイムスタンプの数
+CHUNK_SIZE = 24
+
+logger = logging.getLogger(__name__)
+
+
+def select_timestamps(timestamps:list, since:float=None, until:float=None, limit:int=None) -> list:
+    """
+    昇順のタイムスタンプから範囲に含まれるものを新しい順に返却する
+
+    Args:
+        timestamps (list): タイムスタンプのリスト、昇順
+        since (float, optional): これ以降、この値を含む. Defaults to None.
+        until (float, optional): これ以前、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
+
+    Returns:
+        list: タイムスタンプのリスト、降順
+    """
+    lo = bisect_left(timestamps, since) if since is not None else 0
+    hi = bisect_right(timestamps, until) if until is not None else len(timestamps)
+
+    selected = timestamps[lo:hi][::-1]
+    if limit is not None:
+        selected = selected[:limit]
+    return selected
+
+
+def get_sorted_timestamps(table_name:str, cond:dict=None) -> list:
+    """
+    条件に一致するドキュメントのタイムスタンプを重複なしの昇順で返却する
+    """
+    with open_db() as db:
+        return sorted(set(db.timestamps(table_name, cond)))
+
+
+def iter_history_documents(table_name:str, cond:dict=None, since:float=None, until:float=None, limit:int=None, chunk_size:int=CHUNK_SIZE):
+    """
+    ドキュメントを新しい順に返すジェネレータ
+
+    同じタイムスタンプのドキュメントが複数ある場合（装置ごとのPYATSなど）は全て返す。
+    limitはタイムスタンプの数で数える。
+
+    Args:
+        table_name (str): テーブル名
+        cond (dict, optional): 検索条件. Defaults to None.
+        since (float, optional): これ以降、この値を含む. Defaults to None.
+        until (float, optional): これ以前、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
+        chunk_size (int, optional): 一度に取り出すタイムスタンプの数. Defaults to CHUNK_SIZE.
+
+    Yields:
+        dict: ドキュメント
+    """
+    timestamps = select_timestamps(get_sorted_timestamps(table_name, cond), since=since, until=until, limit=limit)
+
+    for i in range(0, len(timestamps), chunk_size):
+        chunk = timestamps[i:i + chunk_size]
+
+        # ジェネレータを止めている間はデータベースを開いたままにしない
+        with open_db() as db:
+            docs = db.search(table_name, dict(cond or {}, timestamp=chunk))
+
+        yield from sorted(docs, key=lambda d: d['timestamp'], reverse=True)
+
+
+if __name__ == '__main__':
+
+    import os
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_history_iter():
+        try:
+            from db_session import DbSession
+        except ImportError:
+            from .db_session import DbSession
+
+        assert [3.0, 2.0] == select_timestamps([1.0, 2.0, 3.0, 4.0], since=2.0, until=3.0)
+        assert [4.0] == select_timestamps([1.0, 2.0, 3.0, 4.0], limit=1)
+        assert [] == select_timestamps([1.0, 2.0], since=5.0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                with open_db() as db:
+                    for i in range(10):
+                        db.insert('TEST', {'device_name': 'a', 'timestamp': float(i)})
+                        db.insert('TEST', {'device_name': 'b', 'timestamp': float(i)})
+
+                docs = list(iter_history_documents('TEST', {'device_name': 'a'}, since=3.0, chunk_size=4))
+                assert [float(i) for i in range(9, 2, -1)] == [d['timestamp'] for d in docs]
+
+                docs = list(iter_history_documents('TEST', limit=2))
+                assert [9.0, 9.0, 8.0, 8.0] == [d['timestamp'] for d in docs]
+
+        logger.info('test history iter pass')
+
+    def main():
+        test_history_iter()
+        return 0
+
+    sys.exit(main())
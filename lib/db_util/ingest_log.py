@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+#
+# コレクタの書き込みを受け付ける追記専用のログ
+#
+# コレクタは1時間に1回データベースのファイルを丸ごと読み込んで書き戻しているので、
+# 代わりにJSONLのログに1行追記するだけで済むようにする。
+#
+# ingest.jsonl
+# {"kind": "dhcp_clients", "timestamp": xxx, "doc_data": [...]}
+# {"kind": "wlc_clients", "timestamp": xxx, "doc_data": [...]}
+# {"kind": "mac_address_table", "timestamp": xxx, "device_name": xxx, "doc_data": {...}}
+#
+# 追記は1回のwrite()とfsync()で行う。書き込み途中で落ちた場合は最後の行が壊れるだけで、読み込むときに捨てる。
+#
+# ログはcompact_ingest_log()でデータベースに取り込む。
+# ログをリネームしてから取り込むので、その間にコレクタが追記しても新しいログに書かれる。
+# 履歴ごとにまとめてSnapshotTable.insert_many()で取り込む。
+# 取り込み済みのタイムスタンプは飛ばすので、途中で落ちても再実行すればよい。
+# 取り込みが終わったら保存期間のポリシーを一度だけ適用する。
+#
+# どちらに書き込むかは環境変数 DB_UTIL_INGEST_MODE で指定する（direct または log）。
+# logの場合はcronなどで定期的に python ingest_log.py -c を実行する。
+#
+
+import fcntl
+import json
+import logging
+import os
+
+try:
+    from .backend import DB_DIR
+    from .db_session import ensure_session
+    from .retention import RETENTION_MODE_SCHEDULED, get_retention_mode, set_retention_mode, run_retention
+    from .dhcp_clients_table import DHCP_CLIENTS_TABLE, insert_dhcp_clients, get_dhcp_clients_timestamps
+    from .wlc_clients_table import WLC_CLIENTS_TABLE, insert_wlc_clients
+    from .pyats_table import get_device_table, insert_device_mac_address_table
+except ImportError:
+    from backend import DB_DIR
+    from db_session import ensure_session
+    from retention import RETENTION_MODE_SCHEDULED, get_retention_mode, set_retention_mode, run_retention
+    from dhcp_clients_table import DHCP_CLIENTS_TABLE, insert_dhcp_clients, get_dhcp_clients_timestamps
+    from wlc_clients_table import WLC_CLIENTS_TABLE, insert_wlc_clients
+    from pyats_table import get_device_table, insert_device_mac_address_table
+
+# 書き込み先
+INGEST_MODE_DIRECT = 'direct'
+INGEST_MODE_LOG = 'log'
+
+INGEST_MODE = os.environ.get('DB_UTIL_INGEST_MODE', INGEST_MODE_DIRECT)
+
+# ログのファイル
+INGEST_LOG_PATH = os.path.join(DB_DIR, 'ingest.jsonl')
+
+# レコードの種類
+KIND_DHCP_CLIENTS = 'dhcp_clients'
+KIND_WLC_CLIENTS = 'wlc_clients'
+KIND_MAC_ADDRESS_TABLE = 'mac_address_table'
+
+logger = logging.getLogger(__name__)
+
+
+def set_ingest_mode(mode:str):
+    global INGEST_MODE
+
+    if mode not in (INGEST_MODE_DIRECT, INGEST_MODE_LOG):
+        raise ValueError(f'unknown ingest mode: {mode}')
+
+    INGEST_MODE = mode
+
+
+def append_records(records:list, log_path:str=None):
+    """
+    レコードをログに追記する
+
+    複数のレコードも1回のwrite()で書き込む。
+
+    Args:
+        records (list): レコードのリスト
+        log_path (str, optional): ログのファイル. Defaults to INGEST_LOG_PATH.
+    """
+    log_path = log_path or INGEST_LOG_PATH
+
+    data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+    while True:
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # ロックを待っている間に取り込みのためにリネームされていたら開き直す
+            try:
+                same_file = os.fstat(fd).st_ino == os.stat(log_path).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if not same_file:
+                continue
+
+            os.write(fd, data)
+            os.fsync(fd)
+            return
+        finally:
+            os.close(fd)
+
+
+def read_records(log_path:str) -> list:
+    """
+    ログからレコードを読み出す、壊れた行は捨てる
+
+    Args:
+        log_path (str): ログのファイル
+
+    Returns:
+        list: レコードのリスト
+    """
+    records = []
+
+    if not os.path.exists(log_path):
+        return records
+
+    with open(log_path, encoding='utf-8') as f:
+        for num, line in enumerate(f, start=1):
+            if not line.endswith('\n'):
+                # 書き込み途中で落ちた最後の行
+                logger.warning(f'{log_path}:{num}: incomplete record skipped')
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f'{log_path}:{num}: broken record skipped')
+
+    return records
+
+
+def ingest_dhcp_clients(dhcp_clients_list:list, timestamp:float):
+    """
+    DHCPクライアントの情報をログ、もしくはテーブルに書き込む
+    """
+    if INGEST_MODE == INGEST_MODE_LOG:
+        append_records([{'kind': KIND_DHCP_CLIENTS, 'timestamp': timestamp, 'doc_data': dhcp_clients_list}])
+    else:
+        insert_dhcp_clients(dhcp_clients_list=dhcp_clients_list, timestamp=timestamp)
+
+
+def ingest_wlc_clients(wlc_clients_list:list, timestamp:float):
+    """
+    WLCクライアントの情報をログ、もしくはテーブルに書き込む
+    """
+    if INGEST_MODE == INGEST_MODE_LOG:
+        append_records([{'kind': KIND_WLC_CLIENTS, 'timestamp': timestamp, 'doc_data': wlc_clients_list}])
+    else:
+        insert_wlc_clients(wlc_clients_list=wlc_clients_list, timestamp=timestamp)
+
+
+def ingest_mac_address_tables(mac_address_tables:dict, timestamp:float):
+    """
+    全装置分のMACアドレステーブルをログ、もしくはテーブルに書き込む
+
+    Args:
+        mac_address_tables (dict): 装置名をキーにしたparse()済みのMACアドレステーブル
+        timestamp (float): 実行した時点のタイムスタンプ
+    """
+    if INGEST_MODE == INGEST_MODE_LOG:
+        records = [{'kind': KIND_MAC_ADDRESS_TABLE, 'timestamp': timestamp, 'device_name': name, 'doc_data': parsed_data} for name, parsed_data in mac_address_tables.items()]
+        append_records(records)
+        return
+
+    # 全装置分をまとめて一回で書き込む
+    with ensure_session():
+        for name, parsed_data in mac_address_tables.items():
+            insert_device_mac_address_table(name, parsed_data, timestamp)
+
+
+def get_record_table(record:dict):
+    """
+    レコードを取り込むSnapshotTableを返却する、知らない種類はNone
+    """
+    kind = record.get('kind')
+
+    if kind == KIND_DHCP_CLIENTS:
+        return DHCP_CLIENTS_TABLE
+
+    if kind == KIND_WLC_CLIENTS:
+        return WLC_CLIENTS_TABLE
+
+    if kind == KIND_MAC_ADDRESS_TABLE:
+        return get_device_table(record['device_name'], 'mac_address_table')
+
+    return None
+
+
+def compact_ingest_log(log_path:str=None) -> int:
+    """
+    ログをテーブルに取り込み、保存期間のポリシーを適用する
+
+    Args:
+        log_path (str, optional): ログのファイル. Defaults to INGEST_LOG_PATH.
+
+    Returns:
+        int: 取り込んだレコードの数
+    """
+    log_path = log_path or INGEST_LOG_PATH
+    compacting_path = log_path + '.compacting'
+
+    # 前回途中で終わったものがあればそれを先に取り込む
+    if not os.path.exists(compacting_path):
+        if not os.path.exists(log_path):
+            return 0
+        os.rename(log_path, compacting_path)
+
+    # リネームする前に開いたコレクタが書き終わるのを待つ
+    with open(compacting_path, 'rb') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        records = read_records(compacting_path)
+
+        # 挿入のたびに削除せず、最後にまとめて適用する
+        retention_mode = get_retention_mode()
+        set_retention_mode(RETENTION_MODE_SCHEDULED)
+        try:
+            with ensure_session():
+                # 履歴ごとにまとめる
+                groups = {}
+                for record in records:
+                    table = get_record_table(record)
+                    if table is None:
+                        logger.warning(f"unknown record kind: {record.get('kind')}")
+                        continue
+                    key = (record.get('kind'), record.get('device_name'))
+                    groups.setdefault(key, (table, []))[1].append(record)
+
+                num_applied = 0
+                for table, group in groups.values():
+                    num_applied += table.insert_many(group)
+
+                run_retention()
+        finally:
+            set_retention_mode(retention_mode)
+
+    os.remove(compacting_path)
+
+    logger.info(f'{num_applied} of {len(records)} records compacted')
+    return num_applied
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_ingest_log():
+        try:
+            from db_session import DbSession
+        except ImportError:
+            from .db_session import DbSession
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'ingest.jsonl')
+
+            dhcp_clients_list = [{'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}]
+            append_records([{'kind': KIND_DHCP_CLIENTS, 'timestamp': 1.0, 'doc_data': dhcp_clients_list}], log_path=log_path)
+            append_records([{'kind': KIND_DHCP_CLIENTS, 'timestamp': 2.0, 'doc_data': dhcp_clients_list}], log_path=log_path)
+
+            # 書き込み途中で落ちた行
+            with open(log_path, 'a') as f:
+                f.write('{"kind": "dhcp_cli')
+
+            assert 2 == len(read_records(log_path))
+
+            with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                assert 2 == compact_ingest_log(log_path)
+                assert [2.0, 1.0] == get_dhcp_clients_timestamps()
+                assert not os.path.exists(log_path)
+
+                # 途中で落ちた取り込みをやり直しても重複しない
+                append_records([{'kind': KIND_DHCP_CLIENTS, 'timestamp': 2.0, 'doc_data': dhcp_clients_list}], log_path=log_path + '.compacting')
+                assert 0 == compact_ingest_log(log_path)
+                assert [2.0, 1.0] == get_dhcp_clients_timestamps()
+
+        logger.info('test ingest log pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-c', '--compact', action='store_true', default=False, help='fold ingest log into the database')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_ingest_log()
+            return 0
+
+        if args.compact:
+            compact_ingest_log()
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
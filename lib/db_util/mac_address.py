@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+#
+# MACアドレス型
+#
+# MACアドレスは取り込み元によって表記がばらばら。
+#
+#   DHCPクライアント        AA:BB:CC:DD:EE:FF
+#   WLCクライアント          aa:bb:cc:dd:ee:ff
+#   Catalystのmac_address   aabb.ccdd.eeff
+#   radacctのUser-Name      aa-bb-cc-dd-ee-ff
+#   known_devices.yaml      大文字小文字が混在
+#
+# MacAddressは48ビットの整数を一つだけ持つ型で、比較とハッシュは整数で行う。
+# 文字列からの変換は結果を覚えておくので、同じ文字列を何度変換しても二回目以降は辞書を引くだけになる。
+# 文字列にするときもAA:BB:CC:DD:EE:FFの形式を覚えておくので、ループの中で文字列を作り直さない。
+#
+
+import os
+
+from functools import lru_cache, total_ordering
+
+# 変換結果を覚えておく数
+MAC_CACHE_SIZE = int(os.environ.get('DB_UTIL_MAC_CACHE_SIZE', '65536'))
+
+# MACアドレスの最大値
+MAC_MAX = (1 << 48) - 1
+
+# 区切り文字を取り除くための変換表
+_SEPARATORS = str.maketrans('', '', ':-.')
+
+# 16進数で使える文字
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+
+@lru_cache(maxsize=MAC_CACHE_SIZE)
+def parse_mac_int(mac_address:str) -> int:
+    """
+    'AA:BB:CC:DD:EE:FF'、'aa-bb-cc-dd-ee-ff'、'aabb.ccdd.eeff'、'aabbccddeeff'を48ビットの整数にする
+
+    Args:
+        mac_address (str): MACアドレス
+
+    Returns:
+        int: 48ビットの整数
+
+    Raises:
+        ValueError: MACアドレスとして解釈できない場合
+    """
+    digits = mac_address.translate(_SEPARATORS)
+    if len(digits) != 12 or not _HEX_DIGITS.issuperset(digits):
+        raise ValueError(f'invalid mac address: {mac_address!r}')
+    return int(digits, 16)
+
+
+@lru_cache(maxsize=MAC_CACHE_SIZE)
+def format_mac(value:int) -> str:
+    """
+    48ビットの整数をAA:BB:CC:DD:EE:FFの形式の文字列にする
+    """
+    digits = f'{value:012X}'
+    return ':'.join((digits[0:2], digits[2:4], digits[4:6], digits[6:8], digits[8:10], digits[10:12]))
+
+
+@total_ordering
+class MacAddress:
+    """
+    48ビットの整数で表したMACアドレス
+
+    変更しない前提で辞書のキーや集合の要素に使う。
+    文字列とは等しくならないので、文字列と比べるときはparse_mac()で変換してから比べる。
+
+    Args:
+        mac_address (str|int|MacAddress): MACアドレス
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, mac_address) -> None:
+        if isinstance(mac_address, MacAddress):
+            value = mac_address.value
+        elif isinstance(mac_address, int):
+            if not 0 <= mac_address <= MAC_MAX:
+                raise ValueError(f'invalid mac address: {mac_address!r}')
+            value = mac_address
+        else:
+            value = parse_mac_int(mac_address)
+        self.value = value
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, MacAddress):
+            return self.value == other.value
+        return NotImplemented
+
+    def __lt__(self, other) -> bool:
+        if isinstance(other, MacAddress):
+            return self.value < other.value
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.value)
+
+    def __int__(self) -> int:
+        return self.value
+
+    def __str__(self) -> str:
+        return format_mac(self.value)
+
+    def __repr__(self) -> str:
+        return f"MacAddress('{format_mac(self.value)}')"
+
+    @property
+    def oui(self) -> int:
+        """
+        先頭24ビットのベンダーコード
+        """
+        return self.value >> 24
+
+    @property
+    def is_locally_administered(self) -> bool:
+        """
+        先頭オクテットのU/Lビットが1のローカルアドレス（プライベートMACアドレス）かどうか
+        """
+        return bool(self.value & (0x02 << 40))
+
+    @property
+    def is_multicast(self) -> bool:
+        """
+        先頭オクテットのI/Gビットが1のマルチキャストアドレスかどうか
+        """
+        return bool(self.value & (0x01 << 40))
+
+    def dotted(self) -> str:
+        """
+        Ciscoのドット表記 aabb.ccdd.eeff
+        """
+        digits = f'{self.value:012x}'
+        return f'{digits[0:4]}.{digits[4:8]}.{digits[8:12]}'
+
+    def hyphen(self) -> str:
+        """
+        radacctのUser-Nameと同じ小文字のハイフン区切り aa-bb-cc-dd-ee-ff
+        """
+        return format_mac(self.value).lower().replace(':', '-')
+
+
+@lru_cache(maxsize=MAC_CACHE_SIZE)
+def parse_mac(mac_address:str) -> MacAddress:
+    """
+    文字列をMacAddressにする
+
+    同じ文字列には同じインスタンスを返すので、ループの中で何度呼んでも新しいオブジェクトは作らない。
+
+    Args:
+        mac_address (str): MACアドレス
+
+    Returns:
+        MacAddress: MACアドレス
+
+    Raises:
+        ValueError: MACアドレスとして解釈できない場合
+    """
+    return MacAddress(mac_address)
+
+
+def to_mac(mac_address) -> MacAddress:
+    """
+    文字列、整数、MacAddressのどれでもMacAddressにする、解釈できなければNone
+
+    Args:
+        mac_address (str|int|MacAddress): MACアドレス
+
+    Returns:
+        MacAddress: MACアドレス、解釈できなければNone
+    """
+    if isinstance(mac_address, MacAddress):
+        return mac_address
+    try:
+        if isinstance(mac_address, str):
+            return parse_mac(mac_address)
+        return MacAddress(mac_address)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import timeit
+
+    def test_parse():
+        expected = MacAddress('28:84:FA:EA:5F:0C')
+        for text in ['28:84:FA:EA:5F:0C', '28:84:fa:ea:5f:0c', '28-84-fa-ea-5f-0c', '2884.faea.5f0c', '2884FAEA5F0C']:
+            assert expected == parse_mac(text), text
+            assert hash(expected) == hash(parse_mac(text))
+        assert 0x2884FAEA5F0C == int(expected)
+        assert '28:84:FA:EA:5F:0C' == str(expected)
+        assert '2884.faea.5f0c' == expected.dotted()
+        assert '28-84-fa-ea-5f-0c' == expected.hyphen()
+        assert 0x2884FA == expected.oui
+        assert MacAddress(expected) == expected
+        assert MacAddress(0x2884FAEA5F0C) == expected
+
+        # 同じ文字列からは同じインスタンス
+        assert parse_mac('2884.faea.5f0c') is parse_mac('2884.faea.5f0c')
+
+        # 文字列とは等しくならない
+        assert expected != '28:84:FA:EA:5F:0C'
+
+        # 集合と辞書
+        known = {parse_mac('28:84:fa:ea:5f:0c'), parse_mac('04-03-D6-D8-57-5F')}
+        assert parse_mac('0403.d6d8.575f') in known
+        assert parse_mac('00:00:5E:00:01:01') not in known
+
+        # 並び順は整数の順
+        assert sorted([parse_mac('ff:00:00:00:00:00'), parse_mac('00:00:00:00:00:01')]) == [MacAddress(1), MacAddress(0xFF0000000000)]
+
+        # ローカルアドレスとマルチキャスト
+        assert parse_mac('f6:ff:cc:5f:51:68').is_locally_administered
+        assert not expected.is_locally_administered
+        assert parse_mac('01:00:5e:00:00:01').is_multicast
+
+        # 解釈できないもの
+        for text in ['', 'N/A', '28:84:FA:EA:5F', '28:84:FA:EA:5F:0G', '28:84:FA:EA:5F:0C:00', ' 2884faea5f0c', '2884_faea_5f0']:
+            try:
+                parse_mac(text)
+                assert False, text
+            except ValueError:
+                pass
+        for value in [-1, MAC_MAX + 1]:
+            try:
+                MacAddress(value)
+                assert False, value
+            except ValueError:
+                pass
+        assert to_mac('N/A') is None
+        assert to_mac(None) is None
+        assert to_mac('2884.faea.5f0c') == expected
+        assert to_mac(expected) is expected
+
+        print('all tests passed')
+
+
+    def bench_parse():
+        texts = [f'{i:012x}' for i in range(1000)]
+        texts = [f'{t[0:4]}.{t[4:8]}.{t[8:12]}' for t in texts]
+
+        def adhoc():
+            for t in texts:
+                m = t.replace('.', '')
+                ':'.join(m[i:i+2] for i in range(0, 12, 2)).upper()
+
+        def cached():
+            for t in texts:
+                str(parse_mac(t))
+
+        cached()
+        print(f'adhoc  : {min(timeit.repeat(adhoc, number=100, repeat=3)):.3f} sec')
+        print(f'cached : {min(timeit.repeat(cached, number=100, repeat=3)):.3f} sec')
+
+
+    def main():
+        parser = argparse.ArgumentParser(description='mac address type')
+        parser.add_argument('-t', '--test', action='store_true', default=False, help='test')
+        parser.add_argument('-b', '--bench', action='store_true', default=False, help='benchmark')
+        args = parser.parse_args()
+
+        if args.test:
+            test_parse()
+            return 0
+
+        if args.bench:
+            bench_parse()
+            return 0
+
+        parser.print_help()
+        return 0
+
+
+    sys.exit(main())
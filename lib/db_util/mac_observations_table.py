@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+#
+# MACアドレスの観測インデックス
+#
+# DHCP_CLIENTS, WLC_CLIENTS, PYATS(mac_address_table)の各スナップショットから、
+# どのMACアドレスを、いつ、どこで見たか、をMACアドレスをキーにして保存する。
+#
+# 毎時のスナップショットをそのまま並べるとMACアドレスを一つ探すのに全履歴を走査することになるので、
+# 属性(ip, device, interface, ap_name, ssid)が変わらずに連続して観測されている間は一つの区間にまとめる。
+#
+# {
+#     'mac': 'AA:BB:CC:DD:EE:FF',
+#     'observations': [
+#         {'source': 'dhcp', 'ip': '192.168.122.106', 'first_seen': 1668000000.0, 'last_seen': 1668003600.0},
+#         {'source': 'wlc', 'ip': '192.168.122.106', 'ap_name': 'taka-AP1815I', 'ssid': 'taka 11ac', 'first_seen': ..., 'last_seen': ...},
+#         {'source': 'mac_address_table', 'device': 'c3560c-12pc-s', 'interface': 'FastEthernet0/7', 'first_seen': ..., 'last_seen': ...}
+#     ]
+# }
+#
+# 区間が連続していることを判定するため、取り込み元ごとに直前のスナップショットのタイムスタンプを別テーブルに保存する。
+#
+# { 'source': 'dhcp', 'timestamp': 1668003600.0 }
+# { 'source': 'mac_address_table/c3560c-12pc-s', 'timestamp': 1668003600.0 }
+#
+
+import bisect
+import logging
+
+try:
+    from .db_session import open_db, ensure_session
+    from .mac_address import format_mac, parse_mac_int
+except ImportError:
+    from db_session import open_db, ensure_session
+    from mac_address import format_mac, parse_mac_int
+
+# テーブルの種類
+TABLE_MAC_OBSERVATIONS = 'MAC_OBSERVATIONS'
+TABLE_MAC_OBSERVATIONS_STATE = 'MAC_OBSERVATIONS_STATE'
+
+# 取り込み元
+SOURCE_DHCP = 'dhcp'
+SOURCE_WLC = 'wlc'
+SOURCE_MAC_ADDRESS_TABLE = 'mac_address_table'
+
+# 区間をまとめるときに比較する属性
+OBSERVATION_FIELDS = ('source', 'ip', 'device', 'interface', 'ap_name', 'ssid')
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_mac(mac_address:str) -> str:
+    """
+    MACアドレスをAA:BB:CC:DD:EE:FFの形式にする
+
+    Ciscoのドット表記(0000.5e00.0101)、ハイフン区切り、区切りなしにも対応する。
+    変換はmac_addressモジュールで覚えておくので、同じ文字列なら二回目以降は文字列を作らない。
+
+    Args:
+        mac_address (str): MACアドレス
+
+    Returns:
+        str: AA:BB:CC:DD:EE:FFの形式の文字列、MACアドレスとして解釈できなければ大文字にしただけの文字列
+    """
+    try:
+        return format_mac(parse_mac_int(mac_address))
+    except ValueError:
+        return mac_address.upper()
+
+
+def get_source_key(source:str, device_name:str=None) -> str:
+    """
+    直前のタイムスタンプを管理する単位のキー
+
+    mac_address_tableは装置ごとに取り込むので装置名を付ける
+    """
+    if device_name:
+        return f'{source}/{device_name}'
+    return source
+
+
+def dhcp_observations(dhcp_clients_list:list) -> list:
+    # [ {'ip': a.b.c.d, 'mac': AA:BB:CC:DD:EE:FF}, {}, {}]
+    results = []
+    for d in dhcp_clients_list:
+        mac = d.get('mac')
+        if not mac:
+            continue
+        results.append({'mac': normalize_mac(mac), 'source': SOURCE_DHCP, 'ip': d.get('ip', '')})
+    return results
+
+
+def wlc_observations(wlc_clients_list:list) -> list:
+    # [ {'mac_address': 'fe:dd:b8:3f:de:59', 'ip_address': ..., 'ap_name': ..., 'wireless_lan_network_name': ...}, {}, {}]
+    results = []
+    for d in wlc_clients_list:
+        mac = d.get('mac_address')
+        if not mac:
+            continue
+        results.append({
+            'mac': normalize_mac(mac),
+            'source': SOURCE_WLC,
+            'ip': d.get('ip_address', ''),
+            'ap_name': d.get('ap_name', ''),
+            'ssid': d.get('wireless_lan_network_name', '')
+        })
+    return results
+
+
+def mac_address_table_observations(device_name:str, mac_address_table:dict) -> list:
+    # {'mac_table': {'vlans': {'1': {'mac_addresses': {'0000.5e00.0101': {'interfaces': {'FastEthernet0/7': {'entry_type': 'dynamic',
+    #                                                                                                       'interface': 'FastEthernet0/7'}},
+    #                                                                     'mac_address': '0000.5e00.0101'},
+    results = []
+    vlans = mac_address_table.get('mac_table', {}).get('vlans', {})
+    for vlan in vlans.values():
+        for mac_addr, d in vlan.get('mac_addresses', {}).items():
+            for intf in d.get('interfaces', {}).keys():
+                results.append({
+                    'mac': normalize_mac(mac_addr),
+                    'source': SOURCE_MAC_ADDRESS_TABLE,
+                    'device': device_name,
+                    'interface': intf
+                })
+    return results
+
+
+def _same_attributes(a:dict, b:dict) -> bool:
+    for k in OBSERVATION_FIELDS:
+        if a.get(k) != b.get(k):
+            return False
+    return True
+
+
+def has_mac_observations(source_key:str) -> bool:
+    """
+    取り込み元のインデックスが作成済みかどうか
+    """
+    with open_db() as db:
+        return db.get(TABLE_MAC_OBSERVATIONS_STATE, {'source': source_key}) is not None
+
+
+def get_mac_observations_sources() -> list:
+    """
+    インデックスが作成済みの取り込み元のキーの一覧
+    """
+    with open_db() as db:
+        return [doc['source'] for doc in db.all(TABLE_MAC_OBSERVATIONS_STATE)]
+
+
+def update_mac_observations(source_key:str, timestamp:float, observations:list):
+    """
+    一つのスナップショットから取り出した観測情報をインデックスに反映する
+
+    同じ属性で直前のスナップショットでも観測されていれば、その区間のlast_seenを延ばす。
+    そうでなければ新しい区間を追加する。
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        timestamp (float): スナップショットのタイムスタンプ
+        observations (list): dhcp_observations()などで作成した観測情報のリスト
+    """
+    by_mac = {}
+    for o in observations:
+        by_mac.setdefault(o['mac'], []).append(o)
+
+    with ensure_session():
+        with open_db() as db:
+            state = db.get(TABLE_MAC_OBSERVATIONS_STATE, {'source': source_key})
+            prev_timestamp = state['timestamp'] if state else None
+
+            # 古いスナップショットを後から取り込むことはしない
+            if prev_timestamp is not None and timestamp <= prev_timestamp:
+                return
+
+            docs = {}
+            if by_mac:
+                docs = {doc['mac']: doc for doc in db.search(TABLE_MAC_OBSERVATIONS, {'mac': list(by_mac.keys())})}
+
+            updated = []
+            for mac, obs_list in by_mac.items():
+                doc = docs.get(mac, {'mac': mac, 'observations': []})
+                runs = [dict(run) for run in doc['observations']]
+
+                for o in obs_list:
+                    for run in runs:
+                        if run['last_seen'] == prev_timestamp and _same_attributes(run, o):
+                            # 直前から継続して観測されている
+                            run['last_seen'] = timestamp
+                            break
+                        if run['last_seen'] == timestamp and _same_attributes(run, o):
+                            # 同じスナップショットの中で重複している
+                            break
+                    else:
+                        run = {k: o[k] for k in OBSERVATION_FIELDS if o.get(k) is not None}
+                        run['first_seen'] = timestamp
+                        run['last_seen'] = timestamp
+                        runs.append(run)
+
+                updated.append({'mac': mac, 'observations': runs})
+
+            if updated:
+                db.remove(TABLE_MAC_OBSERVATIONS, {'mac': [d['mac'] for d in updated]})
+                db.insert_multiple(TABLE_MAC_OBSERVATIONS, updated)
+
+            db.remove(TABLE_MAC_OBSERVATIONS_STATE, {'source': source_key})
+            db.insert(TABLE_MAC_OBSERVATIONS_STATE, {'source': source_key, 'timestamp': timestamp})
+
+
+def prune_mac_observations(source_key:str, deleted_until:float):
+    """
+    保存期間を過ぎたスナップショットにしか現れない区間を削除する
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        deleted_until (float): 削除したスナップショットのうち一番新しいもののタイムスタンプ
+    """
+    with open_db() as db:
+        changed = []
+        emptied = []
+        for doc in db.all(TABLE_MAC_OBSERVATIONS):
+            runs = [run for run in doc['observations']
+                    if run['last_seen'] > deleted_until or get_source_key(run['source'], run.get('device')) != source_key]
+            if len(runs) == len(doc['observations']):
+                continue
+            if runs:
+                changed.append({'mac': doc['mac'], 'observations': runs})
+            else:
+                emptied.append(doc['mac'])
+
+        if changed or emptied:
+            db.remove(TABLE_MAC_OBSERVATIONS, {'mac': [d['mac'] for d in changed] + emptied})
+            if changed:
+                db.insert_multiple(TABLE_MAC_OBSERVATIONS, changed)
+
+
+def drop_mac_observations(source_key:str):
+    """
+    取り込み元のインデックスを削除する、次に参照したときに作り直される
+    """
+    with open_db() as db:
+        db.remove(TABLE_MAC_OBSERVATIONS_STATE, {'source': source_key})
+
+    prune_mac_observations(source_key, float('inf'))
+
+
+def rebuild_mac_observations(source_key:str, docs:list, extract:callable):
+    """
+    スナップショットの履歴からインデックスを作り直す
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        docs (list): timestampキーを持つスナップショットのリスト
+        extract (callable): スナップショットから観測情報のリストを取り出す関数
+    """
+    with ensure_session():
+        drop_mac_observations(source_key)
+        for doc in sorted(docs, key=lambda d: d['timestamp']):
+            update_mac_observations(source_key, doc['timestamp'], extract(doc))
+
+    logger.info(f'mac observations rebuilt: {source_key} {len(docs)} snapshots')
+
+
+def get_mac_observations(mac_address:str, source:str=None, device_name:str=None) -> list:
+    """
+    MACアドレスを観測した区間を新しい順に返却する
+
+    Args:
+        mac_address (str): MACアドレス、形式は問わない
+        source (str, optional): 取り込み元で絞り込む. Defaults to None.
+        device_name (str, optional): 装置名で絞り込む. Defaults to None.
+
+    Returns:
+        list: 区間のリスト [{'source': ..., 'first_seen': ..., 'last_seen': ..., ...}]
+    """
+    with open_db() as db:
+        doc = db.get(TABLE_MAC_OBSERVATIONS, {'mac': normalize_mac(mac_address)})
+
+    if doc is None:
+        return []
+
+    runs = doc['observations']
+    if source is not None:
+        runs = [run for run in runs if run['source'] == source]
+    if device_name is not None:
+        runs = [run for run in runs if run.get('device') == device_name]
+
+    return sorted(runs, key=lambda run: run['last_seen'], reverse=True)
+
+
+def expand_observations(runs:list, timestamps:list) -> list:
+    """
+    区間をスナップショットのタイムスタンプに展開する
+
+    Args:
+        runs (list): get_mac_observations()で得た区間のリスト
+        timestamps (list): スナップショットのタイムスタンプのリスト
+
+    Returns:
+        list: (timestamp, 区間) のタプルのリスト、タイムスタンプの昇順
+    """
+    timestamps = sorted(timestamps)
+    results = []
+    for run in runs:
+        start = bisect.bisect_left(timestamps, run['first_seen'])
+        end = bisect.bisect_right(timestamps, run['last_seen'])
+        for ts in timestamps[start:end]:
+            results.append((ts, run))
+    results.sort(key=lambda x: x[0])
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import os
+    import sys
+    import tempfile
+
+    from datetime import datetime
+    from pprint import pprint
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_mac_observations():
+        try:
+            from backend import BACKEND_TINYDB
+            from db_session import DbSession
+        except ImportError:
+            from .backend import BACKEND_TINYDB
+            from .db_session import DbSession
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'db.json')
+            with DbSession(db_path=db_path, backend=BACKEND_TINYDB):
+                snapshots = [
+                    (1.0, [{'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}]),
+                    (2.0, [{'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}]),
+                    (3.0, []),
+                    (4.0, [{'ip': '192.168.122.107', 'mac': '28:84:FA:EA:5F:0C'}]),
+                ]
+                for ts, clients in snapshots:
+                    update_mac_observations(SOURCE_DHCP, ts, dhcp_observations(clients))
+
+                runs = get_mac_observations('2884.faea.5f0c')
+                assert [(4.0, 4.0), (1.0, 2.0)] == [(run['first_seen'], run['last_seen']) for run in runs]
+
+                expanded = expand_observations(runs, [1.0, 2.0, 3.0, 4.0])
+                assert [1.0, 2.0, 4.0] == [ts for ts, _ in expanded]
+
+                prune_mac_observations(SOURCE_DHCP, 2.0)
+                assert 1 == len(get_mac_observations('28:84:fa:ea:5f:0c'))
+
+        logger.info('test mac observations pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-s', '--search', dest='search', help='search mac address', type=str)
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_mac_observations()
+            return 0
+
+        if args.search:
+            for run in get_mac_observations(args.search):
+                run = dict(run)
+                run['first_seen'] = datetime.fromtimestamp(run['first_seen']).strftime('%Y-%m-%d %H:%M:%S')
+                run['last_seen'] = datetime.fromtimestamp(run['last_seen']).strftime('%Y-%m-%d %H:%M:%S')
+                pprint(run)
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+#
+# MACベンダー検索のベンチマークと答え合わせ
+#
+# ベンダーの検索には次の実装があるので、同じMACアドレスの集合を全てに流して、
+# 速さと、総当たりで求めた正解（一番長く一致したベンダーコード）との食い違いを比べる。
+#
+#   db_equality         _search_mac_vendors()       MA-S MA-M MA-Lの順にデータベースを一致検索する
+#   prefix_index        get_mac_vendors_index()     ベンダーコードの長さごとの辞書
+#   binary_file         MacVendorsFile.search()     mmapしたバイナリファイルを二分探索
+#   binary_file_many    MacVendorsFile.search_many() まとめて検索
+#   search              search_mac_vendors()        キャッシュ付き、最初はキャッシュが空の状態で測る
+#   search_many         search_mac_vendors_many()   キャッシュ付き、まとめて検索
+#   list_of_dict        search_list_of_dict()       ソートしたリストを前方一致で二分探索（collect_mac_vendors.py -s）
+#
+# db_equalityは一回の検索でテーブルを全て調べるので遅い。そのため一部のMACアドレスだけで測る。
+#
+# 合成したベンダー情報で測る
+# python mac_vendors_bench.py -b
+# python mac_vendors_bench.py -b --macs 100000 --private 0.5
+#
+# 本番のデータベースのコピーにあるベンダー情報で測る
+# python mac_vendors_bench.py -b --db /path/to/db.json
+#
+
+import logging
+import os
+import random
+import tempfile
+import time
+
+try:
+    from .backend import get_backend_name, get_default_db_path
+    from .db_session import DbSession
+    from .dictfilter import search_list_of_dict
+    from .mac_vendors_file import open_mac_vendors_file, write_mac_vendors_file
+    from .mac_vendors_table import PREFIX_LENGTHS, insert_mac_vendors, get_mac_vendors_all, get_mac_vendors_timestamp
+    from .mac_vendors_table import _search_mac_vendors, get_mac_vendors_index, clear_mac_vendors_index, search_mac_vendors, search_mac_vendors_many
+    from .stats import copy_database
+except ImportError:
+    from backend import get_backend_name, get_default_db_path
+    from db_session import DbSession
+    from dictfilter import search_list_of_dict
+    from mac_vendors_file import open_mac_vendors_file, write_mac_vendors_file
+    from mac_vendors_table import PREFIX_LENGTHS, insert_mac_vendors, get_mac_vendors_all, get_mac_vendors_timestamp
+    from mac_vendors_table import _search_mac_vendors, get_mac_vendors_index, clear_mac_vendors_index, search_mac_vendors, search_mac_vendors_many
+    from stats import copy_database
+
+# 合成するベンダー情報の既定値
+DEFAULT_NUM_MA_L = 30000
+DEFAULT_NUM_MA_M = 5000
+DEFAULT_NUM_MA_S = 6000
+
+# 検索するMACアドレスの既定値
+DEFAULT_NUM_MACS = 20000
+DEFAULT_PRIVATE_RATIO = 0.3
+
+# db_equalityで使うMACアドレスの数
+DEFAULT_SLOW_SAMPLE = 100
+
+# IEEEがMA-MとMA-Sを割り当てるために持っているMA-L
+IEEE_VENDOR_NAME = 'IEEE Registration Authority'
+
+logger = logging.getLogger(__name__)
+
+
+def make_synthetic_vendors(num_ma_l:int=DEFAULT_NUM_MA_L, num_ma_m:int=DEFAULT_NUM_MA_M, num_ma_s:int=DEFAULT_NUM_MA_S, seed:int=0) -> list:
+    """
+    maclookup.appのダンプに似たベンダー情報を作る
+
+    MA-MとMA-Sは実際と同じくIEEEのMA-Lの中に割り当てる。
+    U/Lビットが1のCIDも少し混ぜる。
+
+    Returns:
+        list: [{'macPrefix': xxx, 'vendorName': xxx, 'private': False, 'blockType': xxx}, ...] macPrefixの順
+    """
+    rnd = random.Random(seed)
+
+    def octets(value:int, digits:int) -> str:
+        h = f'{value:0{digits}X}'
+        return ':'.join(h[i:i + 2] for i in range(0, digits, 2))
+
+    used = set()
+
+    def new_oui(local:bool=False) -> int:
+        while True:
+            oui = rnd.randrange(0, 1 << 24)
+            # 先頭オクテットのマルチキャストビットは0、U/Lビットは指定通り
+            oui = (oui & ~(0x01 << 16)) & ~(0x02 << 16)
+            if local:
+                oui |= 0x02 << 16
+            if oui not in used:
+                used.add(oui)
+                return oui
+
+    vendors = []
+    for i in range(num_ma_l):
+        vendors.append({'macPrefix': octets(new_oui(), 6), 'vendorName': f'Vendor L{i % (num_ma_l // 3 + 1)}', 'private': False, 'blockType': 'MA-L'})
+
+    for i in range(max(1, num_ma_l // 1000)):
+        vendors.append({'macPrefix': octets(new_oui(local=True), 6), 'vendorName': f'Vendor CID{i}', 'private': False, 'blockType': 'CID'})
+
+    def ieee_blocks(num:int, bits:int, block_type:str, name:str):
+        # 一つのMA-Lの中に 2^(bits-24) 個まで割り当てられる
+        per_oui = 1 << (bits - 24)
+        remaining = num
+        while remaining > 0:
+            oui = new_oui()
+            vendors.append({'macPrefix': octets(oui, 6), 'vendorName': IEEE_VENDOR_NAME, 'private': False, 'blockType': 'MA-L'})
+            count = min(remaining, per_oui)
+            for sub in rnd.sample(range(per_oui), count):
+                prefix = octets(oui, 6) + ':' + f'{sub:0{(bits - 24) // 4}X}'
+                if bits == 36:
+                    prefix = prefix[:11] + ':' + prefix[11:]
+                vendors.append({'macPrefix': prefix, 'vendorName': f'{name}{len(vendors)}', 'private': False, 'blockType': block_type})
+            remaining -= count
+
+    ieee_blocks(num_ma_m, 28, 'MA-M', 'Vendor M')
+    ieee_blocks(num_ma_s, 36, 'MA-S', 'Vendor S')
+
+    return sorted(vendors, key=lambda d: d['macPrefix'])
+
+
+def expected_vendor_names(vendors:list, mac_addresses:list) -> list:
+    """
+    総当たりで正解を求める、一番長く一致したベンダーコードのベンダー名
+
+    Returns:
+        list: 入力と同じ順番のベンダー名のリスト、一致しなければNone
+    """
+    by_prefix = {}
+    for d in vendors:
+        by_prefix.setdefault(d['macPrefix'].upper(), d['vendorName'])
+
+    results = []
+    for mac_address in mac_addresses:
+        mac_address = mac_address.upper()
+        name = None
+        for n in PREFIX_LENGTHS:
+            if mac_address[:n] in by_prefix:
+                name = by_prefix[mac_address[:n]]
+                break
+        results.append(name)
+    return results
+
+
+def make_workload(vendors:list, num_macs:int=DEFAULT_NUM_MACS, private_ratio:float=DEFAULT_PRIVATE_RATIO, seed:int=0) -> list:
+    """
+    検索するMACアドレスを作る
+
+    ベンダーコードに一致するもの（MA-L MA-M MA-S）、どれにも一致しないもの、ローカルアドレス（プライベートMACアドレス）を混ぜる。
+    同じMACアドレスが何度も現れるのはanalyze.pyと同じ。
+
+    Returns:
+        list: 'AA:BB:CC:DD:EE:FF'形式のMACアドレスのリスト
+    """
+    rnd = random.Random(seed)
+
+    def from_prefix(prefix:str) -> str:
+        digits = prefix.replace(':', '')
+        digits += ''.join(rnd.choice('0123456789ABCDEF') for _ in range(12 - len(digits)))
+        return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+    def random_mac(local:bool) -> str:
+        first = rnd.randrange(0, 256) & ~0x01
+        first = first | 0x02 if local else first & ~0x02
+        return ':'.join([f'{first:02X}'] + [f'{rnd.randrange(0, 256):02X}' for _ in range(5)])
+
+    prefixes = [d['macPrefix'] for d in vendors]
+
+    # 全体の半分くらいは同じMACアドレスの繰り返しにする
+    distinct = []
+    for _ in range(max(1, num_macs // 2)):
+        r = rnd.random()
+        if r < private_ratio:
+            distinct.append(random_mac(local=True))
+        elif r < private_ratio + 0.05:
+            distinct.append(random_mac(local=False))
+        else:
+            distinct.append(from_prefix(rnd.choice(prefixes)))
+
+    return [rnd.choice(distinct) for _ in range(num_macs)]
+
+
+def _run(name:str, func:callable, mac_addresses:list, expected:list) -> dict:
+    start = time.perf_counter()
+    names = func(mac_addresses)
+    elapsed = time.perf_counter() - start
+
+    mismatches = [(mac, e, n) for mac, e, n in zip(mac_addresses, expected, names) if e != n]
+    if mismatches:
+        logger.info(f'{name}: {len(mismatches)} mismatches, e.g. {mismatches[:3]}')
+
+    return {
+        'n': len(mac_addresses),
+        'seconds': elapsed,
+        'us_per_lookup': elapsed / len(mac_addresses) * 1e6 if mac_addresses else 0.0,
+        'lookups_per_sec': len(mac_addresses) / elapsed if elapsed > 0 else 0.0,
+        'mismatches': len(mismatches),
+        'examples': mismatches[:3]
+    }
+
+
+def benchmark(db_path:str=None, backend:str=None, num_macs:int=DEFAULT_NUM_MACS, private_ratio:float=DEFAULT_PRIVATE_RATIO,
+              slow_sample:int=DEFAULT_SLOW_SAMPLE, vendors:list=None, seed:int=0) -> dict:
+    """
+    全ての実装で同じMACアドレスを検索して、速さと正解との食い違いを測る
+
+    Args:
+        db_path (str, optional): ベンダー情報を持つデータベース、複製して使う. Defaults to None.
+        backend (str, optional): バックエンドの種類. Defaults to DB_BACKEND.
+        num_macs (int, optional): 検索するMACアドレスの数. Defaults to DEFAULT_NUM_MACS.
+        private_ratio (float, optional): ローカルアドレスの割合. Defaults to DEFAULT_PRIVATE_RATIO.
+        slow_sample (int, optional): db_equalityで使うMACアドレスの数. Defaults to DEFAULT_SLOW_SAMPLE.
+        vendors (list, optional): db_pathを指定しない場合のベンダー情報. Defaults to make_synthetic_vendors().
+        seed (int, optional): 乱数の種. Defaults to 0.
+
+    Returns:
+        dict: {実装: {'n': 件数, 'seconds': 秒, 'us_per_lookup': マイクロ秒, 'lookups_per_sec': 件数, 'mismatches': 件数, 'examples': [...]}}
+    """
+    backend = backend or get_backend_name()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if db_path:
+            path = copy_database(db_path, tmp_dir, backend=backend)
+        else:
+            path = os.path.join(tmp_dir, os.path.basename(get_default_db_path(backend)))
+
+        with DbSession(db_path=path, backend=backend):
+            if db_path:
+                vendors = get_mac_vendors_all()
+                # バイナリファイルは複製したデータベースと同じ場所に作る
+                write_mac_vendors_file(vendors, get_mac_vendors_timestamp() or time.time())
+            else:
+                vendors = vendors or make_synthetic_vendors(seed=seed)
+                insert_mac_vendors(vendors, time.time())
+
+            mac_addresses = make_workload(vendors, num_macs=num_macs, private_ratio=private_ratio, seed=seed)
+            expected = expected_vendor_names(vendors, mac_addresses)
+            logger.info(f'{len(vendors)} vendors, {len(mac_addresses)} mac addresses, {sum(1 for e in expected if e is None)} without vendor')
+
+            def first_name(searched) -> str:
+                if isinstance(searched, dict):
+                    return searched.get('vendorName')
+                return searched[0].get('vendorName') if searched else None
+
+            def db_equality(macs):
+                return [first_name(_search_mac_vendors(mac)) for mac in macs]
+
+            def prefix_index(macs):
+                index = get_mac_vendors_index()
+                names = []
+                for mac in macs:
+                    mac = mac.upper()
+                    name = None
+                    for n in PREFIX_LENGTHS:
+                        docs = index[n].get(mac[:n])
+                        if docs:
+                            name = docs[0].get('vendorName')
+                            break
+                    names.append(name)
+                return names
+
+            def binary_file(macs):
+                f = open_mac_vendors_file()
+                return [first_name(f.search(mac)) for mac in macs]
+
+            def binary_file_many(macs):
+                return open_mac_vendors_file().search_many(macs)
+
+            def search(macs):
+                return [first_name(search_mac_vendors(mac)) for mac in macs]
+
+            def search_many(macs):
+                return search_mac_vendors_many(macs)
+
+            sorted_vendors = sorted(vendors, key=lambda d: d.get('macPrefix', ''))
+
+            def list_of_dict(macs):
+                return [first_name(search_list_of_dict(sorted_vendors, 'macPrefix', mac.upper(), exact_match=False)) for mac in macs]
+
+            # インデックスを作る時間は含めない
+            get_mac_vendors_index()
+            open_mac_vendors_file()
+
+            sample = mac_addresses[:slow_sample]
+            results['db_equality'] = _run('db_equality', db_equality, sample, expected[:slow_sample])
+            results['prefix_index'] = _run('prefix_index', prefix_index, mac_addresses, expected)
+            results['binary_file'] = _run('binary_file', binary_file, mac_addresses, expected)
+            results['binary_file_many'] = _run('binary_file_many', binary_file_many, mac_addresses, expected)
+
+            clear_mac_vendors_index()
+            open_mac_vendors_file()
+            results['search'] = _run('search', search, mac_addresses, expected)
+
+            clear_mac_vendors_index()
+            open_mac_vendors_file()
+            results['search_many'] = _run('search_many', search_many, mac_addresses, expected)
+
+            results['list_of_dict'] = _run('list_of_dict', list_of_dict, mac_addresses, expected)
+
+            # 次に使う人のためにキャッシュを捨てる
+            clear_mac_vendors_index()
+
+    return results
+
+
+def print_results(results:dict):
+    print(f"{'implementation':18} {'n':>8} {'us/lookup':>10} {'lookups/s':>12} {'mismatches':>10}")
+    for name, r in results.items():
+        print(f"{name:18} {r['n']:>8} {r['us_per_lookup']:>10.2f} {r['lookups_per_sec']:>12.0f} {r['mismatches']:>10}")
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_mac_vendors_bench():
+        vendors = make_synthetic_vendors(num_ma_l=300, num_ma_m=50, num_ma_s=60)
+        assert len(vendors) == len({d['macPrefix'] for d in vendors})
+        assert {'MA-L', 'MA-M', 'MA-S', 'CID'} == {d['blockType'] for d in vendors}
+
+        results = benchmark(backend='tinydb', num_macs=2000, slow_sample=100, vendors=vendors)
+        print_results(results)
+
+        # list_of_dict以外は正解と一致する
+        for name, r in results.items():
+            if name != 'list_of_dict':
+                assert 0 == r['mismatches'], name
+
+        logger.info('test mac vendors bench pass')
+
+    parser = argparse.ArgumentParser(description='benchmark and cross-check mac vendor lookups')
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-b', '--bench', action='store_true', default=False, help='run benchmark')
+    parser.add_argument('--db', dest='db_path', help='use vendors in a copy of this database instead of synthetic ones')
+    parser.add_argument('--backend', dest='backend', help='tinydb, sqlite or sharded')
+    parser.add_argument('--macs', type=int, default=DEFAULT_NUM_MACS, help='number of mac addresses to look up')
+    parser.add_argument('--private', type=float, default=DEFAULT_PRIVATE_RATIO, help='ratio of locally administered mac addresses')
+    parser.add_argument('--slow-sample', dest='slow_sample', type=int, default=DEFAULT_SLOW_SAMPLE, help='number of mac addresses for db_equality')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_mac_vendors_bench()
+            return 0
+
+        if args.bench:
+            results = benchmark(db_path=args.db_path, backend=args.backend, num_macs=args.macs, private_ratio=args.private, slow_sample=args.slow_sample)
+            print_results(results)
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
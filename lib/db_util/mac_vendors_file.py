@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+
+#
+# MACベンダーのバイナリファイル
+#
+# MAC_VENDORSテーブルは数万件のドキュメントなので、ベンダー名を一つ知りたいだけのプロセスでも
+# db.jsonを全部パースすることになる。
+# そこでMAC_VENDORSテーブルを更新するときに、検索だけに使うバイナリファイルをデータベースと同じ場所に書き出し、
+# 検索はmmapしたファイルを二分探索する。起動時のパースは不要で、読むのは探索で触れたページだけになる。
+#
+# ファイルの形式（リトルエンディアン）
+#
+#   ヘッダ     magic 'MACV', version, フラグ, タイムスタンプ, 各セクションの件数, 文字列テーブルの大きさ
+#   MA-S       (ベンダーコード 36ビットの整数, vendorName, blockType, lastUpdateの文字列の位置, フラグ) をベンダーコードの順に並べたもの
+#   MA-M       同じく28ビット
+#   MA-L       同じく24ビット
+#   文字列     (長さ 2バイト, UTF-8) を並べたもの、同じ文字列は一つにまとめる
+#
+# 検索結果はデータベースから検索したときと同じドキュメントになるように、blockTypeとlastUpdateも文字列で持ち、
+# ドキュメントに無かったキーは返さない。
+#
+# 書き出しは一時ファイルに書いてから置き換えるので、mmapしたまま読んでいるプロセスは古いファイルを読み続けられる。
+#
+# 多数のMACアドレスをまとめて検索するsearch_many()は、MACアドレスを48ビットの整数にして、
+# numpyがあればセクションごとにsearchsortedで一度に探す。numpyが無ければ一つずつ二分探索する。
+#
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from .backend import get_default_db_path
+    from .db_session import get_session
+    from .mac_address import MAC_MAX, MacAddress, parse_mac_int
+except ImportError:
+    from backend import get_default_db_path
+    from db_session import get_session
+    from mac_address import MAC_MAX, MacAddress, parse_mac_int
+
+# ファイル名、データベースと同じディレクトリに置く
+MAC_VENDORS_FILE_NAME = 'mac_vendors.bin'
+
+MAGIC = b'MACV'
+VERSION = 3
+
+# magic, version, フラグ, タイムスタンプ, MA-S MA-M MA-Lの件数, 文字列テーブルの大きさ
+HEADER = struct.Struct('<4sHHdIIII')
+
+# ヘッダのフラグ
+# ローカルアドレス（U/Lビットが1）のベンダーコードを含む、CIDなど
+HEADER_FLAG_HAS_LOCAL = 0x01
+
+# ベンダーコード, vendorName, blockType, lastUpdateの文字列の位置, フラグ
+RECORD = struct.Struct('<QIIIBxxx')
+
+# RECORDと同じ並びのnumpyの型
+RECORD_DTYPE = [('prefix', '<u8'), ('name', '<u4'), ('block_type', '<u4'), ('last_update', '<u4'), ('flags', 'u1'), ('pad', 'V3')]
+
+# ドキュメントにそのキーが無かったことを表す文字列の位置
+NO_STRING = 0xffffffff
+
+# フラグ
+FLAG_PRIVATE = 0x01
+FLAG_HAS_PRIVATE = 0x02
+
+# セクションの順番、(コロン表記の長さ, ビット数, blockType)
+SECTIONS = ((13, 36, 'MA-S'), (10, 28, 'MA-M'), (8, 24, 'MA-L'))
+
+logger = logging.getLogger(__name__)
+
+# 開いているファイル {path: (os.stat()の識別子, MacVendorsFile)}
+_open_files = {}
+
+
+def get_mac_vendors_file_path(db_path:str=None) -> str:
+    """
+    バイナリファイルのパスを返却する
+
+    Args:
+        db_path (str, optional): データベースのパス. Defaults to 有効なセッション、無ければ既定のパス.
+
+    Returns:
+        str: データベースと同じディレクトリのMAC_VENDORS_FILE_NAME
+    """
+    if db_path is None:
+        session = get_session()
+        db_path = session.db_path if session is not None else get_default_db_path()
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), MAC_VENDORS_FILE_NAME)
+
+
+def is_locally_administered(mac_address:str) -> bool:
+    """
+    先頭オクテットのU/Lビットが1のローカルアドレス（プライベートMACアドレス）かどうか
+
+    Args:
+        mac_address (str): 'AA:BB:CC:DD:EE:FF'や'aabb.ccdd.eeff'のようなMACアドレス、ベンダーコードでもよい
+    """
+    try:
+        return bool(int(mac_address[:2], 16) & 0x02)
+    except ValueError:
+        return False
+
+
+def prefix_to_int(prefix:str) -> int:
+    """
+    '8C:1F:64:A5:E'のようなベンダーコードを整数にする
+    """
+    return int(prefix.replace(':', '').replace('-', '').replace('.', ''), 16)
+
+
+def mac_to_int(mac_address:str) -> int:
+    """
+    'AA:BB:CC:DD:EE:FF'や'aabb.ccdd.eeff'のようなMACアドレスを48ビットの整数にする、MacAddressや整数はそのまま
+
+    Returns:
+        int: 整数、MACアドレスとして解釈できなければ-1
+    """
+    if isinstance(mac_address, MacAddress):
+        return mac_address.value
+    if isinstance(mac_address, int):
+        return mac_address if 0 <= mac_address <= MAC_MAX else -1
+    try:
+        return parse_mac_int(mac_address)
+    except (AttributeError, ValueError):
+        return -1
+
+
+class MacVendorsFileBuilder:
+    """
+    MACベンダーを一つずつ受け取ってバイナリファイルを作る
+
+    ドキュメントそのものは持たずに整数と文字列テーブルだけを持つので、ダンプを流しながら作れる。
+    """
+
+    def __init__(self) -> None:
+        self.strings = bytearray()
+        self.string_offsets = {}
+        self.sections = {length: {} for length, _, _ in SECTIONS}
+        self.header_flags = 0
+
+
+    def _string_offset(self, s:str) -> int:
+        if s is None:
+            return NO_STRING
+        if s not in self.string_offsets:
+            data = s.encode('utf-8')[:0xffff]
+            self.string_offsets[s] = len(self.strings)
+            self.strings.extend(struct.pack('<H', len(data)))
+            self.strings.extend(data)
+        return self.string_offsets[s]
+
+
+    def add(self, d:dict):
+        prefix = (d.get('macPrefix') or '').upper()
+        if len(prefix) not in self.sections:
+            return
+        try:
+            value = prefix_to_int(prefix)
+        except ValueError:
+            logger.warning(f'invalid macPrefix skipped: {prefix}')
+            return
+        # 同じベンダーコードが重複していたら最初のものを使う
+        if value not in self.sections[len(prefix)]:
+            flags = FLAG_PRIVATE if d.get('private') else 0
+            if 'private' in d:
+                flags |= FLAG_HAS_PRIVATE
+            strings = (self._string_offset(d.get('vendorName') or ''), self._string_offset(d.get('blockType')), self._string_offset(d.get('lastUpdate')))
+            self.sections[len(prefix)][value] = (strings, flags)
+            if is_locally_administered(prefix):
+                self.header_flags |= HEADER_FLAG_HAS_LOCAL
+
+
+    def write(self, timestamp:float, path:str=None):
+        """
+        バイナリファイルを書き出す
+
+        Args:
+            timestamp (float): MACベンダーのデータのタイムスタンプ
+            path (str, optional): 書き出すファイル. Defaults to get_mac_vendors_file_path().
+        """
+        path = path or get_mac_vendors_file_path()
+
+        header = HEADER.pack(MAGIC, VERSION, self.header_flags, timestamp, *[len(self.sections[length]) for length, _, _ in SECTIONS], len(self.strings))
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                for length, _, _ in SECTIONS:
+                    for value, (strings, flags) in sorted(self.sections[length].items()):
+                        f.write(RECORD.pack(value, *strings, flags))
+                f.write(self.strings)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        logger.info(f'{path} written: {sum(len(s) for s in self.sections.values())} prefixes, {len(self.string_offsets)} strings')
+
+
+def write_mac_vendors_file(mac_vendors_list, timestamp:float, path:str=None):
+    """
+    MACベンダーのリストからバイナリファイルを作る
+
+    Args:
+        mac_vendors_list (list): MACベンダーのdictデータのリスト、イテレータでもよい
+        timestamp (float): MACベンダーのデータのタイムスタンプ
+        path (str, optional): 書き出すファイル. Defaults to get_mac_vendors_file_path().
+    """
+    builder = MacVendorsFileBuilder()
+    for d in mac_vendors_list:
+        builder.add(d)
+    builder.write(timestamp, path=path)
+
+
+class MacVendorsFile:
+    """
+    mmapしたバイナリファイルから検索する
+    """
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_flags, self.timestamp, *counts, strings_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError(f'{path} is not a mac vendors file of version {VERSION}')
+
+        # ローカルアドレスのベンダーコードが無ければ、ローカルアドレスは検索するまでもなく見つからない
+        self.has_local = bool(header_flags & HEADER_FLAG_HAS_LOCAL)
+
+        # セクションごとの (先頭の位置, 件数)
+        self.sections = []
+        offset = HEADER.size
+        for count in counts:
+            self.sections.append((offset, count))
+            offset += count * RECORD.size
+        self.strings_offset = offset
+
+
+    def __len__(self) -> int:
+        return sum(count for _, count in self.sections)
+
+
+    def _string(self, offset:int) -> str:
+        pos = self.strings_offset + offset
+        length, = struct.unpack_from('<H', self.mm, pos)
+        return self.mm[pos + 2:pos + 2 + length].decode('utf-8')
+
+
+    def _bisect(self, section:int, value:int):
+        start, count = self.sections[section]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v, *record = RECORD.unpack_from(self.mm, start + mid * RECORD.size)
+            if v < value:
+                lo = mid + 1
+            elif v > value:
+                hi = mid
+            else:
+                # (vendorName, blockType, lastUpdate, フラグ)
+                return record
+        return None
+
+
+    def search(self, mac_address:str) -> list:
+        """
+        MACアドレスをキーとしてベンダーを検索する
+
+        Args:
+            mac_address (str): AA:AA:AA:AA:AA:AAの形式の文字列
+
+        Returns:
+            list: search_mac_vendors()と同じ形式、長いベンダーコードで一致したものが先
+                  データベースに格納したドキュメントと同じキーを持つ
+        """
+        mac_address = mac_address.upper()
+
+        searched = []
+        for i, (length, _, _) in enumerate(SECTIONS):
+            if len(mac_address) < length:
+                continue
+            prefix = mac_address[:length]
+            try:
+                value = prefix_to_int(prefix)
+            except ValueError:
+                return []
+            found = self._bisect(i, value)
+            if found is not None:
+                name_offset, block_type_offset, last_update_offset, flags = found
+                d = {'macPrefix': prefix, 'vendorName': self._string(name_offset)}
+                if flags & FLAG_HAS_PRIVATE:
+                    d['private'] = bool(flags & FLAG_PRIVATE)
+                if block_type_offset != NO_STRING:
+                    d['blockType'] = self._string(block_type_offset)
+                if last_update_offset != NO_STRING:
+                    d['lastUpdate'] = self._string(last_update_offset)
+                searched.append(d)
+        return searched
+
+
+    def search_many(self, mac_addresses:list) -> list:
+        """
+        多数のMACアドレスのベンダー名をまとめて検索する
+
+        Args:
+            mac_addresses (list): MACアドレスの文字列のリスト
+
+        Returns:
+            list: 入力と同じ順番のベンダー名のリスト、一致しなければNone
+        """
+        values = [mac_to_int(mac) for mac in mac_addresses]
+
+        if numpy is not None:
+            name_offsets = self._search_many_numpy(values)
+        else:
+            name_offsets = self._search_many_bisect(values)
+
+        # 同じベンダー名は一度だけデコードする
+        names = {}
+        results = []
+        for offset in name_offsets:
+            if offset < 0:
+                results.append(None)
+                continue
+            if offset not in names:
+                names[offset] = self._string(offset)
+            results.append(names[offset])
+        return results
+
+
+    def _search_many_numpy(self, values:list) -> list:
+        macs = numpy.array(values, dtype=numpy.int64)
+        valid = macs >= 0
+        macs = macs.astype(numpy.uint64)
+
+        # 見つからなかったものは-1のまま
+        found = numpy.full(len(values), -1, dtype=numpy.int64)
+
+        for (start, count), (_, bits, _) in zip(self.sections, SECTIONS):
+            if count == 0:
+                continue
+            records = numpy.frombuffer(self.mm, dtype=RECORD_DTYPE, count=count, offset=start)
+            prefixes = records['prefix']
+
+            keys = macs >> numpy.uint64(48 - bits)
+            pos = numpy.searchsorted(prefixes, keys)
+            pos_clipped = numpy.minimum(pos, count - 1)
+            hit = valid & (found < 0) & (pos < count) & (prefixes[pos_clipped] == keys)
+            found[hit] = records['name'][pos_clipped[hit]]
+
+        return found.tolist()
+
+
+    def _search_many_bisect(self, values:list) -> list:
+        found = []
+        for value in values:
+            offset = -1
+            if value >= 0:
+                for i, (_, bits, _) in enumerate(SECTIONS):
+                    hit = self._bisect(i, value >> (48 - bits))
+                    if hit is not None:
+                        offset = hit[0]
+                        break
+            found.append(offset)
+        return found
+
+
+    def close(self):
+        self.mm.close()
+
+
+def open_mac_vendors_file(path:str=None):
+    """
+    バイナリファイルを開いて返却する、開いたものは使い回す
+
+    ファイルが置き換えられていたら開き直す。
+    形式が古いファイルは使わない、collect_mac_vendors.pyを実行すれば作り直される。
+
+    Returns:
+        MacVendorsFile: ファイルが無い、もしくは使えなければNone
+    """
+    path = path or get_mac_vendors_file_path()
+
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    ident = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    cached = _open_files.get(path)
+    if cached is not None:
+        if cached[0] == ident:
+            return cached[1]
+        # 古いmmapは参照している人がいるかもしれないので閉じずに捨てる
+        del _open_files[path]
+
+    try:
+        f = MacVendorsFile(path)
+    except ValueError as e:
+        # 何度も警告しないように使えないことも覚えておく
+        logger.warning(f'{e}, ignored')
+        f = None
+    _open_files[path] = (ident, f)
+    return f
+
+
+def get_mac_vendors_file_timestamp(path:str=None):
+    """
+    バイナリファイルに記録したタイムスタンプを返却する、ファイルが無ければNone
+    """
+    f = open_mac_vendors_file(path)
+    return f.timestamp if f is not None else None
+
+
+def search_mac_vendors_file(mac_address:str, path:str=None):
+    """
+    バイナリファイルからベンダーを検索する
+
+    Returns:
+        list: 検索結果、ファイルが無ければNone
+    """
+    f = open_mac_vendors_file(path)
+    if f is None:
+        return None
+    return f.search(mac_address)
+
+
+def search_mac_vendors_file_many(mac_addresses:list, path:str=None):
+    """
+    バイナリファイルから多数のMACアドレスのベンダー名をまとめて検索する
+
+    Returns:
+        list: 入力と同じ順番のベンダー名のリスト、一致しなければNone、ファイルが無ければNone
+    """
+    f = open_mac_vendors_file(path)
+    if f is None:
+        return None
+    return f.search_many(mac_addresses)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+
+    from pprint import pprint
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_mac_vendors_file():
+        mac_vendors_list = [
+            {'macPrefix': '98:86:8B', 'vendorName': 'Juniper Networks', 'private': False, 'blockType': 'MA-L', 'lastUpdate': '2015/11/17'},
+            {'macPrefix': '90:31:4B', 'vendorName': 'AltoBeam Inc.', 'private': False},
+            {'macPrefix': '8C:1F:64', 'vendorName': 'IEEE Registration Authority', 'private': False, 'blockType': 'MA-L', 'lastUpdate': '2019/05/24'},
+            {'macPrefix': '8C:5D:B2:9', 'vendorName': 'ISSENDORFF KG', 'private': False, 'blockType': 'MA-M', 'lastUpdate': '2016/02/05'},
+            {'macPrefix': '8C:5D:B2:8', 'vendorName': 'Guangzhou Phimax Electronic Technology Co.,Ltd', 'private': False, 'blockType': 'MA-M', 'lastUpdate': '2016/02/05'},
+            {'macPrefix': '8C:1F:64:A5:E', 'vendorName': 'XTIA Ltd', 'private': False, 'blockType': 'MA-S', 'lastUpdate': '2022/10/01'},
+            {'macPrefix': '8C:1F:64:FD:C', 'vendorName': 'Private', 'private': True, 'blockType': 'IAB', 'lastUpdate': '2022/10/01'},
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, MAC_VENDORS_FILE_NAME)
+            assert search_mac_vendors_file('98:86:8B:00:00:00', path=path) is None
+
+            write_mac_vendors_file(mac_vendors_list, 1.5, path=path)
+            assert 1.5 == get_mac_vendors_file_timestamp(path=path)
+            assert not open_mac_vendors_file(path).has_local
+            assert len(mac_vendors_list) == len(open_mac_vendors_file(path))
+
+            # データベースに格納したドキュメントと同じものを返す
+            for d in mac_vendors_list:
+                digits = (d['macPrefix'].replace(':', '') + '0' * 12)[:12]
+                mac_address = ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+                assert d == search_mac_vendors_file(mac_address, path=path)[0]
+            assert [mac_vendors_list[0]] == search_mac_vendors_file('98:86:8b:12:34:56', path=path)
+            assert ['ISSENDORFF KG'] == [d['vendorName'] for d in search_mac_vendors_file('8C:5D:B2:90:00:00', path=path)]
+            assert ['XTIA Ltd', 'IEEE Registration Authority'] == [d['vendorName'] for d in search_mac_vendors_file('8C:1F:64:A5:E0:00', path=path)]
+            assert search_mac_vendors_file('8C:1F:64:FD:C0:00', path=path)[0]['private']
+            assert [] == search_mac_vendors_file('AB:CD:EF:00:00:00', path=path)
+            assert [] == search_mac_vendors_file('zz', path=path)
+
+            # まとめて検索、numpyの有無で結果は変わらない
+            mac_addresses = ['8C:1F:64:A5:E0:00', '98:86:8b:00:00:01', 'AB:CD:EF:00:00:00', '8c5d.b280.0000', 'zz', '8C:1F:64:00:00:00']
+            expected = ['XTIA Ltd', 'Juniper Networks', None, 'Guangzhou Phimax Electronic Technology Co.,Ltd', None, 'IEEE Registration Authority']
+            assert expected == search_mac_vendors_file_many(mac_addresses, path=path)
+            f = open_mac_vendors_file(path)
+            assert expected == [f._string(offset) if offset >= 0 else None for offset in f._search_many_bisect([mac_to_int(mac) for mac in mac_addresses])]
+            assert [] == search_mac_vendors_file_many([], path=path)
+
+            # 置き換えたら開き直す
+            write_mac_vendors_file(mac_vendors_list[:1], 2.5, path=path)
+            assert 2.5 == get_mac_vendors_file_timestamp(path=path)
+            assert [] == search_mac_vendors_file('90:31:4B:00:00:00', path=path)
+
+            # CIDのようなローカルアドレスのベンダーコード
+            assert is_locally_administered('DA:A1:19:00:00:00') and not is_locally_administered('98:86:8B:00:00:00')
+            write_mac_vendors_file([{'macPrefix': 'DA:A1:19', 'vendorName': 'Google, Inc.'}], 3.5, path=path)
+            assert open_mac_vendors_file(path).has_local
+
+            # 形式の違うファイルは使わない
+            with open(path, 'r+b') as f:
+                f.write(struct.pack('<4sH', MAGIC, VERSION + 1))
+            assert search_mac_vendors_file('DA:A1:19:00:00:00', path=path) is None
+
+        logger.info('test mac vendors file pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-s', '--search', dest='search', help='search mac address', type=str)
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_mac_vendors_file()
+            return 0
+
+        if args.search:
+            pprint(search_mac_vendors_file(args.search))
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
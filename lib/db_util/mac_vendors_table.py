@@ -2,69 +2,209 @@
 
 import logging
 import os
+import time
 
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 
-#
-# tinydb
-#
-from tinydb import Query, TinyDB
-
-# JSONファイル
-DB_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(DB_DIR, 'db.json')
+try:
+    from .backend import EXISTS, get_default_db_path
+    from .db_session import open_db, ensure_session, get_session
+    from .mac_vendors_file import MacVendorsFileBuilder, open_mac_vendors_file, is_locally_administered
+    from .mac_address import MacAddress, to_mac
+except ImportError:
+    from backend import EXISTS, get_default_db_path
+    from db_session import open_db, ensure_session, get_session
+    from mac_vendors_file import MacVendorsFileBuilder, open_mac_vendors_file, is_locally_administered
+    from mac_address import MacAddress, to_mac
 
 # テーブルの種類
 TABLE_MAC_VENDORS = 'MAC_VENDORS'
 
+# ベンダーコードのコロン表記の長さ、長いものから順に検索する
+# MA-S 36ビット = 13文字、MA-M 28ビット = 10文字、MA-L 24ビット = 8文字
+PREFIX_LENGTHS = (13, 10, 8)
+
 logger = logging.getLogger(__name__)
 
+# 検索結果をMACアドレスごとに覚えておく数
+VENDOR_CACHE_SIZE = int(os.environ.get('DB_UTIL_VENDOR_CACHE_SIZE', '4096'))
+
+# 検索元のタイムスタンプを確かめ直すまでの秒数
+# この間はキャッシュにあるものをデータベースに触らずに返す、0にすると毎回確かめる
+VENDOR_CACHE_TTL = float(os.environ.get('DB_UTIL_VENDOR_CACHE_TTL', '60'))
+
+# 検索用のインデックス
+# {(db_path, table_name): (タイムスタンプ, {13: {macPrefix: [doc, ...]}, 10: {...}, 8: {...}}, ローカルアドレスのベンダーコードを含むか)}
+_vendor_indexes = {}
+
+# 検索結果のキャッシュ {table_name: VendorCache}
+_vendor_caches = {}
+
+# キャッシュに無いことを表す
+_MISSING = object()
+
+# 検索に使うもの
+#   version:     検索元と、そのタイムスタンプ、変わったらキャッシュを捨てる
+#   has_local:   ローカルアドレスのベンダーコードを含むか
+#   search:      MACアドレスからsearch_mac_vendors()の形式で返す関数
+#   search_many: MACアドレスのリストからベンダー名のリストを返す関数
+_LookupSource = namedtuple('_LookupSource', ['version', 'has_local', 'search', 'search_many'])
+
 #
 # MACベンダー情報
 #
 
-def insert_mac_vendors(mac_vendors_list:list, timestamp:float, table_name:str=TABLE_MAC_VENDORS):
+def _timestamp_doc(timestamp:float, etag:str=None, last_modified:str=None) -> dict:
+    # 次回の条件付きGETのためにETagとLast-Modifiedを一緒に残す
+    doc = {'timestamp': timestamp}
+    if etag:
+        doc['etag'] = etag
+    if last_modified:
+        doc['last_modified'] = last_modified
+    return doc
+
+
+def insert_mac_vendors(mac_vendors_list:list, timestamp:float, table_name:str=TABLE_MAC_VENDORS, etag:str=None, last_modified:str=None):
     """
     データを'TABLE_MAC_VENDORS'テーブルに保存する。
 
     格納するドキュメントの形式はこの通り
-    { 'timestamp': xxx }
+    { 'timestamp': xxx, 'etag': xxx, 'last_modified': xxx }
     { 'macPrefix': '00:00:0C', 'vendorName': 'Cisco Systems, Inc', ... }
     { 'macPrefix': '98:86:8B', 'vendorName': 'Juniper Networks', ...}
 
     正確にはこんな感じ
     {'blockType': 'MA-L', 'lastUpdate': '2020/08/13', 'macPrefix': '90:9A:4A', 'private': False, 'vendorName': 'TP-LINK TECHNOLOGIES CO.,LTD.'}
 
+    ダウンロードしたダンプを一つずつ読み込むイテレータを渡せば、ダンプ全体をリストにしなくてよい。
+
     Args:
-        mac_vendors_list (list): MACベンダーのdictデータのリスト
+        mac_vendors_list (list): MACベンダーのdictデータのリスト、イテレータでもよい
         timestamp (float): 実行した時点のタイムスタンプ
+        etag (str, optional): ダウンロードしたときのETag. Defaults to None.
+        last_modified (str, optional): ダウンロードしたときのLast-Modified. Defaults to None.
     """
-    with TinyDB(DB_PATH) as db:
+    # 検索用のバイナリファイルは格納しながら一緒に作る
+    builder = MacVendorsFileBuilder() if table_name == TABLE_MAC_VENDORS else None
+
+    def feed():
+        for d in mac_vendors_list:
+            if builder is not None:
+                builder.add(d)
+            yield d
+
+    with open_db() as db:
         # すでにテーブルが存在する場合は破棄
         db.drop_table(table_name)
 
-        # テーブルを取得
-        table = db.table(table_name)
-
         # タイムスタンプの情報を格納
-        table.insert({'timestamp': timestamp})
+        db.insert(table_name, _timestamp_doc(timestamp, etag=etag, last_modified=last_modified))
 
         # macベンダーのリストを一括で挿入
-        table.insert_multiple(mac_vendors_list)
+        db.insert_multiple(table_name, feed())
 
+    # 作り直したので次の検索でインデックスも作り直す
+    clear_mac_vendors_index()
 
-def get_mac_vendors_timestamp(table_name:str=TABLE_MAC_VENDORS):
-    q = Query()
+    if builder is not None:
+        builder.write(timestamp)
+
+
+def update_mac_vendors(mac_vendors_list:list, timestamp:float, table_name:str=TABLE_MAC_VENDORS, etag:str=None, last_modified:str=None) -> dict:
+    """
+    新しいダンプと比べて、追加、変更、削除されたベンダーコードだけをテーブルに反映する。
+
+    テーブルが空の場合はinsert_mac_vendors()と同じ。
+    変更されたベンダーコードはlastUpdateが変わるので、ドキュメントが一致しないものを変更とみなす。
+
+    Args:
+        mac_vendors_list (list): 新しいダンプのMACベンダーのdictデータのリスト、イテレータでもよい
+        timestamp (float): 新しいダンプのタイムスタンプ
+        etag (str, optional): ダウンロードしたときのETag. Defaults to None.
+        last_modified (str, optional): ダウンロードしたときのLast-Modified. Defaults to None.
+
+    Returns:
+        dict: {'added': 件数, 'changed': 件数, 'removed': 件数}
+    """
+    builder = MacVendorsFileBuilder() if table_name == TABLE_MAC_VENDORS else None
+
+    with ensure_session():
+        with open_db() as db:
+            stored = {d['macPrefix']: d for d in db.search(table_name, {'macPrefix': EXISTS})}
+
+        if not stored:
+            count = [0]
+
+            def counted():
+                for d in mac_vendors_list:
+                    count[0] += 1
+                    yield d
+
+            insert_mac_vendors(counted(), timestamp, table_name=table_name, etag=etag, last_modified=last_modified)
+            return {'added': count[0], 'changed': 0, 'removed': 0}
+
+        seen = set()
+        added = []
+        changed = []
+        for d in mac_vendors_list:
+            if builder is not None:
+                builder.add(d)
+            prefix = d.get('macPrefix')
+            seen.add(prefix)
+            old = stored.get(prefix)
+            if old is None:
+                added.append(d)
+            elif old.get('lastUpdate') != d.get('lastUpdate') or old != d:
+                changed.append(d)
+
+        removed = [prefix for prefix in stored.keys() if prefix not in seen]
+
+        with open_db() as db:
+            # 変更されたものは消してから入れ直す
+            # SQLiteのパラメータの数の上限を超えないように分けて削除する
+            prefixes = [d['macPrefix'] for d in changed] + removed
+            for i in range(0, len(prefixes), 500):
+                db.remove(table_name, {'macPrefix': prefixes[i:i + 500]})
+
+            db.insert_multiple(table_name, added + changed)
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        searched = table.get(q.timestamp.exists())
+            db.remove(table_name, {'timestamp': EXISTS})
+            db.insert(table_name, _timestamp_doc(timestamp, etag=etag, last_modified=last_modified))
+
+    clear_mac_vendors_index()
+
+    if builder is not None:
+        builder.write(timestamp)
+
+    logger.info(f'mac vendors updated: {len(added)} added, {len(changed)} changed, {len(removed)} removed')
+    return {'added': len(added), 'changed': len(changed), 'removed': len(removed)}
+
+
+def get_mac_vendors_timestamp(table_name:str=TABLE_MAC_VENDORS):
+    with open_db() as db:
+        searched = db.get(table_name, {'timestamp': EXISTS})
 
     if searched is None:
         return None
     return searched['timestamp']
 
 
+def get_mac_vendors_validators(table_name:str=TABLE_MAC_VENDORS) -> dict:
+    """
+    条件付きGETに使う前回のETagとLast-Modifiedを返却する
+
+    Returns:
+        dict: {'etag': xxx, 'last_modified': xxx}、格納されていなければどちらもNone
+    """
+    with open_db() as db:
+        searched = db.get(table_name, {'timestamp': EXISTS})
+
+    if searched is None:
+        return {'etag': None, 'last_modified': None}
+    return {'etag': searched.get('etag'), 'last_modified': searched.get('last_modified')}
+
+
 def get_mac_vendors_datetime(table_name:str=TABLE_MAC_VENDORS):
     ts = get_mac_vendors_timestamp(table_name=table_name)
     if ts is None:
@@ -73,16 +213,9 @@ def get_mac_vendors_datetime(table_name:str=TABLE_MAC_VENDORS):
 
 
 def get_mac_vendors_all(table_name:str=TABLE_MAC_VENDORS) -> list:
-    q = Query()
-
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-
-        # {'timestamp': ...}を除くすべて、を返却
-        # return table.search(~ (q.timestamp.exists()))
-
+    with open_db() as db:
         # {'macPrefix': ...}を含むすべて、を返却
-        return table.search(q.macPrefix.exists())
+        return db.search(table_name, {'macPrefix': EXISTS})
 
 
 # radix treeを使えば簡単に検索できるけど、ここでは力技で検索
@@ -94,40 +227,236 @@ def _search_mac_vendors(mac_address:str, table_name:str=TABLE_MAC_VENDORS) -> li
     # 大文字に変換
     mac_address = mac_address.upper()
 
-    q = Query()
-
-    with TinyDB(DB_PATH) as db:
-
-        table = db.table(table_name)
+    with open_db() as db:
 
         # MA-S 36ビットのベンダーコードを検索
         # コロン表記で13文字
         if len(mac_address) >= 13:
-            searched = table.search(q.macPrefix == mac_address[:13])
+            searched = db.search(table_name, {'macPrefix': mac_address[:13]})
             if len(searched) > 0:
                 return searched
 
         # MA-M 28ビットのベンダーコードを検索
         # コロン表記で10文字
         if len(mac_address) >= 10:
-            searched = table.search(q.macPrefix == mac_address[:10])
+            searched = db.search(table_name, {'macPrefix': mac_address[:10]})
             if len(searched) > 0:
                 return searched
 
         # MA-L 24ビットのベンダーコードを検索
         # コロン表記で8文字
         if len(mac_address) >= 8:
-            searched = table.search(q.macPrefix == mac_address[:8])
+            searched = db.search(table_name, {'macPrefix': mac_address[:8]})
             if len(searched) > 0:
                 return searched
 
     return []
 
 
+def build_mac_vendors_index(mac_vendors_list:list) -> dict:
+    """
+    ベンダーコードの長さごとに、ベンダーコードをキーにした辞書を作る
+
+    Args:
+        mac_vendors_list (list): MACベンダーのdictデータのリスト
+
+    Returns:
+        dict: {13: {macPrefix: [doc, ...]}, 10: {...}, 8: {...}}
+    """
+    index = {n: {} for n in PREFIX_LENGTHS}
+    for d in mac_vendors_list:
+        prefix = d.get('macPrefix')
+        if not prefix:
+            continue
+        prefix = prefix.upper()
+        if len(prefix) in index:
+            index[len(prefix)].setdefault(prefix, []).append(d)
+    return index
+
+
+def clear_mac_vendors_index():
+    _vendor_indexes.clear()
+    _vendor_caches.clear()
+
+
+def _get_mac_vendors_index_entry(table_name:str=TABLE_MAC_VENDORS) -> tuple:
+    session = get_session()
+    db_path = session.db_path if session is not None else get_default_db_path()
+    key = (db_path, table_name)
+
+    with open_db() as db:
+        searched = db.get(table_name, {'timestamp': EXISTS})
+        timestamp = searched['timestamp'] if searched is not None else None
+
+        cached = _vendor_indexes.get(key)
+        if cached is not None and cached[0] == timestamp:
+            return key, cached
+
+        index = build_mac_vendors_index(db.search(table_name, {'macPrefix': EXISTS}))
+
+    has_local = any(is_locally_administered(prefix) for prefixes in index.values() for prefix in prefixes)
+    _vendor_indexes[key] = (timestamp, index, has_local)
+    logger.debug(f'mac vendors index built: {table_name} {sum(len(v) for v in index.values())} prefixes')
+    return key, _vendor_indexes[key]
+
+
+def get_mac_vendors_index(table_name:str=TABLE_MAC_VENDORS) -> dict:
+    """
+    検索用のインデックスを返却する
+
+    インデックスはプロセスの中で一度だけ作り、テーブルのタイムスタンプが変わったら作り直す。
+    別のプロセスでテーブルが更新された場合もタイムスタンプで気づく。
+
+    Returns:
+        dict: build_mac_vendors_index()の戻り値
+    """
+    _, (_, index, _) = _get_mac_vendors_index_entry(table_name=table_name)
+    return index
+
+
+def _search_index(index:dict, mac_address:str) -> list:
+    searched = []
+    for n in PREFIX_LENGTHS:
+        if len(mac_address) >= n:
+            searched.extend(index[n].get(mac_address[:n], []))
+    return searched
+
+
+def _get_lookup_source(table_name:str=TABLE_MAC_VENDORS) -> _LookupSource:
+    """
+    TABLE_MAC_VENDORSはバイナリファイル（mac_vendors_file.py参照）があればそちらから、無ければインデックスから検索する
+
+    バックエンドを移行したりdb.jsonを戻したりするとファイルとテーブルが食い違うので、
+    ファイルのタイムスタンプがテーブルと一致しない場合はインデックスから検索する。
+    """
+    if table_name == TABLE_MAC_VENDORS:
+        f = open_mac_vendors_file()
+        if f is not None:
+            if f.timestamp == get_mac_vendors_timestamp(table_name=table_name):
+                return _LookupSource((f.path, f.timestamp), f.has_local, f.search, f.search_many)
+            logger.info(f'{f.path} does not match {table_name}, search the index instead')
+
+    key, (timestamp, index, has_local) = _get_mac_vendors_index_entry(table_name=table_name)
+
+    def search_many(mac_addresses:list) -> list:
+        results = []
+        for mac_address in mac_addresses:
+            searched = _search_index(index, str(mac_address).upper())
+            results.append(searched[0].get('vendorName') if searched else None)
+        return results
+
+    return _LookupSource((key, timestamp), has_local, lambda mac_address: _search_index(index, mac_address), search_many)
+
+
+class VendorCache:
+    """
+    MACアドレスごとの検索結果のLRUキャッシュ
+
+    analyze.pyのように同じMACアドレスを何度も調べる処理のために、見つからなかったことも含めて覚えておく。
+    検索元のタイムスタンプ（get_mac_vendors_timestamp()と同じ値）が変わったら全て捨てる。
+
+    タイムスタンプを確かめるにはデータベースを開くことになるので、確かめた検索元を覚えておき、
+    VENDOR_CACHE_TTL秒の間は確かめずにそのまま使う。
+    """
+
+    def __init__(self, maxsize:int=VENDOR_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # 最後に確かめた検索元と、そのときのデータベースのパスと時刻
+        self.source = None
+        self.db_path = None
+        self.checked_at = 0.0
+
+
+    def validate(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+
+    def get(self, key):
+        value = self.entries.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+def _get_vendor_cache(table_name:str, version) -> VendorCache:
+    cache = _vendor_caches.get(table_name)
+    if cache is None:
+        cache = _vendor_caches[table_name] = VendorCache()
+    cache.validate(version)
+    return cache
+
+
+def _get_cached_lookup(table_name:str=TABLE_MAC_VENDORS) -> tuple:
+    """
+    検索元とキャッシュを返却する
+
+    VENDOR_CACHE_TTL秒以内に同じデータベースで確かめた検索元があれば、データベースに触らずにそれを使う。
+
+    Returns:
+        tuple: (_LookupSource, VendorCache)
+    """
+    session = get_session()
+    db_path = session.db_path if session is not None else get_default_db_path()
+    now = time.monotonic()
+
+    cache = _vendor_caches.get(table_name)
+    if cache is not None and cache.source is not None and cache.db_path == db_path and now - cache.checked_at < VENDOR_CACHE_TTL:
+        return cache.source, cache
+
+    source = _get_lookup_source(table_name=table_name)
+    cache = _get_vendor_cache(table_name, source.version)
+    cache.source = source
+    cache.db_path = db_path
+    cache.checked_at = now
+    return source, cache
+
+
+def get_vendor_cache_info(table_name:str=TABLE_MAC_VENDORS) -> dict:
+    """
+    検索結果のキャッシュの状況を返却する
+
+    Returns:
+        dict: {'hits': xxx, 'misses': xxx, 'size': xxx, 'maxsize': xxx}
+    """
+    cache = _vendor_caches.get(table_name)
+    if cache is None:
+        return {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': VENDOR_CACHE_SIZE}
+    return {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache.entries), 'maxsize': cache.maxsize}
+
+
 def search_mac_vendors(mac_address:str, table_name:str=TABLE_MAC_VENDORS) -> list:
     """
     MACアドレスをキーとしてベンダーを検索する。
 
+    MA-S MA-M MA-Lの順に、長いベンダーコードで一致したものから並べて返却する。
+    IEEEが自分で持っているMA-Lの中にMA-SやMA-Mが割り当てられている場合、先頭が実際のベンダーになる。
+
+    TABLE_MAC_VENDORSはバイナリファイル（mac_vendors_file.py参照）があればそちらから検索するので、
+    データベースを読み込まない。どちらから検索しても結果は格納したドキュメントと同じ。
+
+    検索結果はVendorCacheに覚えておく。キャッシュにあればデータベースを開かない。
+    返却するドキュメントはキャッシュと共有しないように複製する。
+    ローカルアドレス（プライベートMACアドレス）は、ローカルアドレスのベンダーコードが無ければ検索せずに空のリストを返す。
+
     Args:
         mac_address (str): AA:AA:AA:AA:AA:AAの形式の文字列
         table_name (str, optional): _description_. Defaults to TABLE_MAC_VENDORS.
@@ -139,12 +468,59 @@ def search_mac_vendors(mac_address:str, table_name:str=TABLE_MAC_VENDORS) -> lis
     # 大文字に変換
     mac_address = mac_address.upper()
 
-    q = Query()
+    source, cache = _get_cached_lookup(table_name=table_name)
+
+    searched = cache.get(('docs', mac_address))
+    if searched is _MISSING:
+        if is_locally_administered(mac_address) and not source.has_local:
+            searched = []
+        else:
+            searched = source.search(mac_address)
+        cache.put(('docs', mac_address), searched)
+
+    return [dict(d) for d in searched]
+
+
+def search_mac_vendors_many(mac_addresses:list, table_name:str=TABLE_MAC_VENDORS) -> list:
+    """
+    多数のMACアドレスのベンダー名をまとめて検索する。
+
+    スナップショットの履歴に現れる全てのMACアドレスを一度に調べるときに使う。
+    キャッシュに無く、ローカルアドレスでもないものだけをまとめて検索する。
+    MacAddressや整数を渡せば、バイナリファイルからは文字列に戻さずに検索する。
+
+    Args:
+        mac_addresses (list): MacAddress、48ビットの整数、もしくはMACアドレスの文字列のリスト
+        table_name (str, optional): テーブル名. Defaults to TABLE_MAC_VENDORS.
+
+    Returns:
+        list: 入力と同じ順番のベンダー名のリスト。一致したものがなければNone。
+    """
+    source, cache = _get_cached_lookup(table_name=table_name)
+
+    results = []
+    missed = {}
+    for i, mac_address in enumerate(mac_addresses):
+        # MACアドレスとして解釈できるものはMacAddressにそろえて、形式が違っても同じものとして扱う
+        mac = to_mac(mac_address)
+        mac_address = mac if mac is not None else mac_address.upper()
+        vendor_name = cache.get(('name', mac_address))
+        if vendor_name is _MISSING:
+            is_local = mac.is_locally_administered if mac is not None else is_locally_administered(mac_address)
+            if is_local and not source.has_local:
+                vendor_name = None
+                cache.put(('name', mac_address), None)
+            else:
+                missed.setdefault(mac_address, []).append(i)
+        results.append(vendor_name)
+
+    if missed:
+        for mac_address, vendor_name in zip(missed.keys(), source.search_many(list(missed.keys()))):
+            cache.put(('name', mac_address), vendor_name)
+            for i in missed[mac_address]:
+                results[i] = vendor_name
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        # str.find()で一致するかテストする
-        return table.search(q.macPrefix.test(lambda s: mac_address.find(s) == 0))
+    return results
 
 
 def dump_mac_vendors(table_name:str=TABLE_MAC_VENDORS):
@@ -169,6 +545,7 @@ if __name__ == '__main__':
 
     import argparse
     import sys
+    import tempfile
     from pprint import pprint
 
     logging.basicConfig(level=logging.INFO)
@@ -190,7 +567,7 @@ if __name__ == '__main__':
         ]
 
         # 既存のテスト用テーブルを破棄
-        with TinyDB(DB_PATH) as db:
+        with open_db() as db:
             db.drop_table(table_name)
 
         # 現在時刻を取得
@@ -221,13 +598,118 @@ if __name__ == '__main__':
         assert [] == search_mac_vendors('AB:CD:EF:00:00:00', table_name=table_name)
         logger.info('test non-existent prefix search pass')
 
+        # 長いベンダーコードで一致したものが先、テーブルを作り直したらインデックスも作り直す
+        ieee = {'macPrefix': '8C:1F:64', 'vendorName': 'IEEE Registration Authority'}
+        insert_mac_vendors(mac_vendors_list + [ieee], timestamp + 1, table_name=table_name)
+        assert [mac_vendors_list[4], ieee] == search_mac_vendors('8c:1f:64:a5:e0:00', table_name=table_name)
+        assert [ieee] == search_mac_vendors('8C:1F:64:00:00:00', table_name=table_name)
+        logger.info('test longest match pass')
+
+        assert ['XTIA Ltd', None, 'Juniper Networks'] == search_mac_vendors_many(['8c:1f:64:a5:e0:00', 'AB:CD:EF:00:00:00', '98:86:8B:00:00:00'], table_name=table_name)
+        assert ['XTIA Ltd', 'Juniper Networks', None] == search_mac_vendors_many([MacAddress('8c1f.64a5.e000'), 0x98868B000001, 'zz'], table_name=table_name)
+        logger.info('test search many pass')
+
+        # 差分だけを反映する
+        renamed = dict(mac_vendors_list[1], vendorName='AltoBeam', lastUpdate='2023/01/01')
+        added = {'macPrefix': '00:00:0C', 'vendorName': 'Cisco Systems, Inc'}
+        updated_list = [ieee, added, renamed] + mac_vendors_list[2:]
+        result = update_mac_vendors(iter(updated_list), timestamp + 2, table_name=table_name, etag='"abc"', last_modified='Sun, 06 Nov 2022 07:42:04 GMT')
+        assert {'added': 1, 'changed': 1, 'removed': 1} == result
+        assert sorted(updated_list, key=lambda d: d['macPrefix']) == sorted(get_mac_vendors_all(table_name=table_name), key=lambda d: d['macPrefix'])
+        assert timestamp + 2 == get_mac_vendors_timestamp(table_name=table_name)
+        assert {'etag': '"abc"', 'last_modified': 'Sun, 06 Nov 2022 07:42:04 GMT'} == get_mac_vendors_validators(table_name=table_name)
+        assert [renamed] == search_mac_vendors('90:31:4B:00:00:00', table_name=table_name)
+        assert [] == search_mac_vendors('98:86:8B:00:00:00', table_name=table_name)
+
+        assert {'added': 0, 'changed': 0, 'removed': 0} == update_mac_vendors(updated_list, timestamp + 3, table_name=table_name)
+        logger.info('test update pass')
+
+        # 見つからなかったことも覚えておく、テーブルを更新したら捨てる
+        clear_mac_vendors_index()
+        assert [] == search_mac_vendors('AB:CD:EF:00:00:00', table_name=table_name)
+        assert [] == search_mac_vendors('AB:CD:EF:00:00:00', table_name=table_name)
+        assert [None] == search_mac_vendors_many(['98:86:8B:00:00:00'], table_name=table_name)
+        assert {'hits': 1, 'misses': 2} == {k: v for k, v in get_vendor_cache_info(table_name=table_name).items() if k in ('hits', 'misses')}
+        update_mac_vendors(mac_vendors_list, timestamp + 4, table_name=table_name)
+        assert ['Juniper Networks'] == search_mac_vendors_many(['98:86:8B:00:00:00'], table_name=table_name)
+        assert 0 == get_vendor_cache_info(table_name=table_name)['hits']
+
+        # ローカルアドレスは検索しない、ローカルアドレスのベンダーコードがあれば検索する
+        assert [] == search_mac_vendors('DA:A1:19:00:00:00', table_name=table_name)
+        cid = {'macPrefix': 'DA:A1:19', 'vendorName': 'Google, Inc.'}
+        update_mac_vendors(mac_vendors_list + [cid], timestamp + 5, table_name=table_name)
+        assert [cid] == search_mac_vendors('DA:A1:19:00:00:00', table_name=table_name)
+        assert ['Google, Inc.', None] == search_mac_vendors_many(['DA:A1:19:00:00:00', 'DE:AD:BE:EF:00:00'], table_name=table_name)
+
+        # VENDOR_CACHE_TTLの間はキャッシュにあればデータベースを開かない
+        # 返却したものを書き換えてもキャッシュは変わらない
+        if VENDOR_CACHE_TTL > 0:
+            calls = []
+            original = _get_lookup_source
+            globals()['_get_lookup_source'] = lambda table_name=TABLE_MAC_VENDORS: calls.append(table_name) or original(table_name=table_name)
+            try:
+                searched = search_mac_vendors('DA:A1:19:00:00:00', table_name=table_name)
+                searched[0]['vendorName'] = 'changed'
+                assert [cid] == search_mac_vendors('DA:A1:19:00:00:00', table_name=table_name)
+                assert ['Google, Inc.'] == search_mac_vendors_many(['DA:A1:19:00:00:00'], table_name=table_name)
+                assert [] == calls
+            finally:
+                globals()['_get_lookup_source'] = original
+        logger.info('test vendor cache pass')
+
         # 既存のテスト用テーブルを破棄
-        with TinyDB(DB_PATH) as db:
+        with open_db() as db:
             db.drop_table(table_name)
 
         assert None == get_mac_vendors_timestamp(table_name=table_name)
 
 
+    def test_mac_vendors_file_source():
+        try:
+            from db_session import DbSession
+            from mac_vendors_file import get_mac_vendors_file_path, write_mac_vendors_file
+        except ImportError:
+            from .db_session import DbSession
+            from .mac_vendors_file import get_mac_vendors_file_path, write_mac_vendors_file
+
+        mac_vendors_list = [
+            {'macPrefix': '98:86:8B', 'vendorName': 'Juniper Networks', 'private': False, 'blockType': 'MA-L', 'lastUpdate': '2015/11/17'},
+            {'macPrefix': '8C:1F:64', 'vendorName': 'IEEE Registration Authority', 'private': False, 'blockType': 'MA-L', 'lastUpdate': '2019/05/24'},
+            {'macPrefix': '8C:1F:64:A5:E', 'vendorName': 'XTIA Ltd', 'private': False, 'blockType': 'MA-S', 'lastUpdate': '2022/10/01'},
+            {'macPrefix': '00:50:C2:00:0', 'vendorName': 'T.L.S. Corp.', 'private': False, 'blockType': 'IAB', 'lastUpdate': '2015/08/27'},
+            {'macPrefix': '90:31:4B', 'vendorName': 'AltoBeam Inc.'},
+        ]
+        mac_addresses = ['98:86:8b:00:00:01', '8C:1F:64:A5:E0:00', '8C:1F:64:00:00:00', '00:50:C2:00:01:00', '90:31:4B:00:00:00', 'AB:CD:EF:00:00:00']
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                insert_mac_vendors(mac_vendors_list, 1.0)
+
+                # バイナリファイルから検索しても、インデックスから検索しても同じドキュメント
+                assert os.path.exists(get_mac_vendors_file_path())
+                from_file = [search_mac_vendors(mac) for mac in mac_addresses]
+                os.remove(get_mac_vendors_file_path())
+                clear_mac_vendors_index()
+                from_index = [search_mac_vendors(mac) for mac in mac_addresses]
+                assert from_index == from_file
+                assert ['Juniper Networks', 'XTIA Ltd'] == search_mac_vendors_many([MacAddress(mac_addresses[0]), int(MacAddress(mac_addresses[1]))])
+                assert [mac_vendors_list[2], mac_vendors_list[1]] == from_file[1]
+                assert [mac_vendors_list[3]] == from_file[3]
+
+                # バイナリファイルからMacAddressと整数のまま検索する
+                insert_mac_vendors(mac_vendors_list, 2.0)
+                assert ['Juniper Networks', 'XTIA Ltd', None] == search_mac_vendors_many([MacAddress(mac_addresses[0]), int(MacAddress(mac_addresses[1])), 'zz'])
+
+                # テーブルと食い違うファイルは使わない
+                write_mac_vendors_file([{'macPrefix': '98:86:8B', 'vendorName': 'stale'}], 0.5)
+                clear_mac_vendors_index()
+                assert [mac_vendors_list[0]] == search_mac_vendors('98:86:8B:00:00:01')
+                assert ['Juniper Networks'] == search_mac_vendors_many(['98:86:8B:00:00:01'])
+                clear_mac_vendors_index()
+
+        logger.info('test mac vendors file source pass')
+
+
     def test_mac_vendors_search():
         mac_list = [
                     '28:84:fa:ea:5f:0c',
@@ -271,6 +753,7 @@ if __name__ == '__main__':
     def main():
         if args.test:
             test_mac_vendors_table()
+            test_mac_vendors_file_source()
             test_mac_vendors_search()
             return 0
 
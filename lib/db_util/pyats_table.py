@@ -7,26 +7,65 @@ import sys
 from datetime import datetime
 from pprint import pprint
 
-#
-# tinydb
-#
-from tinydb import Query, TinyDB
-
-# JSONファイル
-DB_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(DB_DIR, 'db.json')
+try:
+    from .db_session import open_db, ensure_session
+    from .history_iter import iter_history_documents
+    from .snapshot_table import SnapshotTable
+    from .mac_observations_table import SOURCE_MAC_ADDRESS_TABLE, mac_address_table_observations, get_source_key, get_mac_observations_sources
+    from .mac_observations_table import rebuild_mac_observations, get_mac_observations, expand_observations
+except ImportError:
+    from db_session import open_db, ensure_session
+    from history_iter import iter_history_documents
+    from snapshot_table import SnapshotTable
+    from mac_observations_table import SOURCE_MAC_ADDRESS_TABLE, mac_address_table_observations, get_source_key, get_mac_observations_sources
+    from mac_observations_table import rebuild_mac_observations, get_mac_observations, expand_observations
 
 # テーブルの種類
 TABLE_PYATS = 'PYATS'
 
 DEFAULT_DEVICE_MAX_HISTORY = 10
 
+# ドキュメントタイプごとの保管する履歴、ないものはDEFAULT_DEVICE_MAX_HISTORY
+DEVICE_MAX_HISTORY = {
+    'intf_info': 2
+}
+
 logger = logging.getLogger(__name__)
 
 #
 # pyATS取得情報
 #
 
+def get_device_table(device_name:str, doc_type:str) -> SnapshotTable:
+    """
+    装置とドキュメントタイプの組の履歴を表すSnapshotTableを返却する
+
+    mac_address_tableはMACアドレスの観測インデックスと差分履歴を作り、変化をイベントで通知する
+
+    Args:
+        device_name (str): 装置の名前
+        doc_type (str): ドキュメントタイプ 例： mac_address_table
+
+    Returns:
+        SnapshotTable: PYATSテーブルを共有するSnapshotTable
+    """
+    max_history = DEVICE_MAX_HISTORY.get(doc_type, DEFAULT_DEVICE_MAX_HISTORY)
+    cond = {'device_name': device_name, 'doc_type': doc_type}
+
+    if doc_type == 'mac_address_table':
+        return SnapshotTable(
+            TABLE_PYATS,
+            max_history,
+            source_key=get_source_key(SOURCE_MAC_ADDRESS_TABLE, device_name),
+            mac_key='mac_address',
+            observations=lambda doc_data: mac_address_table_observations(device_name, doc_data),
+            entries=mac_address_table_entries,
+            cond=cond
+        )
+
+    return SnapshotTable(TABLE_PYATS, max_history, cond=cond)
+
+
 def insert_device_data(device_name:str, doc_type:str, doc_data:dict, timestamp:float, max_history=DEFAULT_DEVICE_MAX_HISTORY):
     """
     データを'PYATS'テーブルに保存する。
@@ -46,57 +85,31 @@ def insert_device_data(device_name:str, doc_type:str, doc_data:dict, timestamp:f
         timestamp (float): 実行した時点のタイムスタンプ
         max_history (int, optional): 何個まで保存するか Defaults to DEFAULT_MAX_HISTORY.
     """
+    get_device_table(device_name, doc_type).insert(doc_data, timestamp, max_history=max_history)
 
-    # 格納するドキュメント
-    doc = {}
 
-    # デバイス名を付与
-    doc['device_name'] = device_name
-
-    # ドキュメントタイプを付与
-    doc['doc_type'] = doc_type
-
-    # ドキュメントデータを付与
-    doc['doc_data'] = doc_data
-
-    # タイムスタンプを付与
-    doc['timestamp'] = timestamp
+def device_retention_policy(group:tuple) -> dict:
+    """
+    装置とドキュメントタイプの組に適用する保存期間のポリシーを返却する
 
-    # PYATSテーブルに格納
-    with TinyDB(DB_PATH) as db:
-        table = db.table(TABLE_PYATS)
-        table.insert(doc)
+    Args:
+        group (tuple): (device_name, doc_type)
 
-    # max_historyを超えた古いものを削除
-    delete_old_device_data(device_name, doc_type, max_history)
+    Returns:
+        dict: retention.pyのポリシー
+    """
+    return get_device_table(*group).retention_policy()
 
 
 def delete_old_device_data(device_name:str, doc_type:str, max_history:int):
-    q = Query()
-
-    with TinyDB(DB_PATH) as db:
-        table = db.table(TABLE_PYATS)
-
-        # device_nameが一致するドキュメントからtimestampキーの一覧を取り出す
-        docs = table.search((q.device_name == device_name) & (q.doc_type == doc_type))
-        timestamps = [doc['timestamp'] for doc in docs]
-
-        # 新しい順（降順）にソート
-        timestamps.sort(reverse=True)
 
-        # max_historyを超えたものを削除
-        if len(timestamps) > max_history:
-            should_be_deleted = timestamps[max_history:]
-            for ts in should_be_deleted:
-                table.remove( (q.device_name == device_name) & (q.timestamp == ts) )
+    # device_nameとdoc_typeが一致するドキュメントのうちmax_historyを超えたものを削除
+    get_device_table(device_name, doc_type).delete_old(max_history)
 
 
 def delete_device_documents(device_name:str, doc_type:str):
-    q = Query()
-
-    with TinyDB(DB_PATH) as db:
-        table = db.table(TABLE_PYATS)
-        table.remove( (q.device_name == device_name) & (q.doc_type == doc_type))
+    with open_db() as db:
+        db.remove(TABLE_PYATS, {'device_name': device_name, 'doc_type': doc_type})
 
 
 def get_documents(doc_type:str):
@@ -109,11 +122,8 @@ def get_documents(doc_type:str):
     Returns:
         list: 見つかったドキュメントのリスト
     """
-    q = Query()
-
-    with TinyDB(DB_PATH) as db:
-        table = db.table(TABLE_PYATS)
-        docs = table.search((q.doc_type == doc_type))
+    with open_db() as db:
+        docs = db.search(TABLE_PYATS, {'doc_type': doc_type})
 
     if docs:
         return sorted(docs, key=lambda d: d['timestamp'], reverse=True)
@@ -132,43 +142,51 @@ def get_device_documents(device_name:str, doc_type:str):
     Returns:
         list: 見つかったドキュメントのリスト
     """
-    q = Query()
+    return get_device_table(device_name, doc_type).documents()
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(TABLE_PYATS)
-        docs = table.search((q.device_name == device_name) & (q.doc_type == doc_type))
 
-    if docs:
-        return sorted(docs, key=lambda d: d['timestamp'], reverse=True)
+def iter_documents(doc_type:str, since:float=None, until:float=None, limit:int=None):
+    """
+    ドキュメントタイプで検索し、新しい順に一つずつ返すジェネレータ
 
-    return []
+    Args:
+        doc_type (str): ドキュメントタイプ
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+        until (float, optional): これ以前のタイムスタンプ、この値を含む. Defaults to None.
+        limit (int, optional): タイムスタンプの最大の数. Defaults to None.
 
+    Yields:
+        dict: ドキュメント
+    """
+    yield from iter_history_documents(TABLE_PYATS, {'doc_type': doc_type}, since=since, until=until, limit=limit)
 
-def get_device_document_latest(device_name:str, doc_type:str):
-    docs = get_device_documents(device_name=device_name, doc_type=doc_type)
-    if len(docs) > 0:
-        return docs[0]
-    return None
 
+def iter_device_documents(device_name:str, doc_type:str, since:float=None, until:float=None, limit:int=None):
+    """
+    デバイス名とドキュメントタイプで検索し、新しい順に一つずつ返すジェネレータ
 
-def get_device_document_dates(device_name:str, doc_type:str):
+    Args:
+        device_name (str): 検索対象のキーdevice_nameの値
+        doc_type (str): ドキュメントタイプ
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+        until (float, optional): これ以前のタイムスタンプ、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
 
-    # 名前でドキュメントを取り出す
-    docs = get_device_documents(device_name, doc_type)
+    Yields:
+        dict: ドキュメント
+    """
+    yield from get_device_table(device_name, doc_type).iter_documents(since=since, until=until, limit=limit)
 
-    # timestampキーの一覧を取り出す
-    timestamps = [doc['timestamp'] for doc in docs]
 
-    # 降順にソートする
-    timestamps.sort(reverse=True)
+def get_device_document_latest(device_name:str, doc_type:str):
+    # 最新の一つだけ取り出す
+    return get_device_table(device_name, doc_type).latest()
 
-    # datetimeオブジェクトに変換
-    datetimes = [datetime.fromtimestamp(ts) for ts in timestamps]
 
-    # 分かりやすく日付の文字列に変換
-    dates = [dt.strftime('%Y-%m-%d %H:%M:%S') for dt in datetimes]
+def get_device_document_dates(device_name:str, doc_type:str):
 
-    return dates
+    # ドキュメントは取り出さずにtimestampキーの一覧だけを取り出す
+    return get_device_table(device_name, doc_type).dates()
 
 
 def insert_device_mac_address_table(device_name:str, mac_address_table:dict, timestamp:float, max_history=DEFAULT_DEVICE_MAX_HISTORY):
@@ -181,6 +199,7 @@ def insert_device_mac_address_table(device_name:str, mac_address_table:dict, tim
         timestamp (float): 実行した時点のタイムスタンプ
         max_history (int, optional): 何個まで保存するか Defaults to DEFAULT_MAX_HISTORY.
     """
+    # MACアドレスの観測インデックスと差分履歴にも反映される
     insert_device_data(device_name, 'mac_address_table', mac_address_table, timestamp, max_history)
 
 
@@ -209,8 +228,103 @@ def get_mac_address_table():
     return get_documents('mac_address_table')
 
 
+def build_device_mac_address_table_observations(device_name:str=None):
+    """
+    MACアドレステーブルの全履歴からMACアドレスの観測インデックスを作り直す
+
+    Args:
+        device_name (str, optional): 装置名、省略した場合は全ての装置. Defaults to None.
+    """
+    if device_name is None:
+        docs = get_mac_address_table()
+    else:
+        docs = get_device_mac_address_table(device_name)
+
+    by_device = {}
+    for doc in docs:
+        by_device.setdefault(doc['device_name'], []).append(doc)
+
+    with ensure_session():
+        for name, device_docs in by_device.items():
+            source_key = get_source_key(SOURCE_MAC_ADDRESS_TABLE, name)
+            rebuild_mac_observations(source_key, device_docs, lambda doc: mac_address_table_observations(doc['device_name'], doc['doc_data']))
+
+
+def mac_address_table_entries(mac_address_table:dict) -> list:
+    """
+    parse()したMACアドレステーブルを差分を取るために平らなリストにする
+
+    Returns:
+        list: [{'vlan': '1', 'mac_address': '0000.5e00.0101', 'interface': 'FastEthernet0/7', 'entry_type': 'dynamic'}, ...]
+    """
+    results = []
+    vlans = mac_address_table.get('mac_table', {}).get('vlans', {})
+    for vlan_id, vlan in vlans.items():
+        for mac_addr, d in vlan.get('mac_addresses', {}).items():
+            for intf, intf_data in d.get('interfaces', {}).items():
+                results.append({
+                    'vlan': vlan_id,
+                    'mac_address': mac_addr,
+                    'interface': intf,
+                    'entry_type': intf_data.get('entry_type', '')
+                })
+    return results
+
+
+def build_device_mac_address_table_diffs(device_name:str):
+    """
+    装置のMACアドレステーブルの全履歴から差分履歴を作り直す
+
+    Args:
+        device_name (str): 装置名
+    """
+    get_device_table(device_name, 'mac_address_table').build_diffs()
+
+
+def get_device_mac_address_table_diff(device_name:str, since:float=None) -> list:
+    """
+    装置のMACアドレステーブルの隣り合うスナップショットの差分を新しい順に返却する
+
+    Args:
+        device_name (str): 装置名
+        since (float, optional): 新しい方のタイムスタンプがこれ以降、この値を含む. Defaults to None.
+
+    Returns:
+        list: [{'timestamp_before': xxx, 'timestamp_after': xxx, 'add': [...], 'delete': [...]}, ...]
+    """
+    return get_device_table(device_name, 'mac_address_table').diff(since=since)
+
+
+def search_device_mac_address_table(mac_address:str) -> list:
+    """
+    MACアドレスを学習していた装置とインタフェースを新しい順に返却する
+
+    Args:
+        mac_address (str): MACアドレス、形式は問わない
+
+    Returns:
+        list: [{'timestamp': xxx, 'device_name': xxx, 'interface': xxx}, ...]
+    """
+    with ensure_session():
+        # インデックスが一つも作られていなければ作る
+        prefix = get_source_key(SOURCE_MAC_ADDRESS_TABLE, '')
+        if not any(key.startswith(prefix) for key in get_mac_observations_sources()):
+            build_device_mac_address_table_observations()
+
+        runs = get_mac_observations(mac_address, source=SOURCE_MAC_ADDRESS_TABLE)
+
+        history = []
+        for device_name in {run['device'] for run in runs}:
+            timestamps = get_device_table(device_name, 'mac_address_table').timestamps()
+            device_runs = [run for run in runs if run['device'] == device_name]
+            for ts, run in expand_observations(device_runs, timestamps):
+                history.append({'timestamp': ts, 'device_name': device_name, 'interface': run['interface']})
+
+    return sorted(history, key=lambda d: d['timestamp'], reverse=True)
+
+
 
-def insert_device_intf_info(device_name:str, intf_info:dict, timestamp:float, max_history=2):
+def insert_device_intf_info(device_name:str, intf_info:dict, timestamp:float, max_history=DEVICE_MAX_HISTORY['intf_info']):
     """
     学習したインタフェース情報をデータベースに保存する。
 
@@ -218,7 +332,7 @@ def insert_device_intf_info(device_name:str, intf_info:dict, timestamp:float, ma
         device_name (str): 学習した装置の名前
         intf_info (dict): 学習したインタフェース情報
         timestamp (float): 実行した時点のタイムスタンプ
-        max_history (int, optional): 何個まで保存するか Defaults to 2.
+        max_history (int, optional): 何個まで保存するか Defaults to DEVICE_MAX_HISTORY['intf_info'].
     """
     insert_device_data(device_name, 'intf_info', intf_info, timestamp, max_history)
 
@@ -241,8 +355,7 @@ def dump():
 
     try:
         for device_name in devices:
-            docs = get_device_mac_address_table(device_name=device_name)
-            for d in docs:
+            for d in iter_device_documents(device_name, 'mac_address_table'):
                 pprint(d)
     except (BrokenPipeError, IOError):
         # lessにパイプしたときのBrokenPipeError: [Errno 32] Broken pipeを避ける
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+#
+# 保存期間の管理
+#
+# これまでは挿入のたびに古いものを削除していたが、
+# 件数と経過時間のポリシーをテーブルごとにまとめて適用するエンジンを用意する。
+#
+# ポリシーの形式
+# {
+#     'max_history': 残す数（Noneは無制限）,
+#     'max_age': 残す秒数（Noneは無制限）,
+#     'source_key': 削除に合わせて掃除するMACアドレス観測インデックスと差分履歴のキー（省略可）
+#     'archive': 削除する前にアーカイブに移すかどうか（省略可、archive.py参照）
+# }
+#
+# PYATSテーブルのように装置とドキュメントタイプごとに履歴を持つテーブルは
+# 'group_by' でグループ化するキーを、'policy' でグループごとのポリシーを返す関数を指定する。
+#
+# 全てのテーブルを一つのセッションの中で処理するので、書き込みは最後の一回だけになる。
+#
+# 環境変数 DB_UTIL_RETENTION_MODE=scheduled にすると挿入時の削除を行わなくなるので、
+# cronなどで定期的に python retention.py -r を実行する。
+#
+# イベントのファイル（events.py参照）も同じタイミングで切り替え、古いものを削除する。
+#
+
+import logging
+import os
+import time
+
+try:
+    from .db_session import open_db, ensure_session
+    from .snapshot_history import delete_old_snapshots, get_snapshot_timestamps, iter_snapshot_documents
+    from .mac_observations_table import prune_mac_observations
+    from .snapshot_diffs_table import prune_snapshot_diffs
+    from .archive import append_archive
+    from .events import get_event_log_age, rotate_event_log
+except ImportError:
+    from db_session import open_db, ensure_session
+    from snapshot_history import delete_old_snapshots, get_snapshot_timestamps, iter_snapshot_documents
+    from mac_observations_table import prune_mac_observations
+    from snapshot_diffs_table import prune_snapshot_diffs
+    from archive import append_archive
+    from events import get_event_log_age, rotate_event_log
+
+# 削除のタイミング
+RETENTION_MODE_INLINE = 'inline'
+RETENTION_MODE_SCHEDULED = 'scheduled'
+
+RETENTION_MODE = os.environ.get('DB_UTIL_RETENTION_MODE', RETENTION_MODE_INLINE)
+
+logger = logging.getLogger(__name__)
+
+
+def set_retention_mode(mode:str):
+    global RETENTION_MODE
+
+    if mode not in (RETENTION_MODE_INLINE, RETENTION_MODE_SCHEDULED):
+        raise ValueError(f'unknown retention mode: {mode}')
+
+    RETENTION_MODE = mode
+
+
+def get_retention_mode() -> str:
+    return RETENTION_MODE
+
+
+def is_inline_retention() -> bool:
+    """
+    挿入のたびに古いものを削除するかどうか
+    """
+    return RETENTION_MODE == RETENTION_MODE_INLINE
+
+
+def count_retained(timestamps:list, max_history:int=None, max_age:float=None, now:float=None) -> int:
+    """
+    ポリシーに従って残すタイムスタンプの数を返却する
+
+    Args:
+        timestamps (list): タイムスタンプのリスト、降順
+        max_history (int, optional): 残す数. Defaults to None.
+        max_age (float, optional): 残す秒数. Defaults to None.
+        now (float, optional): 現在時刻. Defaults to time.time().
+
+    Returns:
+        int: 新しい方から数えて残す数
+    """
+    retained = len(timestamps)
+
+    if max_history is not None:
+        retained = min(retained, max_history)
+
+    if max_age is not None:
+        oldest = (now or time.time()) - max_age
+        retained = min(retained, len([ts for ts in timestamps if ts >= oldest]))
+
+    return retained
+
+
+def apply_snapshot_retention(table_name:str, max_history:int=None, max_age:float=None, source_key:str=None, archive:bool=False, now:float=None) -> list:
+    """
+    DHCP_CLIENTSのようにスナップショットを格納しているテーブルに保存期間を適用する
+
+    Args:
+        table_name (str): テーブル名
+        max_history (int, optional): 残す数. Defaults to None.
+        max_age (float, optional): 残す秒数. Defaults to None.
+        source_key (str, optional): 掃除する観測インデックスと差分履歴のキー. Defaults to None.
+        archive (bool, optional): 削除する前にアーカイブに移すかどうか. Defaults to False.
+        now (float, optional): 現在時刻. Defaults to time.time().
+
+    Returns:
+        list: 削除したタイムスタンプのリスト、昇順
+    """
+    with ensure_session():
+        timestamps = get_snapshot_timestamps(table_name)
+        retained = count_retained(timestamps, max_history=max_history, max_age=max_age, now=now)
+        if retained == len(timestamps):
+            return []
+
+        if archive:
+            docs = list(iter_snapshot_documents(table_name, until=timestamps[retained]))
+            append_archive(table_name, list(reversed(docs)))
+
+        deleted = delete_old_snapshots(table_name, retained)
+
+        # 削除したスナップショットにしか現れない区間をインデックスから消す
+        if deleted and source_key is not None:
+            prune_mac_observations(source_key, deleted[-1])
+            prune_snapshot_diffs(source_key, deleted[-1])
+
+    return deleted
+
+
+def apply_grouped_retention(table_name:str, group_by:tuple, policy, cond:dict=None, now:float=None) -> int:
+    """
+    グループごとに履歴を持つテーブルに保存期間を適用する
+
+    テーブルを一回だけ読み込み、グループごとに期限切れのドキュメントを削除する。
+
+    Args:
+        table_name (str): テーブル名
+        group_by (tuple): グループ化するキー 例： ('device_name', 'doc_type')
+        policy (function): グループのキーの値のタプルを受け取りポリシーを返す関数
+        cond (dict, optional): 対象を絞り込む条件. Defaults to None.
+        now (float, optional): 現在時刻. Defaults to time.time().
+
+    Returns:
+        int: 削除したドキュメントの数
+    """
+    num_deleted = 0
+
+    with ensure_session():
+        with open_db() as db:
+            docs = db.search(table_name, cond)
+
+        groups = {}
+        for doc in docs:
+            key = tuple(doc.get(k) for k in group_by)
+            groups.setdefault(key, []).append(doc['timestamp'])
+
+        for key, timestamps in groups.items():
+            group_policy = policy(key)
+
+            timestamps.sort(reverse=True)
+            retained = count_retained(timestamps, max_history=group_policy.get('max_history'), max_age=group_policy.get('max_age'), now=now)
+            should_be_deleted = timestamps[retained:]
+            if not should_be_deleted:
+                continue
+
+            with open_db() as db:
+                db.remove(table_name, dict(zip(group_by, key), timestamp=should_be_deleted))
+            num_deleted += len(should_be_deleted)
+
+            source_key = group_policy.get('source_key')
+            if source_key is not None:
+                prune_mac_observations(source_key, should_be_deleted[0])
+                prune_snapshot_diffs(source_key, should_be_deleted[0])
+
+    return num_deleted
+
+
+def get_default_policies() -> dict:
+    """
+    各テーブルの既定のポリシーを返却する
+    """
+    # テーブルのモジュールはこのモジュールを参照しているので、ここで読み込む
+    try:
+        from .dhcp_clients_table import DHCP_CLIENTS_TABLE
+        from .wlc_clients_table import WLC_CLIENTS_TABLE
+        from .pyats_table import TABLE_PYATS, device_retention_policy
+    except ImportError:
+        from dhcp_clients_table import DHCP_CLIENTS_TABLE
+        from wlc_clients_table import WLC_CLIENTS_TABLE
+        from pyats_table import TABLE_PYATS, device_retention_policy
+
+    return {
+        DHCP_CLIENTS_TABLE.table_name: DHCP_CLIENTS_TABLE.retention_policy(),
+        WLC_CLIENTS_TABLE.table_name: WLC_CLIENTS_TABLE.retention_policy(),
+        TABLE_PYATS: {'group_by': ('device_name', 'doc_type'), 'policy': device_retention_policy},
+    }
+
+
+def run_retention(policies:dict=None, max_age:float=None, now:float=None) -> dict:
+    """
+    全てのテーブルにポリシーを適用する
+
+    Args:
+        policies (dict, optional): テーブル名をキーにしたポリシー. Defaults to get_default_policies().
+        max_age (float, optional): 全てのテーブルに追加で適用する残す秒数. Defaults to None.
+        now (float, optional): 現在時刻. Defaults to time.time().
+
+    Returns:
+        dict: テーブル名をキーにした削除した数
+    """
+    policies = policies or get_default_policies()
+    now = now or time.time()
+
+    def with_max_age(policy:dict) -> dict:
+        if max_age is None:
+            return policy
+        if policy.get('max_age') is not None and policy['max_age'] < max_age:
+            return policy
+        return dict(policy, max_age=max_age)
+
+    results = {}
+
+    with ensure_session():
+        for table_name, policy in policies.items():
+            if 'group_by' in policy:
+                results[table_name] = apply_grouped_retention(table_name, policy['group_by'], lambda key, p=policy['policy']: with_max_age(p(key)), now=now)
+            else:
+                policy = with_max_age(policy)
+                deleted = apply_snapshot_retention(table_name, max_history=policy.get('max_history'), max_age=policy.get('max_age'), source_key=policy.get('source_key'), archive=policy.get('archive', False), now=now)
+                results[table_name] = len(deleted)
+
+            logger.info(f'{table_name}: {results[table_name]} deleted')
+
+    # イベントのファイルも切り替えて、古いものを削除する
+    event_log_age = get_event_log_age()
+    if max_age is not None and max_age < event_log_age:
+        event_log_age = max_age
+    rotate_event_log(max_age=event_log_age, now=now)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_retention():
+        try:
+            from db_session import DbSession
+            from events import EVENT_LOG_PATH, set_event_log_path, get_rotated_event_logs
+        except ImportError:
+            from .db_session import DbSession
+            from .events import EVENT_LOG_PATH, set_event_log_path, get_rotated_event_logs
+
+        assert 3 == count_retained([5.0, 4.0, 3.0, 2.0], max_history=3)
+        assert 2 == count_retained([5.0, 4.0, 3.0, 2.0], max_history=3, max_age=1.0, now=5.0)
+
+        # 本番のevents.jsonlを切り替えないように一時ファイルにする
+        event_log_path = EVENT_LOG_PATH
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_log_path = os.path.join(tmp_dir, 'events.jsonl')
+            set_event_log_path(tmp_log_path)
+            try:
+                with open(tmp_log_path, 'w') as f:
+                    f.write('{}\n')
+
+                with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                    with open_db() as db:
+                        for i in range(5):
+                            db.insert('TEST_SNAPSHOTS', {'timestamp': float(i), 'doc_data': []})
+                            db.insert('TEST_GROUPS', {'device_name': 'a', 'doc_type': 'x', 'timestamp': float(i)})
+                            db.insert('TEST_GROUPS', {'device_name': 'b', 'doc_type': 'x', 'timestamp': float(i)})
+
+                    policies = {
+                        'TEST_SNAPSHOTS': {'max_history': 3},
+                        'TEST_GROUPS': {'group_by': ('device_name', 'doc_type'), 'policy': lambda key: {'max_history': 1 if key[0] == 'a' else 4}},
+                    }
+                    assert {'TEST_SNAPSHOTS': 2, 'TEST_GROUPS': 6} == run_retention(policies, max_age=2.5, now=4.0)
+
+                    assert [4.0, 3.0, 2.0] == get_snapshot_timestamps('TEST_SNAPSHOTS')
+                    with open_db() as db:
+                        assert [4.0] == [d['timestamp'] for d in db.search('TEST_GROUPS', {'device_name': 'a'})]
+                        assert [2.0, 3.0, 4.0] == sorted(d['timestamp'] for d in db.search('TEST_GROUPS', {'device_name': 'b'}))
+
+                # イベントのファイルは切り替えられている
+                assert not os.path.exists(tmp_log_path)
+                assert 1 == len(get_rotated_event_logs(tmp_log_path))
+            finally:
+                set_event_log_path(event_log_path)
+
+        logger.info('test retention pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-r', '--run', action='store_true', default=False, help='apply retention policies to all tables')
+    parser.add_argument('--max-age-days', dest='max_age_days', type=float, help='also delete documents older than this')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_retention()
+            return 0
+
+        if args.run:
+            max_age = args.max_age_days * 24 * 60 * 60 if args.max_age_days else None
+            run_retention(max_age=max_age)
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+#
+# スナップショットの差分履歴
+#
+# get_dhcp_clients_diff()は呼ばれるたびに全てのスナップショットを取り出して、
+# 隣り合う2つをリストのまま比較していたので、履歴の長さとクライアントの数の両方に比例して遅くなる。
+#
+# そこでスナップショットを格納するときに直前のスナップショットとの差分を一度だけ計算して保存しておき、
+# 差分の履歴はこのテーブルから返す。
+#
+# {
+#     'source': 'dhcp',
+#     'timestamp': 1668003600.0,
+#     'timestamp_before': 1668000000.0,
+#     'add': [ {}, {} ],
+#     'delete': [ {} ]
+# }
+#
+# 'timestamp'は新しい方のスナップショットのタイムスタンプ。直前と同じ内容の場合は保存しない。
+# 要素はsnapshot_history.entry_key()をキーにした集合で比較する。
+#
+# 次の差分を計算するため、取り込み元ごとに直前のスナップショットを別テーブルに保存する。
+#
+# { 'source': 'dhcp', 'timestamp': 1668003600.0, 'doc_data': [ {}, {}, {} ] }
+# { 'source': 'mac_address_table/c3560c-12pc-s', 'timestamp': 1668003600.0, 'doc_data': [ {}, {} ] }
+# { 'source': 'wlc', 'timestamp': 1668003600.0, 'doc_data': [ {}, {} ], 'version': 1 }
+#
+# 比較する要素の取り出し方（SnapshotTableのentries）を変えた場合はversionを変える。
+# 保存されているversionと違う差分履歴は作成されていないものとして扱い、全履歴から作り直す。
+#
+# 取り込み元のキーはMACアドレスの観測インデックスと同じget_source_key()を使う。
+#
+
+import logging
+
+try:
+    from .backend import Range
+    from .db_session import open_db, ensure_session
+    from .snapshot_history import diff_snapshot
+except ImportError:
+    from backend import Range
+    from db_session import open_db, ensure_session
+    from snapshot_history import diff_snapshot
+
+# テーブルの種類
+TABLE_SNAPSHOT_DIFFS = 'SNAPSHOT_DIFFS'
+TABLE_SNAPSHOT_DIFFS_STATE = 'SNAPSHOT_DIFFS_STATE'
+
+logger = logging.getLogger(__name__)
+
+
+def has_snapshot_diffs(source_key:str, version:int=None) -> bool:
+    """
+    取り込み元の差分履歴が作成済みかどうか
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        version (int, optional): 要素の取り出し方のバージョン、違うものは作成されていないものとする. Defaults to None.
+    """
+    with open_db() as db:
+        state = db.get(TABLE_SNAPSHOT_DIFFS_STATE, {'source': source_key})
+    return state is not None and state.get('version') == version
+
+
+def get_snapshot_diffs_timestamp(source_key:str) -> float:
+    """
+    差分履歴に最後に反映したスナップショットのタイムスタンプを返却する、作成されていなければNone
+    """
+    with open_db() as db:
+        state = db.get(TABLE_SNAPSHOT_DIFFS_STATE, {'source': source_key})
+    return state['timestamp'] if state is not None else None
+
+
+def update_snapshot_diffs(source_key:str, timestamp:float, doc_data:list, version:int=None) -> dict:
+    """
+    一つのスナップショットを直前のものと比較して差分を保存する
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        timestamp (float): スナップショットのタイムスタンプ
+        doc_data (list): スナップショットの要素のリスト
+        version (int, optional): 要素の取り出し方のバージョン. Defaults to None.
+
+    Returns:
+        dict: 保存した差分 {'timestamp_before': xxx, 'timestamp_after': xxx, 'add': [...], 'delete': [...]}、違いがなければNone
+    """
+    diff = None
+
+    with ensure_session():
+        with open_db() as db:
+            state = db.get(TABLE_SNAPSHOT_DIFFS_STATE, {'source': source_key})
+
+            if state is not None:
+                # 古いスナップショットを後から取り込むことはしない
+                if timestamp <= state['timestamp']:
+                    return None
+
+                added, deleted = diff_snapshot(state['doc_data'], doc_data)
+                if added or deleted:
+                    db.insert(TABLE_SNAPSHOT_DIFFS, {
+                        'source': source_key,
+                        'timestamp': timestamp,
+                        'timestamp_before': state['timestamp'],
+                        'add': added,
+                        'delete': deleted
+                    })
+                    diff = {'timestamp_before': state['timestamp'], 'timestamp_after': timestamp, 'add': added, 'delete': deleted}
+
+            new_state = {'source': source_key, 'timestamp': timestamp, 'doc_data': doc_data}
+            if version is not None:
+                new_state['version'] = version
+            db.remove(TABLE_SNAPSHOT_DIFFS_STATE, {'source': source_key})
+            db.insert(TABLE_SNAPSHOT_DIFFS_STATE, new_state)
+
+    return diff
+
+
+def prune_snapshot_diffs(source_key:str, deleted_until:float):
+    """
+    保存期間を過ぎたスナップショットとの差分を削除する
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        deleted_until (float): 削除したスナップショットのうち一番新しいもののタイムスタンプ
+    """
+    with open_db() as db:
+        db.remove(TABLE_SNAPSHOT_DIFFS, {'source': source_key, 'timestamp_before': Range(until=deleted_until)})
+
+
+def drop_snapshot_diffs(source_key:str):
+    """
+    取り込み元の差分履歴を削除する、次に参照したときに作り直される
+    """
+    with open_db() as db:
+        db.remove(TABLE_SNAPSHOT_DIFFS_STATE, {'source': source_key})
+        db.remove(TABLE_SNAPSHOT_DIFFS, {'source': source_key})
+
+
+def rebuild_snapshot_diffs(source_key:str, docs:list, extract:callable, version:int=None):
+    """
+    スナップショットの履歴から差分履歴を作り直す
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        docs (list): timestampキーを持つスナップショットのリスト
+        extract (callable): スナップショットから比較する要素のリストを取り出す関数
+        version (int, optional): 要素の取り出し方のバージョン. Defaults to None.
+    """
+    with ensure_session():
+        drop_snapshot_diffs(source_key)
+        for doc in sorted(docs, key=lambda d: d['timestamp']):
+            update_snapshot_diffs(source_key, doc['timestamp'], extract(doc), version=version)
+
+    logger.info(f'snapshot diffs rebuilt: {source_key} {len(docs)} snapshots')
+
+
+def get_snapshot_diffs(source_key:str, since:float=None, until:float=None) -> list:
+    """
+    差分の履歴を新しい順に返却する
+
+    Args:
+        source_key (str): get_source_key()で作成したキー
+        since (float, optional): 新しい方のタイムスタンプがこれ以降、この値を含む. Defaults to None.
+        until (float, optional): 新しい方のタイムスタンプがこれ以前、この値を含む. Defaults to None.
+
+    Returns:
+        list: [{'timestamp_before': xxx, 'timestamp_after': xxx, 'add': [...], 'delete': [...]}, ...]
+    """
+    cond = {'source': source_key}
+    if since is not None or until is not None:
+        cond['timestamp'] = Range(since, until)
+
+    with open_db() as db:
+        docs = db.search(TABLE_SNAPSHOT_DIFFS, cond)
+
+    results = []
+    for doc in sorted(docs, key=lambda d: d['timestamp'], reverse=True):
+        results.append({
+            'timestamp_before': doc['timestamp_before'],
+            'timestamp_after': doc['timestamp'],
+            'add': doc['add'],
+            'delete': doc['delete']
+        })
+    return results
+
+
+def compute_snapshot_diffs(docs:list, extract:callable=None) -> list:
+    """
+    保存していないスナップショットの履歴から差分の履歴を計算する
+
+    Args:
+        docs (list): timestampキーを持つスナップショットのリスト、順番は問わない
+        extract (callable, optional): スナップショットから比較する要素のリストを取り出す関数. Defaults to doc['doc_data'].
+
+    Returns:
+        list: get_snapshot_diffs()と同じ形式、新しい順
+    """
+    extract = extract or (lambda doc: doc['doc_data'])
+
+    results = []
+    before = None
+    for doc in sorted(docs, key=lambda d: d['timestamp']):
+        after = extract(doc)
+        if before is not None:
+            added, deleted = diff_snapshot(before[1], after)
+            if added or deleted:
+                results.append({'timestamp_before': before[0], 'timestamp_after': doc['timestamp'], 'add': added, 'delete': deleted})
+        before = (doc['timestamp'], after)
+
+    return list(reversed(results))
+
+
+if __name__ == '__main__':
+
+    import os
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_snapshot_diffs():
+        try:
+            from db_session import DbSession
+        except ImportError:
+            from .db_session import DbSession
+
+        a = {'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}
+        b = {'ip': '192.168.122.107', 'mac': '04:03:D6:D8:57:5F'}
+        c = {'ip': '192.168.122.109', 'mac': '3C:22:FB:7B:85:0E'}
+        docs = [{'timestamp': float(i), 'doc_data': doc_data} for i, doc_data in enumerate([[a, b], [b, a], [a, b, c], [c]])]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                assert not has_snapshot_diffs('test')
+                for doc in docs:
+                    update_snapshot_diffs('test', doc['timestamp'], doc['doc_data'])
+                assert has_snapshot_diffs('test')
+
+                # 並び順が変わっただけのものは差分にならない
+                diffs = get_snapshot_diffs('test')
+                assert [(2.0, 3.0, [], [a, b]), (1.0, 2.0, [c], [])] == [(d['timestamp_before'], d['timestamp_after'], d['add'], d['delete']) for d in diffs]
+                assert diffs == compute_snapshot_diffs(docs)
+                assert diffs[:1] == get_snapshot_diffs('test', since=3.0)
+
+                # 古いものは取り込まない
+                update_snapshot_diffs('test', 1.5, [])
+                assert 2 == len(get_snapshot_diffs('test'))
+
+                prune_snapshot_diffs('test', 1.0)
+                assert diffs[:1] == get_snapshot_diffs('test')
+
+                rebuild_snapshot_diffs('test', docs, lambda doc: doc['doc_data'])
+                assert diffs == get_snapshot_diffs('test')
+
+                # バージョンが違う差分履歴は作成されていないものとする
+                assert not has_snapshot_diffs('test', 1)
+                rebuild_snapshot_diffs('test', docs, lambda doc: doc['doc_data'], version=1)
+                assert has_snapshot_diffs('test', 1)
+                assert not has_snapshot_diffs('test')
+
+        logger.info('test snapshot diffs pass')
+
+    def main():
+        test_snapshot_diffs()
+        return 0
+
+    sys.exit(main())
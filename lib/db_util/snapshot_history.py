@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+
+#
+# スナップショット履歴の格納形式
+#
+# DHCP_CLIENTSやWLC_CLIENTSは1時間に1回クライアントの一覧を丸ごと格納しているが、
+# 連続するスナップショットはほとんど同じなので、差分で格納するモードを用意する。
+#
+# 従来の形式（full）
+# { 'timestamp': t, 'doc_data': [ {}, {}, {} ] }
+#
+# 差分の形式（delta）
+# キーフレーム： 一覧を丸ごと持つ
+# { 'timestamp': t0, 'timestamps': [t0, t1, t2], 'doc_data': [ {}, {}, {} ] }
+#
+# 差分： 直前のスナップショットからの追加と削除だけを持つ
+# { 'timestamp': t3, 'timestamps': [t3, t4], 'add': [ {} ], 'delete': [ {} ] }
+#
+# 直前と同じ内容のスナップショットは新しいドキュメントを作らず、timestampsにタイムスタンプを追加する。
+# 'timestamp'は常にtimestampsの先頭と同じ値。従来の形式はtimestampsが一つだけのキーフレームとして扱う。
+#
+# 最新より古いスナップショットを後から格納する場合は、その直前のキーフレームから後ろを復元し、
+# 間に挟んでから格納し直す。格納済みのタイムスタンプは格納しない。
+#
+# どちらの形式で書き込むかは環境変数 DB_UTIL_SNAPSHOT_MODE で指定する（full または delta）。
+# 読み込みは形式を問わないので、途中で切り替えても構わない。
+#
+
+import json
+import logging
+import os
+
+from bisect import bisect_right
+
+try:
+    from .db_session import open_db, ensure_session
+except ImportError:
+    from db_session import open_db, ensure_session
+
+# 格納形式
+SNAPSHOT_MODE_FULL = 'full'
+SNAPSHOT_MODE_DELTA = 'delta'
+
+SNAPSHOT_MODE = os.environ.get('DB_UTIL_SNAPSHOT_MODE', SNAPSHOT_MODE_FULL)
+
+# 差分がこの数だけ続いたら次はキーフレームにする
+DEFAULT_KEYFRAME_INTERVAL = 24
+
+logger = logging.getLogger(__name__)
+
+
+def set_snapshot_mode(mode:str):
+    global SNAPSHOT_MODE
+
+    if mode not in (SNAPSHOT_MODE_FULL, SNAPSHOT_MODE_DELTA):
+        raise ValueError(f'unknown snapshot mode: {mode}')
+
+    SNAPSHOT_MODE = mode
+
+
+def get_snapshot_mode() -> str:
+    return SNAPSHOT_MODE
+
+
+def entry_key(d:dict) -> str:
+    """
+    スナップショットの要素を比較するためのキー
+    """
+    return json.dumps(d, sort_keys=True)
+
+
+def entry_timestamps(entry:dict) -> list:
+    return entry.get('timestamps', [entry['timestamp']])
+
+
+def is_keyframe(entry:dict) -> bool:
+    return 'doc_data' in entry
+
+
+def apply_delta(doc_data:list, entry:dict) -> list:
+    """
+    一覧に差分を適用する、残った要素の順番は維持して追加分は末尾に加える
+    """
+    deleted = {entry_key(d) for d in entry.get('delete', [])}
+    result = [d for d in doc_data if entry_key(d) not in deleted]
+    result.extend(entry.get('add', []))
+    return result
+
+
+def diff_snapshot(before:list, after:list) -> tuple:
+    """
+    2つの一覧の差分を返却する
+
+    Returns:
+        tuple: (追加されたもののリスト, 削除されたもののリスト)
+    """
+    before_keys = {entry_key(d) for d in before}
+    after_keys = {entry_key(d) for d in after}
+    added = [d for d in after if entry_key(d) not in before_keys]
+    deleted = [d for d in before if entry_key(d) not in after_keys]
+    return added, deleted
+
+
+def decode_entries(entries:list) -> list:
+    """
+    格納されているドキュメントをタイムスタンプごとのスナップショットに戻す
+
+    Args:
+        entries (list): テーブルから取り出したドキュメントのリスト
+
+    Returns:
+        list: [{'timestamp': xxx, 'doc_data': [...]}, ...] タイムスタンプの昇順
+    """
+    results = []
+    doc_data = []
+    for entry in sorted(entries, key=lambda e: e['timestamp']):
+        if is_keyframe(entry):
+            doc_data = entry['doc_data']
+        else:
+            doc_data = apply_delta(doc_data, entry)
+
+        for ts in entry_timestamps(entry):
+            results.append({'timestamp': ts, 'doc_data': list(doc_data)})
+
+    return results
+
+
+def _replace_entry(db, table_name:str, old_timestamp:float, entry:dict):
+    db.remove(table_name, {'timestamp': old_timestamp})
+    db.insert(table_name, entry)
+
+
+def encode_snapshots(docs:list, keyframe_interval:int=DEFAULT_KEYFRAME_INTERVAL) -> list:
+    """
+    タイムスタンプの昇順に並んだスナップショットを差分の形式のドキュメントにする
+
+    Args:
+        docs (list): [{'timestamp': xxx, 'doc_data': [...]}, ...] タイムスタンプの昇順
+        keyframe_interval (int, optional): キーフレームの間隔. Defaults to DEFAULT_KEYFRAME_INTERVAL.
+
+    Returns:
+        list: 格納するドキュメントのリスト、先頭はキーフレーム
+    """
+    entries = []
+    latest = None
+    since_keyframe = 0
+    for doc in docs:
+        timestamp = doc['timestamp']
+        if entries:
+            added, deleted = diff_snapshot(latest, doc['doc_data'])
+            if not added and not deleted:
+                entries[-1]['timestamps'].append(timestamp)
+                continue
+
+        if not entries or since_keyframe >= keyframe_interval:
+            entries.append({'timestamp': timestamp, 'timestamps': [timestamp], 'doc_data': doc['doc_data']})
+            since_keyframe = 1
+        else:
+            entries.append({'timestamp': timestamp, 'timestamps': [timestamp], 'add': added, 'delete': deleted})
+            since_keyframe += 1
+        latest = doc['doc_data']
+
+    return entries
+
+
+def _insert_backfill(db, table_name:str, entries:list, timestamp:float, doc_data:list, mode:str, keyframe_interval:int):
+    """
+    最新より古いスナップショットを、直前のキーフレームから後ろを格納し直して間に挟む
+    """
+    start = len(entries) - 1
+    while start > 0 and not (is_keyframe(entries[start]) and entries[start]['timestamp'] < timestamp):
+        start -= 1
+
+    docs = decode_entries(entries[start:])
+    docs.append({'timestamp': timestamp, 'doc_data': doc_data})
+    docs.sort(key=lambda d: d['timestamp'])
+
+    if mode == SNAPSHOT_MODE_FULL:
+        new_entries = [{'timestamp': d['timestamp'], 'doc_data': d['doc_data']} for d in docs]
+    else:
+        new_entries = encode_snapshots(docs, keyframe_interval)
+
+    db.remove(table_name, {'timestamp': [e['timestamp'] for e in entries[start:]]})
+    db.insert_multiple(table_name, new_entries)
+
+
+def insert_snapshot(table_name:str, timestamp:float, doc_data:list, mode:str=None, keyframe_interval:int=DEFAULT_KEYFRAME_INTERVAL) -> bool:
+    """
+    スナップショットをテーブルに格納する
+
+    Args:
+        table_name (str): テーブル名
+        timestamp (float): 採取した時刻のタイムスタンプ
+        doc_data (list): スナップショット
+        mode (str, optional): 格納形式. Defaults to SNAPSHOT_MODE.
+        keyframe_interval (int, optional): キーフレームの間隔. Defaults to DEFAULT_KEYFRAME_INTERVAL.
+
+    Returns:
+        bool: 格納したかどうか、同じタイムスタンプが格納済みならFalse
+    """
+    mode = mode or SNAPSHOT_MODE
+
+    with ensure_session():
+        with open_db() as db:
+            if mode == SNAPSHOT_MODE_FULL:
+                # 最新のドキュメントより新しければ追加するだけ
+                starts = db.timestamps(table_name)
+                last = db.get(table_name, {'timestamp': max(starts)}) if starts else None
+                if last is None or entry_timestamps(last)[-1] < timestamp:
+                    db.insert(table_name, {'timestamp': timestamp, 'doc_data': doc_data})
+                    return True
+
+            entries = sorted(db.all(table_name), key=lambda e: e['timestamp'])
+
+            if any(timestamp in entry_timestamps(e) for e in entries):
+                logger.warning(f'{table_name}: snapshot at {timestamp} already stored')
+                return False
+
+            if not entries:
+                db.insert(table_name, {'timestamp': timestamp, 'timestamps': [timestamp], 'doc_data': doc_data})
+                return True
+
+            if timestamp < entry_timestamps(entries[-1])[-1]:
+                # 後続の差分は直前のスナップショットに対して作られているので格納し直す
+                _insert_backfill(db, table_name, entries, timestamp, doc_data, mode, keyframe_interval)
+                return True
+
+            # 最後のキーフレームから最新のスナップショットを作る
+            start = len(entries) - 1
+            while start > 0 and not is_keyframe(entries[start]):
+                start -= 1
+            latest = decode_entries(entries[start:])[-1]['doc_data']
+
+            added, deleted = diff_snapshot(latest, doc_data)
+            last = entries[-1]
+
+            if not added and not deleted:
+                # 直前と同じなのでタイムスタンプだけ追加する
+                entry = dict(last)
+                entry['timestamps'] = entry_timestamps(last) + [timestamp]
+                _replace_entry(db, table_name, last['timestamp'], entry)
+                return True
+
+            if len(entries) - start >= keyframe_interval:
+                entry = {'timestamp': timestamp, 'timestamps': [timestamp], 'doc_data': doc_data}
+            else:
+                entry = {'timestamp': timestamp, 'timestamps': [timestamp], 'add': added, 'delete': deleted}
+
+            db.insert(table_name, entry)
+    return True
+
+
+def delete_old_snapshots(table_name:str, max_history:int) -> list:
+    """
+    max_historyを超えた古いスナップショットを削除する
+
+    先頭に残ったドキュメントが差分の場合はキーフレームに作り直す
+
+    Args:
+        table_name (str): テーブル名
+        max_history (int): 残すスナップショットの数
+
+    Returns:
+        list: 削除したタイムスタンプのリスト、昇順
+    """
+    with ensure_session():
+        with open_db() as db:
+            entries = sorted(db.all(table_name), key=lambda e: e['timestamp'])
+
+            timestamps = []
+            for entry in entries:
+                timestamps.extend(entry_timestamps(entry))
+
+            excess = len(timestamps) - max_history
+            if excess <= 0:
+                return []
+
+            # 丸ごと消せるドキュメントを数える
+            drop = 0
+            while drop < len(entries) and len(entry_timestamps(entries[drop])) <= excess:
+                excess -= len(entry_timestamps(entries[drop]))
+                drop += 1
+
+            # 差分の起点になるスナップショットを残すため、先頭の切り詰めはデコードした後で行う
+            first = None
+            if drop < len(entries) and (excess > 0 or not is_keyframe(entries[drop])):
+                start = drop
+                while start > 0 and not is_keyframe(entries[start]):
+                    start -= 1
+                decoded = decode_entries(entries[start:drop + 1])
+                first = {
+                    'timestamp': entry_timestamps(entries[drop])[excess],
+                    'timestamps': entry_timestamps(entries[drop])[excess:],
+                    'doc_data': decoded[-1]['doc_data']
+                }
+
+            should_be_deleted = [e['timestamp'] for e in entries[:drop]]
+            if first is not None:
+                should_be_deleted.append(entries[drop]['timestamp'])
+
+            if should_be_deleted:
+                db.remove(table_name, {'timestamp': should_be_deleted})
+            if first is not None:
+                db.insert(table_name, first)
+
+    return timestamps[:len(timestamps) - max_history]
+
+
+def get_snapshot_timestamps(table_name:str) -> list:
+    """
+    タイムスタンプの一覧を降順で返却する
+    """
+    with open_db() as db:
+        timestamps = []
+        for entry in db.all(table_name):
+            timestamps.extend(entry_timestamps(entry))
+
+    timestamps.sort(reverse=True)
+    return timestamps
+
+
+def get_snapshot_documents(table_name:str) -> list:
+    """
+    全てのスナップショットを新しい順に返却する
+    """
+    with open_db() as db:
+        entries = db.all(table_name)
+
+    return list(reversed(decode_entries(entries)))
+
+
+def iter_snapshot_documents(table_name:str, since:float=None, until:float=None, limit:int=None, chunk_size:int=DEFAULT_KEYFRAME_INTERVAL):
+    """
+    スナップショットを新しい順に返すジェネレータ
+
+    ドキュメントの先頭のタイムスタンプを二分探索し、新しい方からchunk_size個ずつ取り出す。
+    差分はその前のキーフレームまで遡ってから復元する。
+
+    Args:
+        table_name (str): テーブル名
+        since (float, optional): これ以降、この値を含む. Defaults to None.
+        until (float, optional): これ以前、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
+        chunk_size (int, optional): 一度に取り出すドキュメントの数. Defaults to DEFAULT_KEYFRAME_INTERVAL.
+
+    Yields:
+        dict: {'timestamp': xxx, 'doc_data': [...]}
+    """
+    with open_db() as db:
+        starts = sorted(db.timestamps(table_name))
+
+    # untilより後に始まるドキュメントは要らない
+    hi = bisect_right(starts, until) if until is not None else len(starts)
+
+    count = 0
+    pending = []
+    while hi > 0:
+        lo = max(0, hi - chunk_size)
+
+        # ジェネレータを止めている間はデータベースを開いたままにしない
+        with open_db() as db:
+            entries = db.search(table_name, {'timestamp': starts[lo:hi]})
+        hi = lo
+
+        for entry in sorted(entries, key=lambda e: e['timestamp'], reverse=True):
+            pending.append(entry)
+            if not is_keyframe(entry):
+                continue
+
+            # キーフレームから復元して新しい順に返す
+            for doc in reversed(decode_entries(pending)):
+                if until is not None and doc['timestamp'] > until:
+                    continue
+                if since is not None and doc['timestamp'] < since:
+                    return
+                yield doc
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            pending = []
+
+            if since is not None and entry['timestamp'] <= since:
+                return
+
+
+def get_snapshot_by_timestamp(table_name:str, timestamp:float):
+    """
+    タイムスタンプを指定してスナップショットを返却する
+
+    Returns:
+        dict: {'timestamp': xxx, 'doc_data': [...]}、存在しなければNone
+    """
+    with open_db() as db:
+        doc = db.get(table_name, {'timestamp': timestamp})
+        if doc is not None and is_keyframe(doc):
+            return {'timestamp': timestamp, 'doc_data': doc['doc_data']}
+
+        entries = sorted(db.all(table_name), key=lambda e: e['timestamp'])
+
+    # 指定されたタイムスタンプを含むドキュメントと、その直前のキーフレームからデコードする
+    for end, entry in enumerate(entries):
+        if timestamp in entry_timestamps(entry):
+            start = end
+            while start > 0 and not is_keyframe(entries[start]):
+                start -= 1
+            for doc in decode_entries(entries[start:end + 1]):
+                if doc['timestamp'] == timestamp:
+                    return doc
+
+    return None
+
+
+def convert_snapshots(table_name:str, mode:str, keyframe_interval:int=DEFAULT_KEYFRAME_INTERVAL):
+    """
+    格納されているスナップショットを指定した形式で格納し直す
+
+    Args:
+        table_name (str): テーブル名
+        mode (str): 格納形式
+        keyframe_interval (int, optional): キーフレームの間隔. Defaults to DEFAULT_KEYFRAME_INTERVAL.
+    """
+    with ensure_session():
+        docs = list(reversed(get_snapshot_documents(table_name)))
+
+        with open_db() as db:
+            db.drop_table(table_name)
+
+        for doc in docs:
+            insert_snapshot(table_name, doc['timestamp'], doc['doc_data'], mode=mode, keyframe_interval=keyframe_interval)
+
+        with open_db() as db:
+            num_entries = len(db.all(table_name))
+
+    logger.info(f'{table_name}: {len(docs)} snapshots stored in {num_entries} documents')
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_snapshot_history():
+        try:
+            from db_session import DbSession
+        except ImportError:
+            from .db_session import DbSession
+
+        table_name = 'TEST_SNAPSHOTS'
+
+        a = {'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}
+        b = {'ip': '192.168.122.107', 'mac': '04:03:D6:D8:57:5F'}
+        c = {'ip': '192.168.122.109', 'mac': '3C:22:FB:7B:85:0E'}
+        snapshots = [[a, b], [a, b], [b, a], [a, b, c], [a, c], [a, c], [c], [], [a]]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                for i, doc_data in enumerate(snapshots):
+                    insert_snapshot(table_name, float(i), doc_data, mode=SNAPSHOT_MODE_DELTA, keyframe_interval=3)
+
+                with open_db() as db:
+                    assert 6 == len(db.all(table_name))
+
+                docs = get_snapshot_documents(table_name)
+                assert [float(i) for i in reversed(range(len(snapshots)))] == [doc['timestamp'] for doc in docs]
+                for doc in docs:
+                    expected = snapshots[int(doc['timestamp'])]
+                    assert sorted(map(entry_key, expected)) == sorted(map(entry_key, doc['doc_data']))
+                    assert sorted(map(entry_key, expected)) == sorted(map(entry_key, get_snapshot_by_timestamp(table_name, doc['timestamp'])['doc_data']))
+
+                docs = list(iter_snapshot_documents(table_name, since=2.0, until=6.0, chunk_size=2))
+                assert [6.0, 5.0, 4.0, 3.0, 2.0] == [doc['timestamp'] for doc in docs]
+                assert [[c], [a, c], [a, c]] == [doc['doc_data'] for doc in docs[:3]]
+                assert [8.0] == [doc['timestamp'] for doc in iter_snapshot_documents(table_name, limit=1)]
+
+                # 差分の途中で切り詰める
+                assert [0.0, 1.0, 2.0, 3.0, 4.0] == delete_old_snapshots(table_name, 4)
+                assert [8.0, 7.0, 6.0, 5.0] == get_snapshot_timestamps(table_name)
+                assert [[a], [], [c], [a, c]] == [doc['doc_data'] for doc in get_snapshot_documents(table_name)]
+
+            for mode in (SNAPSHOT_MODE_DELTA, SNAPSHOT_MODE_FULL):
+                with DbSession(db_path=os.path.join(tmp_dir, f'{mode}.json'), backend='tinydb'):
+                    # 後から古いスナップショットを格納しても、後続のスナップショットは変わらない
+                    x = {'ip': '192.168.122.110', 'mac': '00:00:5E:00:01:01'}
+                    for ts, doc_data in [(1.0, [a]), (2.0, [a, b]), (3.0, [a, b]), (4.0, [b])]:
+                        assert insert_snapshot(table_name, ts, doc_data, mode=SNAPSHOT_MODE_DELTA, keyframe_interval=3)
+                    assert insert_snapshot(table_name, 1.5, [x], mode=mode, keyframe_interval=3)
+                    assert insert_snapshot(table_name, 3.5, [a, b], mode=mode, keyframe_interval=3)
+                    assert insert_snapshot(table_name, 0.5, [c], mode=mode, keyframe_interval=3)
+                    expected = [(4.0, [b]), (3.5, [a, b]), (3.0, [a, b]), (2.0, [a, b]), (1.5, [x]), (1.0, [a]), (0.5, [c])]
+                    assert expected == [(doc['timestamp'], doc['doc_data']) for doc in get_snapshot_documents(table_name)]
+                    assert expected == [(doc['timestamp'], doc['doc_data']) for doc in iter_snapshot_documents(table_name, chunk_size=1)]
+                    assert [a, b] == get_snapshot_by_timestamp(table_name, 3.0)['doc_data']
+
+                    # 格納済みのタイムスタンプは格納しない
+                    assert not insert_snapshot(table_name, 3.0, [c], mode=mode)
+                    assert not insert_snapshot(table_name, 4.0, [c], mode=mode)
+                    assert expected == [(doc['timestamp'], doc['doc_data']) for doc in get_snapshot_documents(table_name)]
+
+        logger.info('test snapshot history pass')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('--convert', nargs=2, metavar=('TABLE', 'MODE'), help='store table again in full or delta mode')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_snapshot_history()
+            return 0
+
+        if args.convert:
+            convert_snapshots(args.convert[0], args.convert[1])
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
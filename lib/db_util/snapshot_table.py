@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+
+#
+# スナップショットの履歴を持つテーブル
+#
+# DHCP_CLIENTS、WLC_CLIENTS、PYATSの装置ごとのmac_address_tableは、
+# どれも一定の間隔で採取した一覧をタイムスタンプ付きで蓄積していて、
+# 格納、保存期間の適用、タイムスタンプの一覧、新しい順の読み出し、MACアドレスでの検索、差分、といった処理は同じ。
+#
+# これまでは同じ処理がテーブルごとのモジュールに書かれていたので、SnapshotTableクラスにまとめて、
+# 各テーブルはこのクラスのインスタンスとして宣言する。
+#
+# DHCP_CLIENTS = SnapshotTable('DHCP_CLIENTS', 168, source_key='dhcp', mac_key='mac', observations=dhcp_observations)
+#
+# 格納形式は2通りある。
+#
+# condを指定しない場合は一つのテーブルを占有し、snapshot_history.pyの形式（fullまたはdelta）で格納する。
+# 保存期間を過ぎたものはアーカイブに移せる（archive.py参照）。
+#
+# condを指定した場合はPYATSのように一つのテーブルを複数の履歴で共有し、
+# condのキーと値を付けたドキュメントを一つずつ格納する。
+# { 'device_name': xxx, 'doc_type': xxx, 'doc_data': {...}, 'timestamp': xxx }
+#
+# source_keyを指定すると、格納するたびにMACアドレスの観測インデックス（mac_observations_table.py）と
+# 差分履歴（snapshot_diffs_table.py）を更新し、差分からイベント（events.py）を通知する。
+# どちらも時刻が進む前提で更新するので、最新より古いスナップショットを後から格納した場合は全履歴から作り直す。
+# この場合イベントは通知しない。
+#
+
+import logging
+
+from datetime import datetime
+
+try:
+    from .db_session import open_db, ensure_session
+    from .retention import is_inline_retention, apply_snapshot_retention, apply_grouped_retention
+    from .snapshot_history import insert_snapshot, get_snapshot_timestamps, get_snapshot_documents
+    from .history_iter import iter_history_documents, get_sorted_timestamps
+    from .archive import iter_snapshot_documents_with_archive, get_snapshot_by_timestamp_with_archive, get_archive_age, is_archive_enabled
+    from .mac_observations_table import has_mac_observations, update_mac_observations, rebuild_mac_observations
+    from .mac_observations_table import get_mac_observations, expand_observations, get_source_key
+    from .snapshot_diffs_table import has_snapshot_diffs, update_snapshot_diffs, rebuild_snapshot_diffs, get_snapshot_diffs, compute_snapshot_diffs
+    from .snapshot_diffs_table import get_snapshot_diffs_timestamp
+    from .events import diff_events, publish_events
+except ImportError:
+    from db_session import open_db, ensure_session
+    from retention import is_inline_retention, apply_snapshot_retention, apply_grouped_retention
+    from snapshot_history import insert_snapshot, get_snapshot_timestamps, get_snapshot_documents
+    from history_iter import iter_history_documents, get_sorted_timestamps
+    from archive import iter_snapshot_documents_with_archive, get_snapshot_by_timestamp_with_archive, get_archive_age, is_archive_enabled
+    from mac_observations_table import has_mac_observations, update_mac_observations, rebuild_mac_observations
+    from mac_observations_table import get_mac_observations, expand_observations, get_source_key
+    from snapshot_diffs_table import has_snapshot_diffs, update_snapshot_diffs, rebuild_snapshot_diffs, get_snapshot_diffs, compute_snapshot_diffs
+    from snapshot_diffs_table import get_snapshot_diffs_timestamp
+    from events import diff_events, publish_events
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotTable:
+    """
+    スナップショットの履歴を持つテーブル
+
+    Args:
+        table_name (str): テーブル名
+        max_history (int): 保管する履歴の数
+        source_key (str, optional): 観測インデックス、差分履歴、イベントのキー、Noneの場合は作らない.
+            observationsが返す観測情報からget_source_key()で作るキーと同じにすること. Defaults to None.
+        mac_key (str, optional): イベントを作るときの要素のMACアドレスのキー、Noneの場合は通知しない. Defaults to None.
+        observations (callable, optional): doc_dataから観測情報のリストを取り出す関数. Defaults to None.
+        entries (callable, optional): doc_dataから差分を取る要素のリストを取り出す関数. Defaults to doc_dataそのもの.
+        entries_version (int, optional): entriesの取り出し方を変えたときに上げる番号、保存済みの差分履歴と違えば作り直す. Defaults to None.
+        cond (dict, optional): テーブルを共有する場合にこの履歴のドキュメントを表す条件. Defaults to None.
+        archive (bool, optional): 保存期間を過ぎたものをアーカイブに移すかどうか. Defaults to False.
+    """
+
+    def __init__(self, table_name:str, max_history:int, source_key:str=None, mac_key:str=None,
+                 observations:callable=None, entries:callable=None, entries_version:int=None, cond:dict=None, archive:bool=False) -> None:
+        self.table_name = table_name
+        self.max_history = max_history
+        self.source_key = source_key
+        self.mac_key = mac_key
+        self.observations = observations
+        self.entries = entries or (lambda doc_data: doc_data)
+        self.entries_version = entries_version
+        self.cond = cond
+        self.archive = archive
+
+
+    def __repr__(self) -> str:
+        return f'SnapshotTable({self.table_name}, cond={self.cond})'
+
+
+    #
+    # 格納
+    #
+
+    def insert(self, doc_data, timestamp:float, max_history:int=None):
+        """
+        スナップショットを格納し、保存期間を適用して、インデックスを更新する
+
+        Args:
+            doc_data (object): スナップショット
+            timestamp (float): 採取した時刻のタイムスタンプ
+            max_history (int, optional): 蓄積する数. Defaults to self.max_history.
+        """
+        # 挿入と削除を一回の読み込みと書き込みにまとめる
+        with ensure_session():
+            backfill = self._is_backfill(timestamp)
+            self._store(doc_data, timestamp)
+
+            # max_historyを超えた古いものを削除、定期実行に任せる場合は何もしない
+            if is_inline_retention():
+                self.delete_old(max_history)
+
+            if backfill:
+                self._rebuild_indexes()
+                events = []
+            else:
+                events = self._update_indexes(doc_data, timestamp)
+
+        # 格納が終わってから通知する
+        publish_events(events)
+
+
+    def insert_many(self, docs:list, max_history:int=None) -> int:
+        """
+        複数のスナップショットを古い順に格納し、保存期間は最後に一度だけ適用する
+
+        格納済みのタイムスタンプのものは飛ばすので、同じものを何度渡してもよい
+
+        Args:
+            docs (list): [{'timestamp': xxx, 'doc_data': ...}, ...]
+            max_history (int, optional): 蓄積する数. Defaults to self.max_history.
+
+        Returns:
+            int: 格納した数
+        """
+        events = []
+        num_inserted = 0
+        backfilled = False
+
+        with ensure_session():
+            stored = set(self.timestamps())
+
+            for doc in sorted(docs, key=lambda d: d['timestamp']):
+                if doc['timestamp'] in stored:
+                    continue
+                if self._is_backfill(doc['timestamp']):
+                    # インデックスは最後に一度だけ作り直す
+                    self._store(doc['doc_data'], doc['timestamp'])
+                    backfilled = True
+                else:
+                    self._store(doc['doc_data'], doc['timestamp'])
+                    events.extend(self._update_indexes(doc['doc_data'], doc['timestamp']))
+                stored.add(doc['timestamp'])
+                num_inserted += 1
+
+            if num_inserted and is_inline_retention():
+                self.delete_old(max_history)
+
+            if backfilled:
+                self._rebuild_indexes()
+
+        publish_events(events)
+        return num_inserted
+
+
+    def _store(self, doc_data, timestamp:float):
+        if self.cond is None:
+            insert_snapshot(self.table_name, timestamp, doc_data)
+            return
+
+        with open_db() as db:
+            db.insert(self.table_name, dict(self.cond, doc_data=doc_data, timestamp=timestamp))
+
+
+    def _is_backfill(self, timestamp:float) -> bool:
+        """
+        差分履歴に反映済みのスナップショットより古いかどうか
+        """
+        if self.source_key is None:
+            return False
+        last = get_snapshot_diffs_timestamp(self.source_key)
+        return last is not None and timestamp < last
+
+
+    def _rebuild_indexes(self):
+        logger.info(f'{self.table_name}: older snapshot stored, rebuilding indexes of {self.source_key}')
+        self.build_observations()
+        self.build_diffs()
+
+
+    def _update_indexes(self, doc_data, timestamp:float) -> list:
+        """
+        観測インデックスと差分履歴に反映する
+
+        Returns:
+            list: 通知するイベントのリスト
+        """
+        if self.source_key is None:
+            return []
+
+        # MACアドレスの観測インデックスに反映する
+        if self.observations is not None:
+            if has_mac_observations(self.source_key):
+                update_mac_observations(self.source_key, timestamp, self.observations(doc_data))
+            else:
+                self.build_observations()
+
+        # 直前のスナップショットとの差分を保存し、差分からイベントを作る
+        if not has_snapshot_diffs(self.source_key, self.entries_version):
+            self.build_diffs()
+            return []
+
+        diff = update_snapshot_diffs(self.source_key, timestamp, self.entries(doc_data), version=self.entries_version)
+        if self.mac_key is None:
+            return []
+        return diff_events(self.source_key, diff, self.mac_key)
+
+
+    #
+    # 保存期間
+    #
+
+    def retention_policy(self, max_history:int=None) -> dict:
+        """
+        このテーブルに適用する保存期間のポリシーを返却する
+
+        Args:
+            max_history (int, optional): 蓄積する数. Defaults to self.max_history.
+
+        Returns:
+            dict: retention.pyのポリシー
+        """
+        policy = {'max_history': self.max_history if max_history is None else max_history}
+
+        # 削除したスナップショットにしか現れない区間をインデックスから消す
+        if self.source_key is not None:
+            policy['source_key'] = self.source_key
+
+        # アーカイブする場合は期間を過ぎたものも削除し、削除する前にアーカイブに移す
+        if self.cond is None and self.archive and is_archive_enabled():
+            policy['max_age'] = get_archive_age()
+            policy['archive'] = True
+
+        return policy
+
+
+    def delete_old(self, max_history:int=None):
+        """
+        保存期間を過ぎたスナップショットを削除する
+
+        Args:
+            max_history (int, optional): 蓄積する数. Defaults to self.max_history.
+        """
+        policy = self.retention_policy(max_history)
+
+        if self.cond is None:
+            apply_snapshot_retention(self.table_name, **policy)
+            return
+
+        apply_grouped_retention(self.table_name, tuple(self.cond.keys()), lambda group: policy, cond=self.cond)
+
+
+    #
+    # 読み出し
+    #
+
+    def timestamps(self) -> list:
+        """
+        タイムスタンプの一覧を降順で返却する
+        """
+        if self.cond is None:
+            return get_snapshot_timestamps(self.table_name)
+
+        # ドキュメントは取り出さずにtimestampキーの一覧だけを取り出す
+        return list(reversed(get_sorted_timestamps(self.table_name, self.cond)))
+
+
+    def dates(self) -> list:
+        """
+        タイムスタンプの一覧を分かりやすい日付の文字列にして降順で返却する
+        """
+        return [datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') for ts in self.timestamps()]
+
+
+    def documents(self) -> list:
+        """
+        全てのスナップショットを新しい順に返却する
+        """
+        if self.cond is None:
+            return get_snapshot_documents(self.table_name)
+
+        with open_db() as db:
+            docs = db.search(self.table_name, self.cond)
+
+        return sorted(docs, key=lambda d: d['timestamp'], reverse=True)
+
+
+    def iter_documents(self, since:float=None, until:float=None, limit:int=None):
+        """
+        スナップショットを新しい順に一つずつ返すジェネレータ
+
+        Args:
+            since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+            until (float, optional): これ以前のタイムスタンプ、この値を含む. Defaults to None.
+            limit (int, optional): 最大の数. Defaults to None.
+
+        Yields:
+            dict: ドキュメント
+        """
+        if self.cond is None:
+            # 範囲がデータベースより古い時刻に及ぶ場合はアーカイブからも読み込む
+            yield from iter_snapshot_documents_with_archive(self.table_name, since=since, until=until, limit=limit)
+        else:
+            yield from iter_history_documents(self.table_name, self.cond, since=since, until=until, limit=limit)
+
+
+    def latest(self):
+        """
+        最新のスナップショットを返却する、なければNone
+        """
+        return next(self.iter_documents(limit=1), None)
+
+
+    def by_timestamp(self, timestamp:float):
+        """
+        タイムスタンプを指定してスナップショットを返却する、なければNone
+        """
+        if self.cond is None:
+            return get_snapshot_by_timestamp_with_archive(self.table_name, timestamp)
+
+        with open_db() as db:
+            return db.get(self.table_name, dict(self.cond, timestamp=timestamp))
+
+
+    #
+    # インデックス
+    #
+
+    def build_observations(self):
+        """
+        全履歴からMACアドレスの観測インデックスを作り直す
+        """
+        if self.source_key is None or self.observations is None:
+            return
+        rebuild_mac_observations(self.source_key, self.documents(), lambda doc: self.observations(doc['doc_data']))
+
+
+    def build_diffs(self):
+        """
+        全履歴から差分履歴を作り直す
+        """
+        if self.source_key is None:
+            return
+        rebuild_snapshot_diffs(self.source_key, self.documents(), lambda doc: self.entries(doc['doc_data']), version=self.entries_version)
+
+
+    def find_mac(self, mac_address:str) -> list:
+        """
+        MACアドレスの観測インデックスから、MACアドレスが現れたスナップショットを探す
+
+        Args:
+            mac_address (str): MACアドレス、形式は問わない
+
+        Returns:
+            list: (timestamp, 区間) のタプルのリスト、タイムスタンプの昇順。インデックスを持たないテーブルはNone
+        """
+        if self.source_key is None or self.observations is None:
+            return None
+
+        with ensure_session():
+            if not has_mac_observations(self.source_key):
+                self.build_observations()
+            runs = [run for run in get_mac_observations(mac_address) if get_source_key(run['source'], run.get('device')) == self.source_key]
+            timestamps = self.timestamps()
+
+        return expand_observations(runs, timestamps)
+
+
+    def diff(self, since:float=None) -> list:
+        """
+        隣り合うスナップショットの差分を新しい順に返却する、違いがないものは含まない
+
+        Args:
+            since (float, optional): 新しい方のタイムスタンプがこれ以降、この値を含む. Defaults to None.
+
+        Returns:
+            list: [{'timestamp_before': xxx, 'timestamp_after': xxx, 'add': [...], 'delete': [...]}, ...]
+        """
+        if self.source_key is not None:
+            # 格納したときに計算して保存した差分を返す
+            with ensure_session():
+                if not has_snapshot_diffs(self.source_key, self.entries_version):
+                    self.build_diffs()
+                return get_snapshot_diffs(self.source_key, since=since)
+
+        # 差分を保存していないテーブルは直前の一つ分を余分に読み込んで計算する
+        docs = []
+        for doc in self.iter_documents():
+            docs.append(doc)
+            if since is not None and doc['timestamp'] < since:
+                break
+        diffs = compute_snapshot_diffs(docs, lambda doc: self.entries(doc['doc_data']))
+        return [diff for diff in diffs if since is None or diff['timestamp_after'] >= since]
+
+
+if __name__ == '__main__':
+
+    import os
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_snapshot_table():
+        try:
+            from db_session import DbSession
+            from events import EVENT_LOG_PATH, set_event_log_path, subscribe, unsubscribe
+            from mac_observations_table import dhcp_observations, drop_mac_observations
+            from snapshot_diffs_table import drop_snapshot_diffs
+        except ImportError:
+            from .db_session import DbSession
+            from .events import EVENT_LOG_PATH, set_event_log_path, subscribe, unsubscribe
+            from .mac_observations_table import dhcp_observations, drop_mac_observations
+            from .snapshot_diffs_table import drop_snapshot_diffs
+
+        # 本番の'dhcp'とは別の取り込み元にする
+        source_key = 'test'
+
+        def test_observations(doc_data):
+            return [dict(d, source=source_key) for d in dhcp_observations(doc_data)]
+
+        a = {'ip': '192.168.122.106', 'mac': '28:84:FA:EA:5F:0C'}
+        b = {'ip': '192.168.122.107', 'mac': '04:03:D6:D8:57:5F'}
+        snapshots = [[a], [a, b], [b], [b]]
+
+        # イベントは本番のevents.jsonlではなく一時ファイルに書く
+        event_log_path = EVENT_LOG_PATH
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            set_event_log_path(os.path.join(tmp_dir, 'events.jsonl'))
+            try:
+                with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                    for cond in (None, {'device_name': 'test'}):
+                        table = SnapshotTable('TEST', 3, source_key=source_key, mac_key='mac', observations=test_observations, cond=cond)
+
+                        for i, doc_data in enumerate(snapshots):
+                            table.insert(doc_data, float(i))
+
+                        assert [3.0, 2.0, 1.0] == table.timestamps()
+                        assert [[b], [b], [a, b]] == [doc['doc_data'] for doc in table.documents()]
+                        assert [3.0, 2.0] == [doc['timestamp'] for doc in table.iter_documents(since=2.0)]
+                        assert 3.0 == table.latest()['timestamp']
+                        assert [a, b] == table.by_timestamp(1.0)['doc_data']
+                        assert [1.0] == [ts for ts, _ in table.find_mac(a['mac'])]
+                        assert [(1.0, 2.0)] == [(d['timestamp_before'], d['timestamp_after']) for d in table.diff()]
+
+                        # 格納済みのものは飛ばす
+                        assert 1 == table.insert_many([{'timestamp': 3.0, 'doc_data': [b]}, {'timestamp': 4.0, 'doc_data': [a]}])
+                        assert [4.0, 3.0, 2.0] == table.timestamps()
+
+                        # 最新より古いものを後から格納すると、イベントは通知せずにインデックスを作り直す
+                        received = []
+                        subscribe(received.append)
+                        try:
+                            assert 1 == table.insert_many([{'timestamp': 2.5, 'doc_data': [a]}])
+                            table.insert([a, b], 3.5)
+                        finally:
+                            unsubscribe(received.append)
+                        assert [] == received
+                        assert [4.0, 3.5, 3.0] == table.timestamps()
+                        assert [3.5, 4.0] == [ts for ts, _ in table.find_mac(a['mac'])]
+                        assert [(3.5, 4.0), (3.0, 3.5)] == [(d['timestamp_before'], d['timestamp_after']) for d in table.diff()]
+
+                        # 作り直した後は続けて通知する
+                        table.insert([b], 5.0)
+                        assert [(4.0, 5.0)] == [(d['timestamp_before'], d['timestamp_after']) for d in table.diff(since=5.0)]
+
+                        with open_db() as db:
+                            db.drop_table('TEST')
+                        drop_mac_observations(source_key)
+                        drop_snapshot_diffs(source_key)
+
+                # イベントは一時ファイルに書かれている
+                assert os.path.exists(os.path.join(tmp_dir, 'events.jsonl'))
+            finally:
+                set_event_log_path(event_log_path)
+
+        logger.info('test snapshot table pass')
+
+    def main():
+        test_snapshot_table()
+        return 0
+
+    sys.exit(main())
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+
+#
+# データベースの統計とベンチマーク
+#
+# コレクタが実行間隔に収まらなくなってから気づくのでは遅いので、
+# テーブルごとの大きさと、よく使う操作にかかる時間を確認できるようにする。
+#
+# テーブルごとのドキュメント数、バイト数（JSONにしたときの大きさ）、最古と最新のタイムスタンプ
+# python stats.py -s
+#
+# 本番のデータベースのコピーで各操作の時間を測る（元のファイルには書き込まない）
+# python stats.py -b
+# python stats.py -b --db /path/to/db.json
+#
+# 合成したデータベースで測る（1時間に1回採取したとして720回分、クライアント50台）
+# python stats.py -b --synthetic 720 --clients 50
+#
+# 測る操作
+#   open:    データベースを開いて閉じる
+#   insert:  DHCPクライアントのスナップショットを一つ格納する（保存期間の適用は含まない）
+#   prune:   DHCPクライアントに保存期間を適用する
+#   latest:  最新のDHCPクライアントのスナップショットを読む
+#   by_mac:  MACアドレスでDHCPクライアントの履歴を探す
+#   vendor:  MACアドレスでベンダーを探す（検索結果のキャッシュとインデックスを捨ててから）
+#   vendor_cached: キャッシュにあるMACアドレスでベンダーを探す
+#
+# コレクタは別々のプロセスで動くので、操作ごとにデータベースを開き直し、読み込みのキャッシュも捨てる。
+#
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from datetime import datetime
+
+try:
+    from .backend import BACKEND_SQLITE, get_backend_name, get_default_db_path, get_lock_path
+    from .db_session import DbSession, open_db
+    from .file_lock import FileLock
+    from .storages import clear_read_cache
+    from .retention import RETENTION_MODE_SCHEDULED, get_retention_mode, set_retention_mode
+    from .archive import get_archive_age, set_archive_days
+    from .events import EVENT_LOG_PATH, set_event_log_path
+    from .dhcp_clients_table import DHCP_CLIENTS_TABLE, insert_dhcp_clients, delete_old_dhcp_clients, iter_dhcp_clients_documents, get_dhcp_clients_by_mac
+    from .wlc_clients_table import WLC_CLIENTS_TABLE
+    from .pyats_table import get_device_table
+    from .mac_vendors_table import insert_mac_vendors, search_mac_vendors, get_mac_vendors_all, clear_mac_vendors_index
+    from .mac_vendors_file import is_locally_administered
+except ImportError:
+    from backend import BACKEND_SQLITE, get_backend_name, get_default_db_path, get_lock_path
+    from db_session import DbSession, open_db
+    from file_lock import FileLock
+    from storages import clear_read_cache
+    from retention import RETENTION_MODE_SCHEDULED, get_retention_mode, set_retention_mode
+    from archive import get_archive_age, set_archive_days
+    from events import EVENT_LOG_PATH, set_event_log_path
+    from dhcp_clients_table import DHCP_CLIENTS_TABLE, insert_dhcp_clients, delete_old_dhcp_clients, iter_dhcp_clients_documents, get_dhcp_clients_by_mac
+    from wlc_clients_table import WLC_CLIENTS_TABLE
+    from pyats_table import get_device_table
+    from mac_vendors_table import insert_mac_vendors, search_mac_vendors, get_mac_vendors_all, clear_mac_vendors_index
+    from mac_vendors_file import is_locally_administered
+
+# 合成するデータベースの既定値
+DEFAULT_SYNTHETIC_CLIENTS = 50
+DEFAULT_SYNTHETIC_DEVICES = 2
+DEFAULT_SYNTHETIC_VENDORS = 30000
+
+# 各操作を繰り返す回数
+DEFAULT_REPEAT = 5
+
+logger = logging.getLogger(__name__)
+
+
+def get_table_stats(db_path:str=None, backend:str=None) -> list:
+    """
+    テーブルごとの統計を返却する
+
+    Args:
+        db_path (str, optional): データベースのパス. Defaults to バックエンドごとの既定のパス.
+        backend (str, optional): バックエンドの種類. Defaults to DB_BACKEND.
+
+    Returns:
+        list: [{'table': xxx, 'docs': xxx, 'bytes': xxx, 'oldest': xxx, 'newest': xxx}, ...] テーブル名の順
+    """
+    results = []
+
+    with DbSession(db_path=db_path, backend=backend, readonly=True):
+        with open_db() as db:
+            for table_name in sorted(db.tables()):
+                docs = db.all(table_name)
+
+                timestamps = []
+                for doc in docs:
+                    # 差分の形式で格納したスナップショットはtimestampsに全てのタイムスタンプを持つ
+                    timestamps.extend(doc.get('timestamps', []))
+                    if isinstance(doc.get('timestamp'), (int, float)):
+                        timestamps.append(doc['timestamp'])
+
+                results.append({
+                    'table': table_name,
+                    'docs': len(docs),
+                    'bytes': sum(len(json.dumps(doc).encode('utf-8')) for doc in docs),
+                    'oldest': min(timestamps) if timestamps else None,
+                    'newest': max(timestamps) if timestamps else None
+                })
+
+    return results
+
+
+def copy_database(src_path:str, dst_dir:str, backend:str=None) -> str:
+    """
+    データベースのファイル（シャードの場合はディレクトリ）を複製する
+
+    コレクタが書き込んでいる途中のものを複製しないように、
+    SQLiteはバックアップのAPIで、それ以外は共有ロックを取ってから複製する。
+    SQLiteのファイルだけを複製すると-walに残っている変更が抜け落ちる。
+
+    Args:
+        src_path (str): 複製するデータベースのパス
+        dst_dir (str): 複製先のディレクトリ
+        backend (str, optional): バックエンドの種類. Defaults to DB_BACKEND.
+
+    Returns:
+        str: 複製したデータベースのパス
+    """
+    backend = backend or get_backend_name()
+    dst_path = os.path.join(dst_dir, os.path.basename(src_path.rstrip(os.sep)))
+
+    if backend == BACKEND_SQLITE:
+        src = sqlite3.connect(src_path, timeout=30)
+        dst = sqlite3.connect(dst_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        return dst_path
+
+    with FileLock(get_lock_path(backend, src_path), shared=True):
+        if os.path.isdir(src_path):
+            # ロックファイルは複製しない
+            shutil.copytree(src_path, dst_path, ignore=shutil.ignore_patterns('.lock'))
+        else:
+            shutil.copy2(src_path, dst_path)
+    return dst_path
+
+
+def build_synthetic_database(num_snapshots:int, num_clients:int=DEFAULT_SYNTHETIC_CLIENTS, num_devices:int=DEFAULT_SYNTHETIC_DEVICES, num_vendors:int=DEFAULT_SYNTHETIC_VENDORS, now:float=None):
+    """
+    開いているデータベースに1時間ごとのスナップショットを合成して格納する
+
+    クライアントの半分は常に接続していて、残りは時間帯によって入れ替わる
+
+    Args:
+        num_snapshots (int): スナップショットの数
+        num_clients (int, optional): クライアントの数. Defaults to DEFAULT_SYNTHETIC_CLIENTS.
+        num_devices (int, optional): MACアドレステーブルを採取する装置の数. Defaults to DEFAULT_SYNTHETIC_DEVICES.
+        num_vendors (int, optional): MACベンダーの数. Defaults to DEFAULT_SYNTHETIC_VENDORS.
+        now (float, optional): 最新のスナップショットの時刻. Defaults to time.time().
+    """
+    now = now or time.time()
+    start = now - (num_snapshots - 1) * 3600
+
+    def mac_of(i:int) -> str:
+        return f'02:00:5E:{(i >> 16) & 0xff:02X}:{(i >> 8) & 0xff:02X}:{i & 0xff:02X}'
+
+    dhcp_docs = []
+    wlc_docs = []
+    device_docs = {f'sw{n}': [] for n in range(num_devices)}
+
+    for t in range(num_snapshots):
+        timestamp = start + t * 3600
+        clients = [i for i in range(num_clients) if i < num_clients // 2 or (i + t) % 3]
+
+        dhcp_docs.append({'timestamp': timestamp, 'doc_data': [{'ip': f'192.168.{i // 250}.{i % 250 + 2}', 'mac': mac_of(i)} for i in clients]})
+
+        wlc_docs.append({'timestamp': timestamp, 'doc_data': [{
+            'mac_address': mac_of(i).lower(),
+            'ip_address': f'192.168.{i // 250}.{i % 250 + 2}',
+            'ap_name': f'ap{(i + t // 24) % 3}',
+            'wireless_lan_network_name': 'home'
+        } for i in clients]})
+
+        for n, name in enumerate(device_docs.keys()):
+            mac_addresses = {}
+            for i in clients:
+                if i % num_devices != n:
+                    continue
+                mac = mac_of(i).replace(':', '').lower()
+                mac = f'{mac[0:4]}.{mac[4:8]}.{mac[8:12]}'
+                intf = f'GigabitEthernet0/{i % 8}'
+                mac_addresses[mac] = {'interfaces': {intf: {'entry_type': 'dynamic', 'interface': intf}}, 'mac_address': mac}
+            device_docs[name].append({'timestamp': timestamp, 'doc_data': {'mac_table': {'vlans': {'1': {'mac_addresses': mac_addresses}}}}})
+
+    DHCP_CLIENTS_TABLE.insert_many(dhcp_docs, max_history=num_snapshots)
+    WLC_CLIENTS_TABLE.insert_many(wlc_docs, max_history=num_snapshots)
+    for name, docs in device_docs.items():
+        get_device_table(name, 'mac_address_table').insert_many(docs, max_history=num_snapshots)
+
+    vendors = []
+    for i in range(num_vendors):
+        vendors.append({'macPrefix': f'{(i >> 16) & 0xff:02X}:{(i >> 8) & 0xff:02X}:{i & 0xff:02X}', 'vendorName': f'vendor {i}', 'private': False, 'blockType': 'MA-L'})
+    insert_mac_vendors(vendors, now)
+
+
+def measure(func:callable, repeat:int=DEFAULT_REPEAT, setup:callable=None) -> float:
+    """
+    関数の実行にかかる時間を測る
+
+    Args:
+        func (callable): 測る関数
+        repeat (int, optional): 繰り返す回数. Defaults to DEFAULT_REPEAT.
+        setup (callable, optional): 毎回funcの前に呼ぶ関数、時間には含めない. Defaults to None.
+
+    Returns:
+        float: 1回あたりの平均の秒数
+    """
+    elapsed = 0.0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        # 別のプロセスから呼ばれたときと同じように読み込みのキャッシュを捨てる
+        clear_read_cache()
+        start = time.perf_counter()
+        func()
+        elapsed += time.perf_counter() - start
+    return elapsed / repeat
+
+
+def benchmark(db_path:str=None, backend:str=None, synthetic:int=None, num_clients:int=DEFAULT_SYNTHETIC_CLIENTS, repeat:int=DEFAULT_REPEAT) -> dict:
+    """
+    データベースの複製、もしくは合成したデータベースで各操作の時間を測る
+
+    Args:
+        db_path (str, optional): 複製するデータベースのパス. Defaults to バックエンドごとの既定のパス.
+        backend (str, optional): バックエンドの種類. Defaults to DB_BACKEND.
+        synthetic (int, optional): 合成する場合はスナップショットの数. Defaults to None.
+        num_clients (int, optional): 合成する場合のクライアントの数. Defaults to DEFAULT_SYNTHETIC_CLIENTS.
+        repeat (int, optional): 各操作を繰り返す回数. Defaults to DEFAULT_REPEAT.
+
+    Returns:
+        dict: {'stats': get_table_stats()の結果, 'timings': {操作: 秒}}
+    """
+    backend = backend or get_backend_name()
+
+    # 複製したデータベースの外には何も書き込まない
+    retention_mode = get_retention_mode()
+    archive_days = (get_archive_age() or 0) / (24 * 60 * 60)
+    event_log_path = EVENT_LOG_PATH
+    set_archive_days(0)
+    set_event_log_path('')
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if synthetic:
+                path = os.path.join(tmp_dir, os.path.basename(get_default_db_path(backend)))
+                set_retention_mode(RETENTION_MODE_SCHEDULED)
+                with DbSession(db_path=path, backend=backend):
+                    build_synthetic_database(synthetic, num_clients=num_clients)
+            else:
+                src_path = db_path or get_default_db_path(backend)
+                if not os.path.exists(src_path):
+                    raise FileNotFoundError(f'{src_path} not found')
+                path = copy_database(src_path, tmp_dir, backend=backend)
+
+            def session():
+                return DbSession(db_path=path, backend=backend)
+
+            with session():
+                latest = next(iter_dhcp_clients_documents(limit=1), None)
+                max_history = DHCP_CLIENTS_TABLE.max_history
+
+                # ローカルアドレスは検索せずに返るので、グローバルアドレスのMA-Lのベンダーコードから作る
+                prefixes = sorted(d['macPrefix'] for d in get_mac_vendors_all() if len(d['macPrefix']) == 8 and not is_locally_administered(d['macPrefix']))
+                vendor_mac = prefixes[len(prefixes) // 2].upper() + ':00:00:01' if prefixes else '00:00:5E:00:00:01'
+
+            doc_data = latest['doc_data'] if latest else []
+            mac = doc_data[0]['mac'] if doc_data else '02:00:5E:00:00:00'
+            next_timestamp = [latest['timestamp'] if latest else time.time()]
+
+            def open_close():
+                with session():
+                    pass
+
+            def insert():
+                next_timestamp[0] += 3600
+                with session():
+                    insert_dhcp_clients(doc_data, next_timestamp[0])
+
+            def prune():
+                with session():
+                    delete_old_dhcp_clients(max_history)
+
+            def read_latest():
+                with session():
+                    next(iter_dhcp_clients_documents(limit=1), None)
+
+            def search_by_mac():
+                with session():
+                    get_dhcp_clients_by_mac(mac)
+
+            def search_vendor():
+                with session():
+                    search_mac_vendors(vendor_mac)
+
+            # 保存期間の適用を含まない挿入の時間
+            set_retention_mode(RETENTION_MODE_SCHEDULED)
+
+            timings = {}
+            timings['open'] = measure(open_close, repeat)
+            timings['insert'] = measure(insert, repeat)
+            # 毎回一つ分だけ保存期間を超えた状態で測る
+            timings['prune'] = measure(prune, repeat, setup=insert)
+            timings['latest'] = measure(read_latest, repeat)
+            timings['by_mac'] = measure(search_by_mac, repeat)
+            # 別のプロセスから呼ばれたときと同じように、インデックスと検索結果のキャッシュを捨ててから測る
+            timings['vendor'] = measure(search_vendor, repeat, setup=clear_mac_vendors_index)
+            search_vendor()
+            timings['vendor_cached'] = measure(search_vendor, repeat)
+
+            stats = get_table_stats(db_path=path, backend=backend)
+    finally:
+        set_retention_mode(retention_mode)
+        set_archive_days(archive_days)
+        set_event_log_path(event_log_path)
+
+    return {'stats': stats, 'timings': timings}
+
+
+def format_timestamp(ts:float) -> str:
+    if ts is None:
+        return '-'
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def print_table_stats(stats:list):
+    print(f"{'table':32} {'docs':>8} {'bytes':>12}  {'oldest':19}  {'newest':19}")
+    for s in stats:
+        print(f"{s['table']:32} {s['docs']:>8} {s['bytes']:>12}  {format_timestamp(s['oldest']):19}  {format_timestamp(s['newest']):19}")
+
+
+def print_timings(timings:dict):
+    for op, seconds in timings.items():
+        print(f'{op:13} {seconds * 1000:10.2f} ms')
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def test_stats():
+        result = benchmark(synthetic=48, num_clients=10, repeat=2)
+
+        tables = {s['table']: s for s in result['stats']}
+        assert tables['DHCP_CLIENTS']['newest'] > tables['DHCP_CLIENTS']['oldest']
+        assert tables['MAC_VENDORS']['docs'] == DEFAULT_SYNTHETIC_VENDORS + 1
+        assert set(result['timings'].keys()) == {'open', 'insert', 'prune', 'latest', 'by_mac', 'vendor', 'vendor_cached'}
+
+        print_table_stats(result['stats'])
+        print_timings(result['timings'])
+        logger.warning('test stats pass')
+
+    def test_copy_database():
+        import multiprocessing
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # チェックポイントされずに-walに残っている変更も複製される
+            src_path = os.path.join(tmp_dir, 'db.sqlite3')
+            conn = sqlite3.connect(src_path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA wal_autocheckpoint=0')
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.execute('INSERT INTO t VALUES (1)')
+            conn.commit()
+            assert os.path.getsize(src_path + '-wal') > 0
+
+            os.makedirs(os.path.join(tmp_dir, 'copy'))
+            dst_path = copy_database(src_path, os.path.join(tmp_dir, 'copy'), backend=BACKEND_SQLITE)
+            conn.close()
+            copied = sqlite3.connect(dst_path)
+            assert [(1,)] == copied.execute('SELECT x FROM t').fetchall()
+            copied.close()
+
+            # 別のプロセスが書き込み中は排他ロックが外れるのを待ってから複製する
+            src_path = os.path.join(tmp_dir, 'db.json')
+
+            def writer(locked):
+                with FileLock(get_lock_path('tinydb', src_path)):
+                    with open(src_path, 'w') as f:
+                        f.write('{"_default": {')
+                    locked.set()
+                    time.sleep(0.5)
+                    with open(src_path, 'w') as f:
+                        f.write('{"_default": {}}')
+
+            ctx = multiprocessing.get_context('fork')
+            locked = ctx.Event()
+            p = ctx.Process(target=writer, args=(locked,))
+            p.start()
+            assert locked.wait(timeout=5)
+            dst_path = copy_database(src_path, os.path.join(tmp_dir, 'copy'), backend='tinydb')
+            p.join()
+            with open(dst_path) as f:
+                assert '{"_default": {}}' == f.read()
+
+        logger.warning('test copy database pass')
+
+    parser = argparse.ArgumentParser(description='show table statistics and benchmark database operations')
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-s', '--stats', action='store_true', default=False, help='show table statistics')
+    parser.add_argument('-b', '--bench', action='store_true', default=False, help='benchmark operations on a copy of the database')
+    parser.add_argument('--db', dest='db_path', help='database path, defaults to the production database')
+    parser.add_argument('--backend', dest='backend', help='tinydb, sqlite or sharded')
+    parser.add_argument('--synthetic', type=int, metavar='SNAPSHOTS', help='benchmark on a synthetic database with this many hourly snapshots')
+    parser.add_argument('--clients', type=int, default=DEFAULT_SYNTHETIC_CLIENTS, help='number of clients in the synthetic database')
+    parser.add_argument('-n', '--repeat', type=int, default=DEFAULT_REPEAT, help='number of times each operation runs')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_copy_database()
+            test_stats()
+            return 0
+
+        if args.stats:
+            print_table_stats(get_table_stats(db_path=args.db_path, backend=args.backend))
+            return 0
+
+        if args.bench:
+            result = benchmark(db_path=args.db_path, backend=args.backend, synthetic=args.synthetic, num_clients=args.clients, repeat=args.repeat)
+            print_table_stats(result['stats'])
+            print('')
+            print_timings(result['timings'])
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+#
+# TinyDBのストレージ
+#
+# TinyDBのJSONStorageは読み書きのたびに標準のjsonモジュールでdb.json全体を変換するので、
+# PYATSのMACアドレステーブルやスナップショットが溜まってくるとこれが一番重い処理になる。
+# そこで速いエンコーダを使うストレージを用意する。
+#
+# - json     TinyDBのJSONStorage、これまで通り
+# - orjson   orjsonで読み書きする、ファイルはJSONのままなので変換は不要
+# - msgpack  msgpackのバイナリ形式で読み書きする、ファイルは db.msgpack になる
+#
+# どれを使うかは環境変数 DB_UTIL_FORMAT で指定する。
+# orjsonとmsgpackはインストールされている場合だけ使える。
+#
+# pip install orjson
+# pip install msgpack
+#
+# 既存のdb.jsonをmsgpackに変換するには
+# python storages.py --convert json msgpack
+#
+# 形式ごとの速さを比べるには
+# python storages.py --bench
+#
+#
+# プロセス内の読み込みキャッシュ
+#
+# analyze.pyのように何度も検索する処理では、その都度db.jsonを開いてパースし直していた。
+# SharedCachingMiddlewareはパースした結果をファイルのパスごとにプロセス内で共有し、
+# ファイルのmtime, サイズ, inodeが変わっていなければそれを使い回す。
+# コレクタが書き込めばmtimeが変わるので、次に開いたときに読み直す。
+#
+# 無効にするには環境変数 DB_UTIL_READ_CACHE=0 とする。
+#
+# lock_pathを指定した場合はファイルを読む間だけ共有ロックを取る（読み込み専用のセッション用）。
+# 書き込みは排他ロックを取ってから行われるので、書きかけのファイルを読むことはない。
+#
+
+import logging
+import os
+
+from contextlib import nullcontext
+
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage, Storage, touch
+
+try:
+    from .file_lock import FileLock
+except ImportError:
+    from file_lock import FileLock
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 格納形式
+FORMAT_JSON = 'json'
+FORMAT_ORJSON = 'orjson'
+FORMAT_MSGPACK = 'msgpack'
+
+DB_FORMAT = os.environ.get('DB_UTIL_FORMAT', FORMAT_JSON)
+
+# 格納形式ごとのファイルの拡張子
+FORMAT_EXTENSIONS = {
+    FORMAT_JSON: '.json',
+    FORMAT_ORJSON: '.json',
+    FORMAT_MSGPACK: '.msgpack',
+}
+
+# プロセス内の読み込みキャッシュを使うかどうか
+READ_CACHE_ENABLED = os.environ.get('DB_UTIL_READ_CACHE', '1') != '0'
+
+logger = logging.getLogger(__name__)
+
+# パースしたファイルの内容 {パス: (ファイルのシグネチャ, データ)}
+_read_cache = {}
+
+
+def file_signature(path:str):
+    """
+    ファイルが書き換えられたかどうかを判定するための値
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def clear_read_cache():
+    _read_cache.clear()
+
+
+class SharedCachingMiddleware(CachingMiddleware):
+    """
+    パースした結果をプロセス内で共有するCachingMiddleware
+
+    write_through=Trueの場合は書き込みのたびにファイルに書き出す（セッションの外で使う場合）。
+    lock_pathを指定した場合はファイルを読む間だけ共有ロックを取る。
+    """
+
+    def __init__(self, storage_cls, write_through:bool=False, lock_path:str=None) -> None:
+        super().__init__(storage_cls)
+        self.path = None
+        self.lock_path = lock_path
+        if write_through:
+            self.WRITE_CACHE_SIZE = 1
+
+
+    def __call__(self, path:str, *args, **kwargs):
+        self.path = os.path.abspath(path)
+        return super().__call__(path, *args, **kwargs)
+
+
+    def read(self):
+        if self.cache is not None:
+            return self.cache
+
+        with FileLock(self.lock_path, shared=True) if self.lock_path else nullcontext():
+            signature = file_signature(self.path)
+            cached = _read_cache.get(self.path)
+            if READ_CACHE_ENABLED and cached is not None and cached[0] == signature:
+                self.cache = cached[1]
+                return self.cache
+
+            self.cache = self.storage.read()
+
+        if READ_CACHE_ENABLED and self.cache is not None:
+            _read_cache[self.path] = (signature, self.cache)
+        return self.cache
+
+
+    def discard(self):
+        """
+        溜まっている書き込みをファイルに書き出さずに捨てる
+
+        読み込みキャッシュは書き込みで変わっているので、次に開いたときに読み直させる
+        """
+        if self._cache_modified_count == 0:
+            return
+
+        _read_cache.pop(self.path, None)
+        self.cache = None
+        self._cache_modified_count = 0
+
+
+    def flush(self):
+        if self._cache_modified_count == 0:
+            return
+
+        super().flush()
+
+        # 自分で書き込んだ内容は読み直さなくてよい
+        if READ_CACHE_ENABLED:
+            _read_cache[self.path] = (file_signature(self.path), self.cache)
+
+
+class _BinaryFileStorage(Storage):
+    """
+    ファイル全体をバイト列として読み書きするストレージ
+
+    継承したクラスで _loads() と _dumps() を実装する
+    """
+
+    def __init__(self, path:str, create_dirs:bool=False, access_mode:str='rb+', **kwargs) -> None:
+        super().__init__()
+
+        self._mode = access_mode
+
+        # 書き込みできるモードならファイルを作っておく
+        if '+' in access_mode:
+            touch(path, create_dirs=create_dirs)
+
+        self._handle = open(path, mode=access_mode)
+
+
+    def _loads(self, data:bytes) -> dict:
+        raise NotImplementedError
+
+
+    def _dumps(self, data:dict) -> bytes:
+        raise NotImplementedError
+
+
+    def read(self):
+        self._handle.seek(0)
+        data = self._handle.read()
+        if not data:
+            # 空のファイルはNoneを返すとTinyDBが初期化する
+            return None
+        return self._loads(data)
+
+
+    def write(self, data:dict):
+        self._handle.seek(0)
+        self._handle.write(self._dumps(data))
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+        # 短くなった場合に後ろに残ったものを消す
+        self._handle.truncate()
+
+
+    def close(self):
+        self._handle.close()
+
+
+class OrjsonStorage(_BinaryFileStorage):
+    """
+    orjsonで読み書きするストレージ、ファイルはJSONStorageと互換
+    """
+
+    def __init__(self, path:str, **kwargs) -> None:
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+        super().__init__(path, **kwargs)
+
+
+    def _loads(self, data:bytes) -> dict:
+        return orjson.loads(data)
+
+
+    def _dumps(self, data:dict) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MsgpackStorage(_BinaryFileStorage):
+    """
+    msgpackのバイナリ形式で読み書きするストレージ
+    """
+
+    def __init__(self, path:str, **kwargs) -> None:
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+        super().__init__(path, **kwargs)
+
+
+    def _loads(self, data:bytes) -> dict:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+    def _dumps(self, data:dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+
+def get_format() -> str:
+    return DB_FORMAT
+
+
+def set_format(fmt:str):
+    global DB_FORMAT
+
+    get_storage_class(fmt)
+    DB_FORMAT = fmt
+
+
+def get_storage_class(fmt:str=None):
+    """
+    格納形式に対応するストレージのクラスを返却する
+
+    Args:
+        fmt (str, optional): 格納形式. Defaults to DB_FORMAT.
+
+    Returns:
+        class: TinyDBに渡すストレージのクラス
+    """
+    fmt = fmt or DB_FORMAT
+
+    if fmt == FORMAT_JSON:
+        return JSONStorage
+
+    if fmt == FORMAT_ORJSON:
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        return OrjsonStorage
+
+    if fmt == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return MsgpackStorage
+
+    raise ValueError(f'unknown format: {fmt}')
+
+
+def available_formats() -> list:
+    """
+    この環境で使える格納形式の一覧
+    """
+    formats = [FORMAT_JSON]
+    if orjson is not None:
+        formats.append(FORMAT_ORJSON)
+    if msgpack is not None:
+        formats.append(FORMAT_MSGPACK)
+    return formats
+
+
+def read_storage(path:str, fmt:str) -> dict:
+    storage = get_storage_class(fmt)(path, access_mode='rb' if fmt != FORMAT_JSON else 'r')
+    try:
+        return storage.read() or {}
+    finally:
+        storage.close()
+
+
+def write_storage(path:str, fmt:str, data:dict):
+    storage = get_storage_class(fmt)(path)
+    try:
+        storage.write(data)
+    finally:
+        storage.close()
+
+
+def convert_storage(src_path:str, src_format:str, dst_path:str, dst_format:str):
+    """
+    TinyDBのファイルを別の格納形式に変換する
+
+    ドキュメントIDも含めてそのまま書き写す
+
+    Args:
+        src_path (str): 変換元のファイル
+        src_format (str): 変換元の格納形式
+        dst_path (str): 変換先のファイル
+        dst_format (str): 変換先の格納形式
+    """
+    data = read_storage(src_path, src_format)
+
+    # 書き込み途中で落ちても変換元が残るように別名で書いてから置き換える
+    tmp_path = dst_path + '.tmp'
+    write_storage(tmp_path, dst_format, data)
+    os.replace(tmp_path, dst_path)
+
+    logger.info(f'{src_path} ({src_format}) -> {dst_path} ({dst_format}): {len(data)} tables')
+
+
+def benchmark(num_docs:int=2000, repeat:int=5) -> dict:
+    """
+    格納形式ごとに読み込みと書き込みの時間を測る
+
+    PYATSのMACアドレステーブルに似たドキュメントを作って測定する
+
+    Args:
+        num_docs (int, optional): ドキュメントの数. Defaults to 2000.
+        repeat (int, optional): 繰り返す回数. Defaults to 5.
+
+    Returns:
+        dict: {格納形式: {'read': 秒, 'write': 秒, 'size': バイト}}
+    """
+    import tempfile
+    import time
+
+    mac_addresses = {}
+    for i in range(40):
+        mac = f'0000.5e00.{i:04x}'
+        intf = f'GigabitEthernet0/{i % 8}'
+        mac_addresses[mac] = {'interfaces': {intf: {'entry_type': 'dynamic', 'interface': intf}}, 'mac_address': mac}
+
+    table = {}
+    for i in range(num_docs):
+        table[str(i + 1)] = {
+            'device_name': f'sw{i % 4}',
+            'doc_type': 'mac_address_table',
+            'doc_data': {'mac_table': {'vlans': {'1': {'mac_addresses': mac_addresses}}}},
+            'timestamp': 1672531200.0 + i * 3600,
+        }
+    data = {'PYATS': table}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fmt in available_formats():
+            path = os.path.join(tmp_dir, 'db' + FORMAT_EXTENSIONS[fmt])
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                write_storage(path, fmt, data)
+            write_time = (time.perf_counter() - start) / repeat
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                assert data == read_storage(path, fmt)
+            read_time = (time.perf_counter() - start) / repeat
+
+            results[fmt] = {'read': read_time, 'write': write_time, 'size': os.path.getsize(path)}
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import tempfile
+
+    from tinydb import TinyDB
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_storages():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_path = os.path.join(tmp_dir, 'db.json')
+            with TinyDB(json_path) as db:
+                db.table('TEST').insert({'timestamp': 1.0, 'doc_data': [{'ip': '192.168.122.106'}]})
+
+            for fmt in available_formats():
+                path = os.path.join(tmp_dir, 'converted' + FORMAT_EXTENSIONS[fmt])
+                convert_storage(json_path, FORMAT_JSON, path, fmt)
+
+                with TinyDB(path, storage=get_storage_class(fmt)) as db:
+                    assert [{'timestamp': 1.0, 'doc_data': [{'ip': '192.168.122.106'}]}] == db.table('TEST').all()
+                    db.table('TEST').insert({'timestamp': 2.0})
+                    assert 2 == len(db.table('TEST').all())
+
+                assert 2 == len(read_storage(path, fmt)['TEST'])
+
+            # 読み込みキャッシュ
+            num_reads = [0]
+
+            class CountingStorage(JSONStorage):
+                def read(self):
+                    num_reads[0] += 1
+                    return super().read()
+
+            for _ in range(3):
+                with TinyDB(json_path, storage=SharedCachingMiddleware(CountingStorage, write_through=True)) as db:
+                    assert 1 == len(db.table('TEST').all())
+            assert 1 == num_reads[0]
+
+            # 他のプロセスが書き込んだら読み直す
+            with TinyDB(json_path) as db:
+                db.table('TEST').insert({'timestamp': 2.0})
+            with TinyDB(json_path, storage=SharedCachingMiddleware(CountingStorage, write_through=True)) as db:
+                assert 2 == len(db.table('TEST').all())
+            assert 2 == num_reads[0]
+
+        logger.info(f'test storages pass: {available_formats()}')
+
+    def print_benchmark(num_docs:int):
+        results = benchmark(num_docs=num_docs)
+        base = results[FORMAT_JSON]
+        print(f'{num_docs} documents')
+        print(f'{"format":10s} {"read[ms]":>10s} {"write[ms]":>10s} {"size[KB]":>10s} {"speedup":>8s}')
+        for fmt, r in results.items():
+            speedup = (base['read'] + base['write']) / (r['read'] + r['write'])
+            print(f'{fmt:10s} {r["read"] * 1000:10.1f} {r["write"] * 1000:10.1f} {r["size"] / 1024:10.1f} {speedup:7.1f}x')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
+    parser.add_argument('-b', '--bench', action='store_true', default=False, help='compare formats')
+    parser.add_argument('-n', '--num', dest='num', type=int, default=2000, help='number of documents for benchmark')
+    parser.add_argument('--convert', nargs=2, metavar=('SRC', 'DST'), help='convert database file, e.g. --convert json msgpack')
+    args = parser.parse_args()
+
+    def main():
+        if args.test:
+            test_storages()
+            return 0
+
+        if args.bench:
+            print_benchmark(args.num)
+            return 0
+
+        if args.convert:
+            src_format, dst_format = args.convert
+            db_dir = os.path.dirname(os.path.abspath(__file__))
+            src_path = os.path.join(db_dir, 'db' + FORMAT_EXTENSIONS[src_format])
+            dst_path = os.path.join(db_dir, 'db' + FORMAT_EXTENSIONS[dst_format])
+            if src_path == dst_path:
+                # json と orjson はファイルの形式が同じなので変換は不要
+                logger.info(f'{src_format} and {dst_format} share the same file format')
+                return 0
+            convert_storage(src_path, src_format, dst_path, dst_format)
+            return 0
+
+        parser.print_help()
+        return 0
+
+    sys.exit(main())
@@ -1,18 +1,15 @@
 #!/usr/bin/env python
 
 import logging
-import os
 
 from datetime import datetime
 
-#
-# tinydb
-#
-from tinydb import Query, TinyDB
-
-# JSONファイル
-DB_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(DB_DIR, 'db.json')
+try:
+    from .snapshot_table import SnapshotTable
+    from .mac_observations_table import SOURCE_WLC, wlc_observations, normalize_mac
+except ImportError:
+    from snapshot_table import SnapshotTable
+    from mac_observations_table import SOURCE_WLC, wlc_observations, normalize_mac
 
 # テーブルの種類
 TABLE_WLC_CLIENTS = 'WLC_CLIENTS'
@@ -20,102 +17,76 @@ TABLE_WLC_CLIENTS = 'WLC_CLIENTS'
 # 保管する履歴
 DEFAULT_WLC_MAX_HISTORY = 168   # 1時間に1回実行して7日分
 
-logger = logging.getLogger(__name__)
+# 差分とイベントで比較する属性
+# connected_forのように接続している間ずっと変わり続ける値を含めると、
+# 同じ端末が同じAPにいるだけで毎回削除と追加の差分になり、moveイベントが出てしまう
+WLC_ENTRY_FIELDS = ('mac_address', 'ip_address', 'ap_name', 'wireless_lan_network_name', 'device_type', 'hostname')
 
-#
-# WLCに接続している無線クライアントに関する情報
-#
+# WLC_ENTRY_FIELDSを変えたら上げる、保存済みの差分履歴は作り直される
+WLC_ENTRIES_VERSION = 1
 
-def insert_wlc_clients(wlc_clients_list:list, timestamp:float, max_history:int=DEFAULT_WLC_MAX_HISTORY, table_name:str=TABLE_WLC_CLIENTS):
-    """_summary_
+logger = logging.getLogger(__name__)
 
-    {
-        'timestamp': float型 タイムスタンプ,
-        'doc_data': [ {'mac_address': a.b.c.d, 'ap_name': ...}, {}, {}]
-    }
-
-    {
-        'ap_mac_address': '00:a3:8e:15:f9:e0',
-        'ap_name': 'taka-AP1815I',
-        'client_state': 'Associated',
-        'connected_for': '12792',
-        'device_type': 'Android',
-        'gateway_address': '192.168.122.1',
-        'hostname': 'Pixel-5',
-        'ip_address': '192.168.122.112',
-        'mac_address': 'fe:dd:b8:3f:de:59',
-        'netmask': '255.255.255.0',
-        'username': 'N/A',
-        'wireless_lan_network_name': 'taka 11ac'
-    }
 
-    Args:
-        wlc_clients_list (list): doc_dataとして格納する配列
-        timestamp (float): 採取した時刻のタイムスタンプ
-        max_history (int, optional): 蓄積する数 Defaults to DEFAULT_WLC_MAX_HISTORY.
-        table_name (str, optional): テーブル名 Defaults to TABLE_WLC_CLIENTS.
+def wlc_clients_entries(wlc_clients_list:list) -> list:
     """
+    WLCクライアントの一覧から差分を取るための属性だけを取り出す
 
-    # 格納するドキュメント
-    doc = {}
+    Returns:
+        list: [{'mac_address': ..., 'ip_address': ..., 'ap_name': ..., ...}, ...]
+    """
+    return [{key: d[key] for key in WLC_ENTRY_FIELDS if key in d} for d in wlc_clients_list]
 
-    # タイムスタンプを付与
-    doc['timestamp'] = timestamp
 
-    # ドキュメントデータを付与
-    doc['doc_data'] = wlc_clients_list
+#
+# WLCに接続している無線クライアントに関する情報
+#
 
-    # テーブルに格納
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        table.insert(doc)
+WLC_CLIENTS_TABLE = SnapshotTable(
+    TABLE_WLC_CLIENTS,
+    DEFAULT_WLC_MAX_HISTORY,
+    source_key=SOURCE_WLC,
+    mac_key='mac_address',
+    observations=wlc_observations,
+    entries=wlc_clients_entries,
+    entries_version=WLC_ENTRIES_VERSION,
+    archive=True
+)
 
-    # max_historyを超えた古いものを削除
-    delete_old_wlc_clients(max_history)
 
+def get_wlc_clients_table(table_name:str=TABLE_WLC_CLIENTS) -> SnapshotTable:
+    """
+    テーブル名に対応するSnapshotTableを返却する
 
-def delete_old_wlc_clients(max_history:int, table_name:str=TABLE_WLC_CLIENTS):
+    TABLE_WLC_CLIENTS以外（テスト用など）はMACアドレスの観測インデックスや差分履歴を作らない
+    """
+    if table_name == TABLE_WLC_CLIENTS:
+        return WLC_CLIENTS_TABLE
+    return SnapshotTable(table_name, DEFAULT_WLC_MAX_HISTORY, entries=wlc_clients_entries, archive=True)
 
-    q = Query()
 
-    # 降順のタイムスタンプの一覧を取得
-    timestamps = get_wlc_clients_timestamps(table_name=table_name)
+def insert_wlc_clients(wlc_clients_list:list, timestamp:float, max_history:int=DEFAULT_WLC_MAX_HISTORY, table_name:str=TABLE_WLC_CLIENTS):
+    """_summary_
+        wlc_clients_list (list): doc_dataとして格納する配列
+        timestamp (float): 採取した時刻のタイムスタンプ
+        max_history (int, optional): 蓄積する数 Defaults to DEFAULT_WLC_MAX_HISTORY.
+        table_name (str, optional): テーブル名 Defaults to TABLE_WLC_CLIENTS.
+    """
+    get_wlc_clients_table(table_name).insert(wlc_clients_list, timestamp, max_history=max_history)
 
-    # max_historyを超えたものを削除
-    if len(timestamps) > max_history:
-        should_be_deleted = timestamps[max_history:]
-        with TinyDB(DB_PATH) as db:
-            table = db.table(table_name)
 
-            for ts in should_be_deleted:
-                table.remove(q.timestamp == ts)
+def delete_old_wlc_clients(max_history:int, table_name:str=TABLE_WLC_CLIENTS):
+    get_wlc_clients_table(table_name).delete_old(max_history)
 
 
 def get_wlc_clients_timestamps(table_name:str=TABLE_WLC_CLIENTS):
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-
-        # timestampキーの一覧を取り出す
-        timestamps = [doc['timestamp'] for doc in table.all()]
-
-    # 降順にソートする
-    timestamps.sort(reverse=True)
-
-    return timestamps
+    # 降順のタイムスタンプの一覧
+    return get_wlc_clients_table(table_name).timestamps()
 
 
 def get_wlc_clients_dates(table_name:str=TABLE_WLC_CLIENTS):
-
-    timestamps = get_wlc_clients_timestamps(table_name=table_name)
-
-    # datetimeオブジェクトに変換
-    datetimes = [datetime.fromtimestamp(ts) for ts in timestamps]
-
-    # 分かりやすく日付の文字列に変換
-    dates = [dt.strftime("%Y-%m-%d %H:%M:%S") for dt in datetimes]
-
-    return dates
+    return get_wlc_clients_table(table_name).dates()
 
 
 def get_wlc_clients_documents(table_name:str=TABLE_WLC_CLIENTS):
@@ -128,23 +99,34 @@ def get_wlc_clients_documents(table_name:str=TABLE_WLC_CLIENTS):
     Returns:
         list: ドキュメントのリスト
     """
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        return sorted(table.all(), key=lambda d: d['timestamp'], reverse=True)
+    return get_wlc_clients_table(table_name).documents()
 
 
-def get_wlc_clients_by_timestamp(timestamp:float, table_name:str=TABLE_WLC_CLIENTS):
-    q = Query()
+def iter_wlc_clients_documents(since:float=None, until:float=None, limit:int=None, table_name:str=TABLE_WLC_CLIENTS):
+    """
+    ドキュメントを新しい順に一つずつ返すジェネレータ
 
-    with TinyDB(DB_PATH) as db:
-        table = db.table(table_name)
-        return table.get(q.timestamp == timestamp)
+    範囲がデータベースより古い時刻に及ぶ場合はアーカイブからも読み込む
+
+    Args:
+        since (float, optional): これ以降のタイムスタンプ、この値を含む. Defaults to None.
+        until (float, optional): これ以前のタイムスタンプ、この値を含む. Defaults to None.
+        limit (int, optional): 最大の数. Defaults to None.
+        table_name (str, optional): テーブル名. Defaults to TABLE_WLC_CLIENTS.
+
+    Yields:
+        dict: ドキュメント
+    """
+    yield from get_wlc_clients_table(table_name).iter_documents(since=since, until=until, limit=limit)
+
+
+def get_wlc_clients_by_timestamp(timestamp:float, table_name:str=TABLE_WLC_CLIENTS):
+    return get_wlc_clients_table(table_name).by_timestamp(timestamp)
 
 
 def dump_wlc_clients(table_name:str=TABLE_WLC_CLIENTS):
-    docs = get_wlc_clients_documents(table_name=table_name)
     try:
-        for doc in docs:
+        for doc in iter_wlc_clients_documents(table_name=table_name):
             ts = doc['timestamp']  # float型 タイムスタンプ,
             dt = datetime.fromtimestamp(ts)
             print(dt.strftime("%Y-%m-%d %H:%M:%S"))
@@ -160,10 +142,66 @@ def dump_wlc_clients(table_name:str=TABLE_WLC_CLIENTS):
     return 0
 
 
+def build_wlc_clients_observations(table_name:str=TABLE_WLC_CLIENTS):
+    """
+    WLCクライアントの全履歴からMACアドレスの観測インデックスを作り直す
+
+    Args:
+        table_name (str, optional): テーブル名. Defaults to TABLE_WLC_CLIENTS.
+    """
+    get_wlc_clients_table(table_name).build_observations()
+
+
+def build_wlc_clients_diffs(table_name:str=TABLE_WLC_CLIENTS):
+    """
+    WLCクライアントの全履歴から差分履歴を作り直す
+
+    Args:
+        table_name (str, optional): テーブル名. Defaults to TABLE_WLC_CLIENTS.
+    """
+    get_wlc_clients_table(table_name).build_diffs()
+
+
+def get_wlc_clients_diff(since:float=None, table_name:str=TABLE_WLC_CLIENTS):
+    """
+    隣り合うスナップショットの差分を新しい順に返却する、違いがないものは含まない
+
+    Args:
+        since (float, optional): 新しい方のタイムスタンプがこれ以降、この値を含む. Defaults to None.
+        table_name (str, optional): テーブル名. Defaults to TABLE_WLC_CLIENTS.
+
+    Returns:
+        list: [{'timestamp_before': xxx, 'timestamp_after': xxx, 'add': [...], 'delete': [...]}, ...]
+    """
+    return get_wlc_clients_table(table_name).diff(since=since)
+
+
 def search_wlc_clients(mac_address:str, table_name:str=TABLE_WLC_CLIENTS):
-    # 全てのドキュメントを対象に探して、最初に見つけたものを返す
-    docs = get_wlc_clients_documents(table_name=table_name)
-    for doc in docs:
+
+    # MACアドレスの観測インデックスから最後に見つけたスナップショットを探す
+    table = get_wlc_clients_table(table_name)
+    found = table.find_mac(mac_address)
+    if found is not None:
+        doc = table.by_timestamp(found[-1][0]) if found else None
+
+        if doc is None:
+            print('not found')
+            return None
+
+        ts = doc['timestamp']
+        dt = datetime.fromtimestamp(ts)
+        print(dt.strftime("%Y-%m-%d %H:%M:%S"))
+
+        mac_address = normalize_mac(mac_address)
+        searched = list(filter(lambda d: normalize_mac(d.get('mac_address', '')) == mac_address, doc['doc_data']))
+        if searched:
+            print('found')
+            return searched[0]
+        print('not found')
+        return None
+
+    # 新しいドキュメントから順に探して、最初に見つけたものを返す
+    for doc in iter_wlc_clients_documents(table_name=table_name):
         ts = doc['timestamp']  # float型 タイムスタンプ,
         dt = datetime.fromtimestamp(ts)
         print(dt.strftime("%Y-%m-%d %H:%M:%S"))
@@ -188,13 +226,72 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO)
 
+    def test_wlc_clients_events():
+        import os
+        import tempfile
+
+        try:
+            from db_session import DbSession
+            from archive import get_archive_age, set_archive_days
+            from events import EVENT_MOVE, EVENT_LOG_PATH, set_event_log_path, subscribe, unsubscribe
+        except ImportError:
+            from .db_session import DbSession
+            from .archive import get_archive_age, set_archive_days
+            from .events import EVENT_MOVE, EVENT_LOG_PATH, set_event_log_path, subscribe, unsubscribe
+
+        client = {
+            'ap_name': 'taka-AP1815I',
+            'client_state': 'Associated',
+            'connected_for': '10',
+            'device_type': 'NintendoWII',
+            'hostname': 'N/A',
+            'ip_address': '192.168.122.107',
+            'mac_address': '04:03:d6:d8:57:5f',
+            'wireless_lan_network_name': 'taka 11ac'
+        }
+
+        archive_days = (get_archive_age() or 0) / (24 * 60 * 60)
+        event_log_path = EVENT_LOG_PATH
+        received = []
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                set_archive_days(0)
+                set_event_log_path(os.path.join(tmp_dir, 'events.jsonl'))
+                subscribe(received.append)
+
+                with DbSession(db_path=os.path.join(tmp_dir, 'db.json'), backend='tinydb'):
+                    insert_wlc_clients([client], 1.0)
+                    insert_wlc_clients([client], 2.0)
+
+                    # connected_forが変わっただけでは差分もイベントも作らない
+                    insert_wlc_clients([dict(client, connected_for='3610')], 3.0)
+                    assert [] == received
+                    assert [] == get_wlc_clients_diff()
+
+                    # APが変わればmove
+                    insert_wlc_clients([dict(client, connected_for='7210', ap_name='living-AP1815M')], 4.0)
+                    assert [EVENT_MOVE] == [event['event'] for event in received]
+                    assert [(3.0, 4.0)] == [(d['timestamp_before'], d['timestamp_after']) for d in get_wlc_clients_diff()]
+        finally:
+            unsubscribe(received.append)
+            set_event_log_path(event_log_path)
+            set_archive_days(archive_days)
+
+        logger.info('test wlc clients events pass')
+
     parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
     parser.add_argument('-d', '--dump', action='store_true', default=False, help='dump all data')
     parser.add_argument('-s', '--search', dest='search', help='search mac address', type=str)
+    parser.add_argument('-b', '--build-diffs', action='store_true', default=False, help='rebuild snapshot diffs')
     args = parser.parse_args()
 
     def main():
 
+        if args.test:
+            test_wlc_clients_events()
+            return 0
+
         if args.dump:
             dump_wlc_clients()
             return 0
@@ -204,6 +301,10 @@ if __name__ == '__main__':
             pprint(searched)
             return 0
 
+        if args.build_diffs:
+            build_wlc_clients_diffs()
+            return 0
+
 
         parser.print_help()
 
@@ -1 +1 @@
-from .mac_vendors_util import get_mac_vendors_list, get_last_modified
\ No newline at end of file
+from .mac_vendors_util import JSON_DIR, get_mac_vendors_list, get_last_modified, parse_last_modified, download_mac_vendors, iter_mac_vendors
@@ -4,10 +4,22 @@
 #
 # 参照
 # https://maclookup.app/downloads/json-database
+#
+# ダンプは数万件あるので、r.json()で一度に読み込むとレスポンスの本文、パースしたリスト、
+# 保存のためのJSON文字列と、同じデータのコピーがいくつもメモリに載ることになる。
+# そこでdownload_mac_vendors()で少しずつファイルに書き出し、
+# iter_mac_vendors()でファイルを少しずつ読みながら配列の要素を一つずつ返す。
+# 格納する側（insert_mac_vendors()）もイテレータをそのまま受け取るので、使うメモリはダンプの大きさに比例しない。
+#
+# 前回取得したときのETagとLast-Modifiedを渡すと条件付きのGETになり、更新されていなければ304が返って本文は来ない。
+# resume=Trueの場合は途中で切れたダウンロードを.partファイルに残しておき、次回はRangeで続きから取得する。
+# サーバ側のファイルが変わっていればIf-Rangeにより最初から送り直される。
+#
 
 import json
 import logging
 import os
+import tempfile
 from dateutil.parser import parse
 
 import requests
@@ -18,6 +30,12 @@ requests.packages.urllib3.util.connection.HAS_IPV6 = False
 # ダウンロードリンク
 URL = 'https://maclookup.app/downloads/json-database/get-db'
 
+# ダウンロードと読み込みの単位
+CHUNK_SIZE = 64 * 1024
+
+# 保存先のディレクトリ
+JSON_DIR = os.path.join(os.path.dirname(__file__), 'json')
+
 logger = logging.getLogger(__name__)
 
 
@@ -42,7 +60,14 @@ def get_last_modified(url: str = URL, requests_options={}) -> float:
     #  'Last-Modified': 'Fri, 11 Nov 2022 07:58:52 GMT',
     #  'CF-Cache-Status': 'HIT',
 
-    last_modified = r.headers.get('Last-Modified', None)
+    return parse_last_modified(r.headers)
+
+
+def parse_last_modified(headers: dict) -> float:
+    """
+    レスポンスヘッダの'Last-Modified'をタイムスタンプにする、無ければNone
+    """
+    last_modified = headers.get('Last-Modified', None)
     if last_modified is None:
         return None
 
@@ -51,15 +76,163 @@ def get_last_modified(url: str = URL, requests_options={}) -> float:
     return ts
 
 
-def get_mac_vendors_list(url: str = URL, requests_options={}, save=False) -> list:
+def download_mac_vendors(path: str, url: str = URL, requests_options={}, etag: str = None, last_modified: str = None, resume: bool = False) -> dict:
+    """
+    ダンプを少しずつファイルに書き出す
+
+    書き終わるまではpath.partに書くので、途中で失敗してもpathのファイルは壊れない。
 
+    Args:
+        path (str): 保存するファイル
+        url (str, optional): ダウンロードリンク. Defaults to URL.
+        requests_options (dict, optional): requestsに渡すオプション. Defaults to {}.
+        etag (str, optional): 前回のETag、If-None-Matchで送る. Defaults to None.
+        last_modified (str, optional): 前回のLast-Modified、If-Modified-Sinceで送る. Defaults to None.
+        resume (bool, optional): 途中で切れたダウンロードを残しておき、次回に続きから取得する. Defaults to False.
+
+    Returns:
+        dict: レスポンスヘッダ、更新されていなければ(304)None
+    """
     logger.info(f'get {url}')
 
     headers = {'content-type': 'application/json'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    part_path = path + '.part'
+    meta_path = part_path + '.json'
+
+    # 前回途中で切れていたら続きから
+    offset = 0
+    if resume and os.path.exists(part_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        validator = meta.get('etag') or meta.get('last_modified')
+        if validator:
+            offset = os.path.getsize(part_path)
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+
+    def discard():
+        for p in (part_path, meta_path):
+            if os.path.exists(p):
+                os.unlink(p)
+
+    with requests.get(url, headers=headers, stream=True, **requests_options) as r:
+        if r.status_code == 304:
+            logger.info('not modified')
+            discard()
+            return None
+
+        r.raise_for_status()
+
+        if r.status_code == 206:
+            logger.info(f'resume from {offset} bytes')
+            mode = 'ab'
+        else:
+            # 最初から送られてきた
+            offset = 0
+            mode = 'wb'
+            if resume:
+                with open(meta_path, 'w') as f:
+                    json.dump({'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}, f)
+
+        # 接続が切れても例外にならないことがあるので、最後まで受け取れたかを大きさで確かめる
+        content_length = r.headers.get('Content-Length')
+        expected = offset + int(content_length) if content_length and 'Content-Encoding' not in r.headers else None
+
+        try:
+            size = offset
+            with open(part_path, mode) as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            if expected is not None and size < expected:
+                raise IOError(f'download interrupted at {size} of {expected} bytes')
+        except Exception:
+            if not resume:
+                discard()
+            raise
+
+        os.replace(part_path, path)
+        discard()
+
+        logger.info(f'{size} bytes downloaded to {path}')
+        return r.headers
+
+
+def iter_mac_vendors(path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    JSONの配列のファイルを少しずつ読みながら要素を一つずつ返す
+
+    Args:
+        path (str): JSONファイル
+        chunk_size (int, optional): 一度に読む大きさ. Defaults to CHUNK_SIZE.
+
+    Yields:
+        dict: 配列の要素 {"macPrefix": "00:00:0C", "vendorName": "Cisco Systems, Inc", ...}
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+        eof = False
+        started = False
+
+        while True:
+            # 空白と区切りを読み飛ばす
+            while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ',')):
+                pos += 1
+
+            if pos < len(buf):
+                if not started:
+                    if buf[pos] != '[':
+                        raise ValueError(f'{path} is not a JSON array')
+                    started = True
+                    pos += 1
+                    continue
+
+                if buf[pos] == ']':
+                    return
+
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    # 末尾で切れた数値などは続きを読んでからもう一度
+                    if end < len(buf) or eof:
+                        yield obj
+                        pos = end
+                        continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+
+            if eof:
+                raise ValueError(f'{path} ends before the JSON array is closed')
+
+            # 読み終わった部分を捨てて続きを読む
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
 
-    r = requests.get(url, headers=headers, **requests_options)
 
-    r.raise_for_status()
+def get_mac_vendors_list(url: str = URL, requests_options={}, save=False) -> list:
+    """
+    ダンプをダウンロードしてリストにする
+
+    ダンプ全体をメモリに載せるので、データベースに格納するならdownload_mac_vendors()とiter_mac_vendors()を使うこと。
+
+    Args:
+        url (str, optional): ダウンロードリンク. Defaults to URL.
+        requests_options (dict, optional): requestsに渡すオプション. Defaults to {}.
+        save (bool, optional): ダウンロードしたファイルをjsonディレクトリに残す. Defaults to False.
+
+    Returns:
+        list: [{"macPrefix": "00:00:0C", "vendorName": "Cisco Systems, Inc", ...}, ...]
+    """
 
     # print(r.headers)
     # {'Date': 'Sun, 06 Nov 2022 07:51:56 GMT',
@@ -74,30 +247,29 @@ def get_mac_vendors_list(url: str = URL, requests_options={}, save=False) -> lis
     #  'Last-Modified': 'Sun, 06 Nov 2022 07:42:04 GMT',
     #  'CF-Cache-Status': 'HIT',
 
-    data = r.json()
-
-    # pprint(data)
-    #
     # [{"macPrefix":"00:00:0C",
     #   "vendorName":"Cisco Systems, Inc",
     #   "private":false,
     #   "blockType":"MA-L",
     #   "lastUpdate":"2015/11/17"},
 
-    logger.info(f'{len(data)} mac vendors downloaded.')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, 'downloaded.json')
+        response_headers = download_mac_vendors(tmp_path, url=url, requests_options=requests_options)
 
-    if save:
-        # ファイル名をヘッダ情報から取得、ヘッダに含まれない場合はdownloaded.jsonとする
-        content_disposition = r.headers.get('Content-Disposition', 'filename="downloaded.json"')
-        filename = content_disposition.split('filename=')[1]
-        filename = filename.strip('"')
-        filename = filename.strip("'")
+        data = list(iter_mac_vendors(tmp_path))
+        logger.info(f'{len(data)} mac vendors downloaded.')
 
-        json_dir = os.path.join(os.path.dirname(__file__), 'json')
-        json_path = os.path.join(json_dir, filename)
+        if save:
+            # ファイル名をヘッダ情報から取得、ヘッダに含まれない場合はdownloaded.jsonとする
+            content_disposition = response_headers.get('Content-Disposition', 'filename="downloaded.json"')
+            filename = content_disposition.split('filename=')[1]
+            filename = filename.strip('"')
+            filename = filename.strip("'")
 
-        with open(json_path, 'w') as f:
-            json.dump(data, f, indent=4)
+            # ダウンロードしたファイルをそのまま残す
+            os.makedirs(JSON_DIR, exist_ok=True)
+            os.replace(tmp_path, os.path.join(JSON_DIR, filename))
 
     # このリストをmacPrefixキーの値でソートしてから返却する
     # return sorted(data, key=lambda x: x.get('macPrefix', ''))
@@ -105,8 +277,7 @@ def get_mac_vendors_list(url: str = URL, requests_options={}, save=False) -> lis
 
 
 def load_from_file(filename:str ='mac-vendors-export.json'):
-    json_dir = os.path.join(os.path.dirname(__file__), 'json')
-    json_path = os.path.join(json_dir, filename)
+    json_path = os.path.join(JSON_DIR, filename)
 
     with open(json_path) as f:
         data = json.load(f)
@@ -123,12 +294,46 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO)
 
+    def test_iter_mac_vendors():
+        data = [
+            {'macPrefix': '00:00:0C', 'vendorName': 'Cisco Systems, Inc', 'private': False, 'blockType': 'MA-L', 'lastUpdate': '2015/11/17'},
+            {'macPrefix': '8C:1F:64:A5:E', 'vendorName': 'XTIA Ltd [, ] "quoted"', 'private': False, 'blockType': 'MA-S', 'lastUpdate': '2022/10/01'},
+            {'macPrefix': '1C:87:76:D', 'vendorName': 'Qivivo', 'private': False, 'blockType': 'MA-M', 'lastUpdate': '2016/02/05'},
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.json')
+
+            # 読み込みの単位がどこで区切れても同じ結果になる
+            for text in [json.dumps(data), json.dumps(data, indent=4), json.dumps([])]:
+                with open(path, 'w') as f:
+                    f.write(text)
+                expected = json.loads(text)
+                for chunk_size in [1, 2, 7, 64, CHUNK_SIZE]:
+                    assert expected == list(iter_mac_vendors(path, chunk_size=chunk_size))
+
+            # 途中で切れたファイル
+            with open(path, 'w') as f:
+                f.write(json.dumps(data)[:-30])
+            try:
+                list(iter_mac_vendors(path, chunk_size=7))
+                assert False
+            except ValueError:
+                pass
+
+        logger.info('test iter_mac_vendors pass')
+
     parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--test', action='store_true', default=False, help='run test')
     parser.add_argument('-d', '--dump', action='store_true')
     parser.add_argument('-g', '--get', action='store_true')
     args, _ = parser.parse_known_args()
 
     def main():
+        if args.test:
+            test_iter_mac_vendors()
+            return 0
+
         # --dump はJSONファイルをダンプ
         if args.dump:
             data = load_from_file()